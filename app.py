@@ -10,6 +10,19 @@ from datetime import datetime, timedelta
 import io
 import requests  # 用於 REST API 兼容模式
 import json      # 用於處理 API 回傳格式
+import time
+import hashlib
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict
+import uuid
+import zipfile
+import gzip
+import pickle
+import sqlite3
+import tempfile
+from statistics import NormalDist
 
 # --- 核心修正：安全引入套件以防止 App 閃退 ---
 try:
@@ -24,6 +37,21 @@ try:
     HAS_XLSXWRITER = True
 except ModuleNotFoundError:
     HAS_XLSXWRITER = False
+
+# pyarrow（伺服器端大檔以 memory-map + Arrow CSV 讀取；沒有時改用 pandas）
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    HAS_PYARROW = True
+except ModuleNotFoundError:
+    HAS_PYARROW = False
+
+# duckdb（選用：超長歷史以 SQL 直接查詢伺服器端檔案）
+try:
+    import duckdb
+    HAS_DUCKDB = True
+except ModuleNotFoundError:
+    HAS_DUCKDB = False
 # -------------------------------------------
 
 # ==========================================
@@ -37,7 +65,7 @@ AI_CONSULTANT_PROMPT = """
 請使用繁體中文回答，語氣專業精準、條列清楚、直接給可執行決策。
 
 # 資料來源說明
-系統會提供多個表格（Daily Alerts, Weekly Trends, P7D Campaign/AdSet/Ad, 30D Trend, CPM Change）。
+系統會提供多個表格（Daily Alerts, Weekly Trends, P7D Campaign/AdSet/Ad, 30D Trend, CPM Change, One Bad Apple, Budget Reallocation Plan）。
 請綜合這些數據進行分析。
 
 ---
@@ -73,6 +101,7 @@ AI_CONSULTANT_PROMPT = """
 
 ## 3.5 💰 CPM 變化與成本結構連動（核心洞察）
 - 結合 **CPM 變化表** 與 **P7D/30D 數據**，分析競價環境對 CPA 的影響。請依照以下情境邏輯進行推論：
+- CPM 變化表（行銷活動 / 廣告組合層級）已附「CPM×CPA 象限」欄位（P7D vs PP7D），可直接引用；CPM 變動通常先出現在廣告組合（受眾）層級。
 
   1. **CPM 上升 + CPA 也上升**：
      - 診斷：競價變貴且轉化未跟上，成本結構惡化。建議檢查是否受眾過窄或競爭加劇。
@@ -99,6 +128,7 @@ AI_CONSULTANT_PROMPT = """
 3.  **One Bad Apple (害群之馬) 理論**：
     - 當某個 AdSet CPA 過高時，檢查是否 **「只有一支爛廣告在拖累」**？
     - **診斷**：若是，**建議「關閉該廣告」而非「關閉整個 AdSet」**；若全體廣告都差，才建議關閉 AdSet。
+    - 若系統有提供 **One Bad Apple 表**（移除後組合 CPA、超額成本貢獻%），請直接引用其數字作為判斷依據。
 
 ---
 
@@ -107,6 +137,9 @@ AI_CONSULTANT_PROMPT = """
   1. **「可加碼潛力股」**：CPA 低於帳戶平均，且預算佔比尚低（通常是被埋沒的新素材或新受眾）。
   2. **「穩定基本盤」**：CPA 穩定、量體大的舊活動。
 - 建議：明確指出哪個 AdSet/廣告 值得加碼，以及加碼的方式（直接加預算 / 獨立出來開新活動）。
+- 若系統有提供 **Budget Reallocation Plan**（以 P30D 逐日數據擬合的邊際 CPA 曲線、總預算不變的最適分配），
+  加碼 / 減碼的對象與幅度請以該表為主要依據，引用「目前 → 建議日均花費」與「邊際 CPA」；
+  與表格不同的判斷（例如新組合數據不足、素材即將替換）請說明理由。
 
 ---
 
@@ -120,6 +153,7 @@ AI_CONSULTANT_PROMPT = """
 2.  **Priority B：導流與優化（資源重分配）**
     - 針對「資源錯置」與「系統偏食」的修正。
     - **指令格式**：`[暫停]` AdSet Y 中的舊素材 A，`[保留]` 新素材 B（依據：CPA B < A，強迫導流測試新素材）
+    - 預算調配：`[加預算]` / `[減預算]` AdSet Y 日預算 $A → $B（依據：Budget Reallocation Plan 邊際 CPA $X vs 帳戶其他組合）
 
 3.  **Priority C：保護基本盤（請勿更動）**
     - 點名那些「雖然舊但很穩」的黃金素材/受眾。
@@ -175,6 +209,12 @@ font_prop = get_chinese_font()
 def clean_ad_name(name):
     return re.sub(r' - 複本.*$', '', str(name)).strip()
 
+def map_unique(series, fn):
+    """對「不重複值」各呼叫一次 fn 再展開回原長度（名稱欄重複度高，比逐列 apply 快）"""
+    codes, uniques = pd.factorize(series, use_na_sentinel=False)
+    mapped = pd.Series([fn(u) for u in uniques], name=series.name)
+    return mapped.take(codes).set_axis(series.index)
+
 
 # --- 新素材/新組合判定（低 token：程式先聚合，AI 只判讀） ---
 DATE_RE = re.compile(r'(20\d{2})(0[1-9]|1[0-2])(0[1-9]|[12]\d|3[01])')  # YYYYMMDD
@@ -202,17 +242,19 @@ def build_new_creatives_summary(df_p7d, conv_col, anchor_date, recent_days=14, t
     if df_p7d is None or df_p7d.empty:
         return pd.DataFrame()
 
-    tmp = df_p7d.copy()
-    tmp['廣告名稱_clean'] = tmp['廣告名稱'].apply(clean_ad_name)
-    tmp['creative_date'] = tmp['廣告名稱'].apply(extract_yyyymmdd)
-    tmp['is_new_creative'] = tmp['creative_date'].apply(lambda d: is_recent_date(d, anchor_date, days=recent_days))
+    # 以 Series 當 groupby 鍵，不在（共用的）區間資料上複製或加欄位；名稱解析只做一次 / 不重複名稱
+    names = df_p7d['廣告名稱']
+    clean = df_p7d['廣告名稱_clean'] if '廣告名稱_clean' in df_p7d.columns else map_unique(names, clean_ad_name)
+    is_new = map_unique(
+        names, lambda n: is_recent_date(extract_yyyymmdd(n), anchor_date, days=recent_days)
+    ).astype(bool)
 
-    agg = tmp.groupby(['廣告名稱_clean', 'is_new_creative'], as_index=False).agg({
+    agg = df_p7d.groupby([clean.rename('廣告名稱_clean'), is_new.rename('is_new_creative')]).agg({
         '花費金額 (TWD)': 'sum',
         conv_col: 'sum',
         '連結點擊次數': 'sum',
         '曝光次數': 'sum'
-    })
+    }).reset_index()
 
     agg['CPA (TWD)'] = agg.apply(lambda x: x['花費金額 (TWD)'] / x[conv_col] if x[conv_col] > 0 else 0, axis=1)
     agg['CTR (%)'] = agg.apply(lambda x: (x['連結點擊次數'] / x['曝光次數']) * 100 if x['曝光次數'] > 0 else 0, axis=1)
@@ -223,7 +265,7 @@ def build_new_creatives_summary(df_p7d, conv_col, anchor_date, recent_days=14, t
     agg['花費占比(%)'] = agg['花費金額 (TWD)'].apply(lambda v: (v / total_spend * 100) if total_spend > 0 else 0)
     agg['轉換占比(%)'] = agg[conv_col].apply(lambda v: (v / total_conv * 100) if total_conv > 0 else 0)
 
-    agg = agg[agg['花費金額 (TWD)'] >= min_spend].copy()
+    agg = agg[agg['花費金額 (TWD)'] >= min_spend]
     agg = agg.sort_values(['is_new_creative', '花費金額 (TWD)'], ascending=[False, False]).head(top_n)
 
     return agg.round(2)
@@ -245,8 +287,14 @@ def build_new_adsets_summary(df_p7d, df_pp7d, conv_col, top_n=15, min_spend_p7=5
         tmp = tmp.rename(columns={conv_col: '轉換'})
         return tmp
 
-    p7 = agg_adset(df_p7d)
-    pp7 = agg_adset(df_pp7d)[['行銷活動名稱', '廣告組合名稱', '花費金額 (TWD)']].rename(columns={'花費金額 (TWD)': '花費金額_PP7D'})
+    return summarize_new_adsets(agg_adset(df_p7d), agg_adset(df_pp7d), top_n, min_spend_p7, old_spend_threshold)
+
+def summarize_new_adsets(p7, pp7, top_n=15, min_spend_p7=500, old_spend_threshold=200):
+    """
+    P7D / PP7D 廣告組合加總（轉換欄已改名為「轉換」）→ 新廣告組合判定表
+    pandas 與 DuckDB 後端共用
+    """
+    pp7 = pp7[['行銷活動名稱', '廣告組合名稱', '花費金額 (TWD)']].rename(columns={'花費金額 (TWD)': '花費金額_PP7D'})
 
     merged = p7.merge(pp7, on=['行銷活動名稱', '廣告組合名稱'], how='left')
     merged['花費金額_PP7D'] = merged['花費金額_PP7D'].fillna(0)
@@ -266,6 +314,198 @@ def build_new_adsets_summary(df_p7d, df_pp7d, conv_col, top_n=15, min_spend_p7=5
 
     return merged.round(2)
 # --- end ---
+# --- 樣本信心：CVR / CTR / CPA 可信區間（Jeffreys 先驗；所有實體一次向量化，5 萬列約數十毫秒） ---
+# - CVR / CTR：Beta(k + ½, n − k + ½) 後驗；CPA：轉換數 Poisson 率的 Gamma(k + ½) 後驗 → 花費 / 率
+# - 分位數不依賴 scipy：logit / log 尺度上以多伽瑪函數取得精確累積量，做 Cornish-Fisher 展開當起點
+#   （k = 0 改用 Gamma(½) = χ²₁ / 2 的封閉解）；Cornish-Fisher 在小樣本（k 只有個位數）偏差可達 10%，
+#   而警示抑制正是看這些列 → min(k, n − k) < CI_EXACT_MAX_COUNT 的列再以 Newton 法在精確 CDF
+#  （不完全 Beta / Gamma 冪級數）上修正到 CDF 誤差 < 1e-8；k ≥ 20 時 Cornish-Fisher 相對誤差已 < 2e-4
+# - 樣本信心：CPA 區間寬度 / CPA ≤ 0.5 為高、≤ 1.2 為中，其餘為低（約 45 / 10 次轉換為界）
+CI_LEVEL = float(os.environ.get('CI_LEVEL', '0.9'))
+CI_BOUND_COLS = ['CPA 下限 (TWD)', 'CPA 上限 (TWD)', 'CVR 下限 (%)', 'CVR 上限 (%)', 'CTR 下限 (%)', 'CTR 上限 (%)']
+SAMPLE_CONFIDENCE_LEVELS = [(0.5, '高'), (1.2, '中')]
+CI_EXACT_MAX_COUNT = 20
+CI_NEWTON_STEPS = 5
+CI_SERIES_MAX_TERMS = 400
+
+def _polygammas(x):
+    """ψ, ψ1, ψ2, ψ3（x > 0）：先以遞推式把 x 平移 6，再用漸近展開（全部元素同一條路徑，不做分支 / 索引）"""
+    x = np.array(x, dtype=np.float64)
+    shift = np.zeros((4, len(x)))
+    for _ in range(6):
+        inv = 1.0 / x
+        inv2 = inv * inv
+        shift[0] -= inv
+        shift[1] += inv2
+        shift[2] -= 2 * inv2 * inv
+        shift[3] += 6 * inv2 * inv2
+        x += 1
+    i = 1.0 / x
+    i2 = i * i
+    i3 = i2 * i
+    psi = np.log(x) - 0.5 * i - i2 * (1 / 12 - i2 * (1 / 120 - i2 / 252))
+    psi1 = i + 0.5 * i2 + i3 * (1 / 6 - i2 * (1 / 30 - i2 / 42))
+    psi2 = -i2 - i3 - i2 * i2 * (0.5 - i2 * (1 / 6 - i2 / 6))
+    psi3 = i3 * (2 + 3 * i + i2 * (2 - i2 * (1 - 4 / 3 * i2)))
+    return psi + shift[0], psi1 + shift[1], psi2 + shift[2], psi3 + shift[3]
+
+def _lgamma(x):
+    """log Γ(x)（x > 0）：與 _polygammas 相同，先以遞推式平移 6 再用 Stirling 展開"""
+    x = np.array(x, dtype=np.float64)
+    shift = np.zeros(len(x))
+    for _ in range(6):
+        shift -= np.log(x)
+        x += 1
+    i = 1.0 / x
+    i2 = i * i
+    return shift + (x - 0.5) * np.log(x) - x + 0.5 * np.log(2 * np.pi) + i * (1 / 12 - i2 * (1 / 360 - i2 / 1260))
+
+def _power_series(x, c, d):
+    """1 + Σ_m Π_{n<m} x (c + n) / (d + n)（c 為 None 時分子為 1）；已收斂的元素移出，不再參與後續項"""
+    out = np.ones(len(x))
+    total, term, idx = out.copy(), out.copy(), np.arange(len(x))
+    for n in range(CI_SERIES_MAX_TERMS):
+        term = term * x * ((c + n) if c is not None else 1.0) / (d + n)
+        total += term
+        if n % 4 == 3:
+            done = term <= 1e-12 * total
+            if done.any():
+                out[idx[done]] = total[done]
+                keep = ~done
+                idx, total, term, x, d = idx[keep], total[keep], term[keep], x[keep], d[keep]
+                c = c[keep] if c is not None else None
+                if not len(idx):
+                    break
+    out[idx] = total
+    return out
+
+def _beta_cdf_logit(y, a, b, log_norm):
+    """
+    x = sigmoid(y) → (I_x(a, b), log dI/dy)；log_norm = −log B(a, b)
+    x > ½ 時改算 1 − I_{1−x}(b, a)，級數只需約 √min(a, b) 項
+    """
+    flip = y > 0
+    xs = 1 / (1 + np.exp(np.abs(y)))
+    p, q = np.where(flip, b, a), np.where(flip, a, b)
+    log_dens = p * np.log(xs) + q * np.log1p(-xs) + log_norm
+    cdf = np.exp(log_dens) / p * _power_series(xs, p + q, p + 1)
+    return np.where(flip, 1 - cdf, cdf), log_dens
+
+def _gamma_cdf_log(y, a, log_norm):
+    """x = exp(y) → (P(a, x), log dP/dy)；log_norm = −log Γ(a)（正規化下不完全 Gamma 的冪級數）"""
+    x = np.exp(y)
+    log_dens = a * y - x + log_norm
+    return np.exp(log_dens) / a * _power_series(x, None, a + 1), log_dens
+
+def _newton_quantile(y, target, cdf):
+    """
+    在轉換尺度 y 上解 cdf(y, idx) = target（cdf 回傳 idx 那些元素的 (F, log dF/dy)）；
+    起點已很接近，多數元素兩步內收斂，之後只對尚未收斂的元素繼續迭代
+    """
+    y, idx = y.copy(), np.arange(len(y))
+    for _ in range(CI_NEWTON_STEPS):
+        f, log_dens = cdf(y[idx], idx)
+        active = np.abs(f - target) >= 1e-9
+        if not active.any():
+            break
+        idx, f, log_dens = idx[active], f[active], log_dens[active]
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            step = np.nan_to_num((f - target) * np.exp(-log_dens))
+        y[idx] -= np.clip(step, -1.0, 1.0)
+    return y
+
+def _cornish_fisher_bounds(k1, k2, k3, k4, level):
+    """以前四階累積量近似 (下界, 上界) 分位數"""
+    z = NormalDist().inv_cdf(0.5 + level / 2)
+    sd = np.sqrt(k2)
+    g1, g2 = k3 / sd ** 3, k4 / k2 ** 2
+    out = []
+    for zz in (-z, z):
+        w = zz + (zz * zz - 1) * g1 / 6 + (zz ** 3 - 3 * zz) * g2 / 24 - (2 * zz ** 3 - 5 * zz) * g1 ** 2 / 36
+        out.append(k1 + sd * w)
+    return out
+
+def _half_gamma_bounds(level):
+    """Gamma(½) = χ²₁ / 2 的 (下界, 上界) 分位數（k = 0 用）"""
+    nd = NormalDist()
+    return nd.inv_cdf(0.5 + (1 - level) / 4) ** 2 / 2, nd.inv_cdf(0.75 + level / 4) ** 2 / 2
+
+def beta_credible_interval(successes, trials, level=CI_LEVEL):
+    """比率 successes / trials 的可信區間（向量化）；trials = 0 → NaN；successes 超過 trials（瀏覽後轉換）視為全數成功"""
+    n = np.asarray(trials, dtype=np.float64)
+    k = np.minimum(np.asarray(successes, dtype=np.float64), n)
+    a, b = k + 0.5, np.maximum(n - k, 0) + 0.5
+    pa, pb = _polygammas(a), _polygammas(b)
+    lo, hi = _cornish_fisher_bounds(pa[0] - pb[0], pa[1] + pb[1], pa[2] - pb[2], pa[3] + pb[3], level)
+    lo, hi = 1 / (1 + np.exp(-lo)), 1 / (1 + np.exp(-hi))
+    # k = 0：Beta(½, b) ≈ G / (G + b)，G ~ Gamma(½)
+    g_lo, g_hi = _half_gamma_bounds(level)
+    zero = k == 0
+    lo = np.where(zero, g_lo / (g_lo + b), lo)
+    hi = np.where(zero, g_hi / (g_hi + b), hi)
+    small = np.flatnonzero((np.minimum(a, b) < CI_EXACT_MAX_COUNT) & (n > 0))
+    if len(small):
+        sa, sb = a[small], b[small]
+        log_norm = _lgamma(sa + sb) - _lgamma(sa) - _lgamma(sb)
+        logit = lambda x: np.log(x) - np.log1p(-x)
+        for bound, target in ((lo, (1 - level) / 2), (hi, (1 + level) / 2)):
+            y0 = logit(np.clip(bound[small], 1e-300, 1 - 1e-16))
+            y = _newton_quantile(y0, target, lambda y, i: _beta_cdf_logit(y, sa[i], sb[i], log_norm[i]))
+            bound[small] = 1 / (1 + np.exp(-y))
+    empty = n <= 0
+    return np.where(empty, np.nan, lo), np.where(empty, np.nan, hi)
+
+def poisson_rate_interval(counts, level=CI_LEVEL):
+    """計數（轉換數）的 Poisson 率可信區間（向量化）"""
+    k = np.asarray(counts, dtype=np.float64)
+    a = np.maximum(k, 0) + 0.5
+    lo, hi = _cornish_fisher_bounds(*_polygammas(a), level)
+    g_lo, g_hi = _half_gamma_bounds(level)
+    zero = k <= 0
+    lo, hi = np.where(zero, g_lo, np.exp(lo)), np.where(zero, g_hi, np.exp(hi))
+    small = np.flatnonzero(a < CI_EXACT_MAX_COUNT)
+    if len(small):
+        sa = a[small]
+        log_norm = -_lgamma(sa)
+        for bound, target in ((lo, (1 - level) / 2), (hi, (1 + level) / 2)):
+            y = _newton_quantile(np.log(bound[small]), target, lambda y, i: _gamma_cdf_log(y, sa[i], log_norm[i]))
+            bound[small] = np.exp(y)
+    return lo, hi
+
+def cpa_credible_interval(spend, conversions, level=CI_LEVEL, rate_bounds=None):
+    """CPA = 花費 / 轉換率 的可信區間；0 轉換時上限為 NaN（沒有上限），下限仍可判斷「CPA 至少多少」"""
+    spend = np.asarray(spend, dtype=np.float64)
+    rate_lo, rate_hi = rate_bounds if rate_bounds is not None else poisson_rate_interval(conversions, level)
+    with np.errstate(divide='ignore'):
+        upper = np.where(np.asarray(conversions) > 0, spend / rate_lo, np.nan)
+    return spend / rate_hi, upper
+
+def sample_confidence_label(conversions, rate_bounds):
+    """CPA 區間相對寬度（只取決於轉換數）→ 高 / 中 / 低；rate_bounds 為 poisson_rate_interval 的結果"""
+    conv = np.asarray(conversions, dtype=np.float64)
+    rate_lo, rate_hi = rate_bounds
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel_width = np.where(conv > 0, (1 / rate_lo - 1 / rate_hi) * conv, np.inf)
+    labels = np.full(len(conv), '低', dtype=object)
+    for threshold, label in reversed(SAMPLE_CONFIDENCE_LEVELS):
+        labels[rel_width <= threshold] = label
+    return labels
+
+def add_confidence_columns(df_metrics, conv_col, level=CI_LEVEL):
+    """已加總的表（含全帳戶平均列）→ 附上 CPA / CVR / CTR 區間與樣本信心欄（就地新增欄位）"""
+    spend = df_metrics['花費金額 (TWD)'].to_numpy(dtype=np.float64)
+    conv = df_metrics[conv_col].to_numpy(dtype=np.float64)
+    clicks = df_metrics['連結點擊次數'].to_numpy(dtype=np.float64)
+    impr = df_metrics['曝光次數'].to_numpy(dtype=np.float64)
+    rate_bounds = poisson_rate_interval(conv, level)
+    cpa_lo, cpa_hi = cpa_credible_interval(spend, conv, level, rate_bounds)
+    cvr_lo, cvr_hi = beta_credible_interval(conv, clicks, level)
+    ctr_lo, ctr_hi = beta_credible_interval(clicks, impr, level)
+    for col, values in zip(CI_BOUND_COLS, (cpa_lo, cpa_hi, cvr_lo * 100, cvr_hi * 100, ctr_lo * 100, ctr_hi * 100)):
+        df_metrics[col] = np.round(values, 2)
+    df_metrics['樣本信心'] = sample_confidence_label(conv, rate_bounds)
+    return df_metrics
+
 def create_summary_row(df, metric_cols):
     """
     metric_cols: dict
@@ -306,7 +546,13 @@ def calculate_consolidated_metrics(df_group, conv_col):
         '連結點擊次數': 'sum',
         '曝光次數': 'sum'
     }).reset_index()
+    return finalize_consolidated_metrics(df_metrics, conv_col)
 
+def finalize_consolidated_metrics(df_metrics, conv_col):
+    """
+    已加總的 花費 / 轉換 / 點擊 / 曝光（每個層級鍵一列）→ 衍生指標、依花費排序、附全帳戶平均列
+    pandas 與 DuckDB 後端共用，確保兩邊輸出的表完全同格式
+    """
     df_metrics = df_metrics[df_metrics['花費金額 (TWD)'] > 0]
 
     # CPA / CTR / CVR / CPM
@@ -339,12 +585,14 @@ def calculate_consolidated_metrics(df_group, conv_col):
     summary_row = create_summary_row(df_metrics, metric_config)
     
     if not df_metrics.empty:
-        return pd.concat([df_metrics, summary_row], ignore_index=True)
+        return add_confidence_columns(pd.concat([df_metrics, summary_row], ignore_index=True), conv_col)
     else:
-        return df_metrics
+        return add_confidence_columns(df_metrics, conv_col)
 
 def collect_period_results(df, period_name_short, conv_col):
-    df['廣告名稱_clean'] = df['廣告名稱'].apply(clean_ad_name)
+    # 分析管線已在排序後的全量資料上算好 廣告名稱_clean；傳入的區間切片不可就地加欄位
+    if '廣告名稱_clean' not in df.columns:
+        df = df.assign(廣告名稱_clean=map_unique(df['廣告名稱'], clean_ad_name))
     results = []
     
     # 0. 詳細層級：活動 + 組合 + 廣告
@@ -373,6 +621,13 @@ def collect_period_results(df, period_name_short, conv_col):
 # ==========================================
 # 3. 異常偵測與趨勢分析邏輯
 # ==========================================
+# 樣本信心抑制：點估計觸發門檻後，還要「可信區間整段」都越過比較基準才發出警示
+# （CPA 下限仍高於基準 / CTR 上限仍低於基準），少量轉換 / 點擊造成的雜訊不再洗版；被抑制的筆數記在 attrs['suppressed']
+def _with_suppressed(rows, suppressed):
+    out = pd.DataFrame(rows)
+    out.attrs['suppressed'] = suppressed
+    return out
+
 def check_daily_anomalies(df_p1, df_p7, level_name='行銷活動名稱'):
     p1 = df_p1[df_p1[level_name] != '全帳戶平均'].copy()
     p7 = df_p7[df_p7[level_name] != '全帳戶平均'].copy()
@@ -382,6 +637,7 @@ def check_daily_anomalies(df_p1, df_p7, level_name='行銷活動名稱'):
 
     merged = pd.merge(p1, p7, on=level_name, suffixes=('_P1', '_P7'), how='inner')
     alerts = []
+    suppressed = 0
     
     for _, row in merged.iterrows():
         if row['花費金額 (TWD)_P1'] < 200: 
@@ -391,18 +647,25 @@ def check_daily_anomalies(df_p1, df_p7, level_name='行銷活動名稱'):
         cpa_p1, cpa_p7 = row['CPA (TWD)_P1'], row['CPA (TWD)_P7']
         ctr_p1, ctr_p7 = row['CTR (%)_P1'], row['CTR (%)_P7']
         spend_p1 = row['花費金額 (TWD)_P1']
+        # 沒有區間欄（舊版結果）時退回點估計
+        cpa_lo = row.get('CPA 下限 (TWD)_P1', cpa_p1)
+        ctr_hi = row.get('CTR 上限 (%)_P1', ctr_p1)
 
-        if cpa_p7 > 0 and cpa_p1 > cpa_p7 * 1.3:
+        if cpa_p7 > 0 and cpa_p1 > cpa_p7 * 1.3 and not cpa_lo > cpa_p7:
+            suppressed += 1
+        elif cpa_p7 > 0 and cpa_p1 > cpa_p7 * 1.3:
             diff = int(((cpa_p1 - cpa_p7) / cpa_p7) * 100)
             alerts.append({
                 '層級': level_name,
                 '名稱': name,
                 '類型': '🔴 CPA 暴漲', 
-                '數據對比': f"昨${cpa_p1:.0f} vs 均${cpa_p7:.0f} (🔺{diff}%)",
+                '數據對比': f"昨${cpa_p1:.0f}（至少${cpa_lo:.0f}）vs 均${cpa_p7:.0f} (🔺{diff}%)",
                 '建議': '檢查競價或受眾'
             })
             
-        if ctr_p7 > 0 and ctr_p1 < ctr_p7 * 0.8:
+        if ctr_p7 > 0 and ctr_p1 < ctr_p7 * 0.8 and not ctr_hi < ctr_p7:
+            suppressed += 1
+        elif ctr_p7 > 0 and ctr_p1 < ctr_p7 * 0.8:
             diff = int(((ctr_p7 - ctr_p1) / ctr_p7) * 100)
             alerts.append({
                 '層級': level_name,
@@ -412,7 +675,10 @@ def check_daily_anomalies(df_p1, df_p7, level_name='行銷活動名稱'):
                 '建議': '素材疲乏/更換素材'
             })
             
-        if cpa_p1 == 0 and spend_p1 > 500:
+        # 0 轉換：P7D 有 CPA 時，CPA 下限（花費 / 轉換率上限）要超過 P7D CPA 才算異常
+        if cpa_p1 == 0 and spend_p1 > 500 and cpa_p7 > 0 and not cpa_lo > cpa_p7:
+            suppressed += 1
+        elif cpa_p1 == 0 and spend_p1 > 500:
              alerts.append({
                  '層級': level_name,
                  '名稱': name,
@@ -421,7 +687,7 @@ def check_daily_anomalies(df_p1, df_p7, level_name='行銷活動名稱'):
                  '建議': '檢查落地頁/設定'
              })
 
-    return pd.DataFrame(alerts)
+    return _with_suppressed(alerts, suppressed)
 
 def check_weekly_trends(df_p7, df_pp7, level_name='行銷活動名稱'):
     curr = df_p7[df_p7[level_name] != '全帳戶平均'].copy()
@@ -432,6 +698,7 @@ def check_weekly_trends(df_p7, df_pp7, level_name='行銷活動名稱'):
     
     merged = pd.merge(curr, prev, on=level_name, suffixes=('_This', '_Last'), how='inner')
     trends = []
+    suppressed = 0
     
     for _, row in merged.iterrows():
         if row['花費金額 (TWD)_This'] < 1000: 
@@ -441,8 +708,12 @@ def check_weekly_trends(df_p7, df_pp7, level_name='行銷活動名稱'):
         cpa_this, cpa_last = row['CPA (TWD)_This'], row['CPA (TWD)_Last']
         ctr_this, ctr_last = row['CTR (%)_This'], row['CTR (%)_Last']
         spend_this, spend_last = row['花費金額 (TWD)_This'], row['花費金額 (TWD)_Last']
+        cpa_lo = row.get('CPA 下限 (TWD)_This', cpa_this)
+        ctr_hi = row.get('CTR 上限 (%)_This', ctr_this)
         
-        if cpa_last > 0 and cpa_this > cpa_last * 1.2:
+        if cpa_last > 0 and cpa_this > cpa_last * 1.2 and not cpa_lo > cpa_last:
+            suppressed += 1
+        elif cpa_last > 0 and cpa_this > cpa_last * 1.2:
             diff = int(((cpa_this - cpa_last) / cpa_last) * 100)
             trends.append({
                 '層級': level_name,
@@ -453,7 +724,9 @@ def check_weekly_trends(df_p7, df_pp7, level_name='行銷活動名稱'):
                 '診斷': '競爭加劇或轉換率下降'
             })
             
-        if ctr_last > 0 and ctr_this < ctr_last * 0.85:
+        if ctr_last > 0 and ctr_this < ctr_last * 0.85 and not ctr_hi < ctr_last:
+            suppressed += 1
+        elif ctr_last > 0 and ctr_this < ctr_last * 0.85:
             diff = int(((ctr_last - ctr_this) / ctr_this) * 100) if ctr_this > 0 else 100
             trends.append({
                 '層級': level_name,
@@ -465,7 +738,9 @@ def check_weekly_trends(df_p7, df_pp7, level_name='行銷活動名稱'):
             })
 
         if spend_last > 0 and spend_this > spend_last * 1.2:
-            if cpa_last > 0 and cpa_this > cpa_last * 1.1:
+            if cpa_last > 0 and cpa_this > cpa_last * 1.1 and not cpa_lo > cpa_last:
+                suppressed += 1
+            elif cpa_last > 0 and cpa_this > cpa_last * 1.1:
                 trends.append({
                     '層級': level_name,
                     '名稱': name,
@@ -475,18 +750,197 @@ def check_weekly_trends(df_p7, df_pp7, level_name='行銷活動名稱'):
                     '診斷': '邊際效應遞減，建議暫停加碼'
                 })
 
-    return pd.DataFrame(trends)
+    return _with_suppressed(trends, suppressed)
+
+# --- 盤中警示（逐小時匯出）：今日已過時段 vs 過去 7 日同時段，全部活動 / 組合一次向量化計算 ---
+INTRADAY_LEVELS = {
+    '行銷活動名稱': ['行銷活動名稱'],
+    '廣告組合名稱': ['行銷活動名稱', '廣告組合名稱'],
+}
+
+def check_intraday_anomalies(df_hourly, conv_col, trailing_days=7, min_spend=200):
+    """
+    df_hourly：天數 / 小時 / 層級欄 / 花費 / 轉換 / 點擊 / 曝光（最近 trailing_days + 1 天）
+    今日 = 最後一天、只看 0 ~ 目前最後一個小時；基準 = 前 trailing_days 天同時段的日平均（沒資料的日子視為 0）
+    """
+    if df_hourly is None or df_hourly.empty:
+        return pd.DataFrame()
+    days = df_hourly['天數'].to_numpy(dtype='datetime64[D]')
+    today = days.max()
+    day_idx = (days - today).astype(np.int64) + trailing_days   # 0 ~ trailing_days（今日）
+    hours = df_hourly['小時'].to_numpy()
+    last_hour = int(hours[day_idx == trailing_days].max())
+    in_window = (day_idx >= 0) & (hours <= last_hour)
+    n_days = trailing_days + 1
+    metric_cols = ['花費金額 (TWD)', conv_col, '連結點擊次數', '曝光次數']
+    values = df_hourly[metric_cols].to_numpy(dtype=np.float64)[in_window]
+    day_idx = day_idx[in_window]
+
+    alerts = []
+    suppressed = 0
+    for level_name, keys in INTRADAY_LEVELS.items():
+        entity, uniques = pd.MultiIndex.from_frame(df_hourly.loc[in_window, keys]).factorize()
+        valid = entity >= 0
+        n_entities = len(uniques)
+        cell = entity[valid] * n_days + day_idx[valid]
+        # (實體, 天, 指標)：每個實體每天 0 ~ last_hour 的加總
+        grid = np.stack([
+            np.bincount(cell, weights=values[valid, j], minlength=n_entities * n_days).reshape(n_entities, n_days)
+            for j in range(len(metric_cols))
+        ], axis=2)
+        now, base = grid[:, -1, :], grid[:, :-1, :].mean(axis=1)
+        spend, conv, clicks, impr = now.T
+        b_spend, b_conv, b_clicks, b_impr = base.T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cpa = np.where(conv > 0, spend / conv, 0)
+            b_cpa = np.where(b_conv > 0, b_spend / b_conv, 0)
+            ctr = np.where(impr > 0, clicks / impr * 100, 0)
+            b_ctr = np.where(b_impr > 0, b_clicks / b_impr * 100, 0)
+            cpa_lo = spend / poisson_rate_interval(conv)[1]
+        ctr_hi = beta_credible_interval(clicks, impr)[1] * 100
+        # 規則 → 區間確認條件：觸發門檻但區間仍涵蓋基準 → 抑制
+        confident = {
+            '🔴 CPA 暴漲': cpa_lo > b_cpa,
+            '📉 CTR 驟降': ctr_hi < b_ctr,
+            '🛑 高花費0轉換': cpa_lo > b_cpa,
+        }
+
+        rules = [
+            ((spend >= min_spend) & (b_cpa > 0) & (cpa > b_cpa * 1.3), '🔴 CPA 暴漲',
+             lambda i: f"今${cpa[i]:.0f} vs 同時段均${b_cpa[i]:.0f} (🔺{int((cpa[i] - b_cpa[i]) / b_cpa[i] * 100)}%)",
+             '檢查競價或受眾'),
+            ((spend >= min_spend) & (b_ctr > 0) & (ctr < b_ctr * 0.8), '📉 CTR 驟降',
+             lambda i: f"今{ctr[i]:.2f}% vs 同時段均{b_ctr[i]:.2f}% (🔻{int((b_ctr[i] - ctr[i]) / b_ctr[i] * 100)}%)",
+             '素材疲乏/更換素材'),
+            ((spend > 500) & (conv == 0) & (b_conv >= 1), '🛑 高花費0轉換',
+             lambda i: f"今花費 ${spend[i]:.0f}，同時段均轉換 {b_conv[i]:.1f}",
+             '檢查落地頁/設定'),
+            ((spend >= min_spend) & (b_spend > 0) & (spend > b_spend * 1.5), '⏫ 花費暴衝',
+             lambda i: f"今${spend[i]:,.0f} vs 同時段均${b_spend[i]:,.0f}",
+             '確認預算 / 出價設定'),
+            ((b_spend >= min_spend) & (spend < b_spend * 0.5), '⏸️ 投放停滯',
+             lambda i: f"今${spend[i]:,.0f} vs 同時段均${b_spend[i]:,.0f}",
+             '檢查審核狀態 / 預算上限'),
+        ]
+        for mask, label, describe, advice in rules:
+            if label in confident:
+                suppressed += int((mask & ~confident[label]).sum())
+                mask = mask & confident[label]
+            for i in np.flatnonzero(mask):
+                alerts.append({
+                    '層級': level_name,
+                    '名稱': ' / '.join(str(k) for k in uniques[i]),
+                    '類型': label,
+                    '數據對比': describe(i),
+                    '建議': advice,
+                    '今日花費': round(float(spend[i]), 2),
+                })
+
+    if not alerts:
+        return _with_suppressed([], suppressed)
+    out = pd.DataFrame(alerts).sort_values('今日花費', ascending=False, kind='stable', ignore_index=True)
+    out.attrs['suppressed'] = suppressed
+    return out
+
+def build_one_bad_apple_table(df_p7d, conv_col, min_adset_spend=1000, cpa_excess_ratio=1.2, top_n=20):
+    """
+    害群之馬（Leave-One-Out）分析：P7D 廣告組合 → 廣告
+    - 每支廣告：組合總和 - 自身總和 = 「移除該廣告後」的組合 CPA / CVR（全向量化，無逐列迴圈）
+    - 超額成本 = 花費 - 帳戶 P7D CPA × 轉換；廣告貢獻(%) = 廣告超額成本 / 組合超額成本
+    - 貢獻分數可加總回組合，故可直接看出是「一支爛廣告」還是「全體都差」
+    - 移除後組合剩 0 轉換時 CPA 無定義 → NaN（畫面顯示 -），排序時排在有定義的列之後
+    """
+    if df_p7d is None or df_p7d.empty:
+        return pd.DataFrame()
+
+    keys = ['行銷活動名稱', '廣告組合名稱']
+    ads = df_p7d.groupby(keys + ['廣告名稱'], sort=False, observed=True).agg({
+        '花費金額 (TWD)': 'sum',
+        conv_col: 'sum',
+        '連結點擊次數': 'sum'
+    }).reset_index()
+    if ads.empty:
+        return pd.DataFrame()
+
+    acc_spend = ads['花費金額 (TWD)'].sum()
+    acc_conv = ads[conv_col].sum()
+    if acc_conv <= 0:
+        return pd.DataFrame()
+    acc_cpa = acc_spend / acc_conv
+
+    grp = ads.groupby(keys, sort=False, observed=True)
+    set_spend = grp['花費金額 (TWD)'].transform('sum').to_numpy(dtype=float)
+    set_conv = grp[conv_col].transform('sum').to_numpy(dtype=float)
+    set_clicks = grp['連結點擊次數'].transform('sum').to_numpy(dtype=float)
+    set_n_ads = grp['廣告名稱'].transform('size').to_numpy()
+
+    ad_spend = ads['花費金額 (TWD)'].to_numpy(dtype=float)
+    ad_conv = ads[conv_col].to_numpy(dtype=float)
+    ad_clicks = ads['連結點擊次數'].to_numpy(dtype=float)
+
+    loo_spend = set_spend - ad_spend
+    loo_conv = set_conv - ad_conv
+    loo_clicks = set_clicks - ad_clicks
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # 0 轉換的 CPA 無定義（NaN，顯示為 '-'），不能記成 0，否則看起來是最便宜的廣告 / 組合
+        set_cpa = np.where(set_conv > 0, set_spend / set_conv, np.nan)
+        ad_cpa = np.where(ad_conv > 0, ad_spend / ad_conv, np.nan)
+        loo_cpa = np.where(loo_conv > 0, loo_spend / loo_conv, np.nan)
+        set_cvr = np.where(set_clicks > 0, set_conv / set_clicks * 100, 0)
+        loo_cvr = np.where(loo_clicks > 0, loo_conv / loo_clicks * 100, 0)
+
+        set_excess = set_spend - acc_cpa * set_conv
+        ad_excess = ad_spend - acc_cpa * ad_conv
+        contribution = np.where(set_excess > 0, ad_excess / set_excess * 100, 0)
+
+    # 組合 CPA 超標（或 0 轉換）且 花費夠大，才進入判定
+    set_over = (set_spend >= min_adset_spend) & ((set_conv == 0) | (set_cpa > acc_cpa * cpa_excess_ratio))
+    # 移除後回到帳戶水位 → 單一害群之馬；否則全體偏差
+    loo_ok = (loo_conv > 0) & (loo_cpa <= acc_cpa * cpa_excess_ratio)
+    is_bad_apple = set_over & (set_n_ads > 1) & loo_ok & (contribution >= 50)
+    codes = grp.ngroup().to_numpy()
+    set_has_apple = np.bincount(codes, weights=is_bad_apple)[codes] > 0
+
+    out = ads[keys + ['廣告名稱']].copy()
+    out['花費金額 (TWD)'] = ad_spend
+    out[conv_col] = ad_conv
+    out['廣告 CPA (TWD)'] = ad_cpa
+    out['組合 CPA (TWD)'] = set_cpa
+    out['移除後組合 CPA (TWD)'] = loo_cpa
+    out['組合 CVR (%)'] = set_cvr
+    out['移除後組合 CVR (%)'] = loo_cvr
+    out['超額成本貢獻(%)'] = contribution
+    out['判定'] = np.select(
+        [is_bad_apple, set_over & ~set_has_apple],
+        ['🍎 害群之馬（關閉該廣告）', '⚠️ 全體偏差（檢討組合）'],
+        default=''
+    )
+
+    out = out[set_over & (ad_excess > 0)]
+    if out.empty:
+        return pd.DataFrame()
+    out = (
+        out.assign(_ranked=out['移除後組合 CPA (TWD)'].notna())
+        .sort_values(['_ranked', '超額成本貢獻(%)', '花費金額 (TWD)'], ascending=[False, False, False])
+        .drop(columns='_ranked')
+        .head(top_n)
+    )
+    return out.round(2).reset_index(drop=True)
 
 def get_trend_data_excel(df_p30d, conv_col):
-    trend_df = df_p30d.copy()
-    acc_daily = trend_df.groupby(['天數']).agg({
+    acc_daily = df_p30d.groupby(['天數']).agg({
         '花費金額 (TWD)': 'sum',
         conv_col: 'sum',
         '連結點擊次數': 'sum',
         '曝光次數': 'sum'
     }).reset_index()
+    return finalize_trend_data(acc_daily, conv_col)
+
+def finalize_trend_data(acc_daily, conv_col):
+    """每日加總 → 30 日帳戶趨勢表（pandas 與 DuckDB 後端共用）"""
     acc_daily['行銷活動名稱'] = '🏆 整體帳戶 (Account Overall)'
-    final_trend = acc_daily[acc_daily['花費金額 (TWD)'] > 0]
+    final_trend = acc_daily[acc_daily['花費金額 (TWD)'] > 0].copy()
     final_trend['CPA (TWD)'] = final_trend.apply(
         lambda x: x['花費金額 (TWD)'] / x[conv_col] if x[conv_col] > 0 else 0,
         axis=1
@@ -498,55 +952,83 @@ def get_trend_data_excel(df_p30d, conv_col):
     final_trend['天數'] = final_trend['天數'].dt.strftime('%Y-%m-%d')
     return final_trend.round(2)
 
-def build_cpm_change_table(p7_camp_df, pp7_camp_df, p30_camp_df):
+# CPM 變化表可用的層級（對應 collect_period_results 的輸出順序與 groupby 鍵）
+CPM_LEVELS = {
+    '行銷活動 (Campaign)': (3, ('行銷活動名稱',)),
+    '廣告組合 (AdSet)': (2, ('行銷活動名稱', '廣告組合名稱')),
+    '廣告 (Ad)': (1, ('廣告名稱_clean',)),
+}
+
+# 與基準期比較時的欄位名稱（沿用舊版欄名，其他區間以 vs_{suffix} 命名）
+CPM_COMPARE_LABELS = {
+    'PP7D': '週環比變化',
+    'P30D': '月度對比',
+}
+
+def build_cpm_change_table(period_tables, level_keys=('行銷活動名稱',), flat_tol=5.0):
     """
-    建立行銷活動層級的 CPM 變化表：P7D / PP7D / P30D
+    建立任一層級的 CPM 變化表（可多區間）：
+    - period_tables: ((suffix, 該區間的匯總表), ...)，第一個為基準期（通常 P7D），其餘為比較期
+    - level_keys: 層級鍵，例如 ('行銷活動名稱',) 或 ('行銷活動名稱', '廣告組合名稱')
+    - 一次 concat 對齊所有區間，變化率以向量運算計算
+    - 同步依 Prompt 3.5 產生「CPM × CPA 象限」（基準期 vs 第一個比較期，±flat_tol% 視為持平）
     """
-    def prep(df, suffix):
-        if df is None or df.empty:
-            return pd.DataFrame(columns=['行銷活動名稱', f'CPM_{suffix}', f'花費金額_{suffix}', f'曝光次數_{suffix}'])
-        tmp = df.copy()
-        cols_keep = ['行銷活動名稱', 'CPM (TWD)', '花費金額 (TWD)', '曝光次數']
-        cols_exist = [c for c in cols_keep if c in tmp.columns]
-        tmp = tmp[cols_exist]
-        tmp = tmp[tmp['行銷活動名稱'].notna()]
-        tmp = tmp.rename(columns={
-            'CPM (TWD)': f'CPM_{suffix}',
-            '花費金額 (TWD)': f'花費金額_{suffix}',
-            '曝光次數': f'曝光次數_{suffix}'
-        })
-        return tmp
+    keys = list(level_keys)
+    frames = []
+    for suffix, df in period_tables:
+        if df is None or df.empty or not set(keys).issubset(df.columns):
+            continue
+        cols = {'CPM (TWD)': f'CPM_{suffix}', 'CPA (TWD)': f'CPA_{suffix}',
+                '花費金額 (TWD)': f'花費金額_{suffix}', '曝光次數': f'曝光次數_{suffix}'}
+        cols = {k: v for k, v in cols.items() if k in df.columns}
+        tmp = df.loc[df[keys[0]].notna(), keys + list(cols)].rename(columns=cols)
+        frames.append(tmp.set_index(keys))
 
-    p7 = prep(p7_camp_df, 'P7D')
-    pp7 = prep(pp7_camp_df, 'PP7D')
-    p30 = prep(p30_camp_df, 'P30D')
+    if not frames:
+        return pd.DataFrame()
 
-    merged = p7.merge(pp7, on='行銷活動名稱', how='outer').merge(p30, on='行銷活動名稱', how='outer')
-    if merged.empty:
-        return merged
+    merged = pd.concat(frames, axis=1, join='outer').fillna(0).reset_index()
 
-    for c in ['CPM_P7D', 'CPM_PP7D', 'CPM_P30D',
-              '花費金額_P7D', '花費金額_PP7D', '花費金額_P30D',
-              '曝光次數_P7D', '曝光次數_PP7D', '曝光次數_P30D']:
-        if c in merged.columns:
-            merged[c] = merged[c].fillna(0)
+    suffixes = [sfx for sfx, _ in period_tables]
+    base = suffixes[0]
+    base_cpm = merged.get(f'CPM_{base}')
+    if base_cpm is None:
+        return merged
 
     def pct_change(new, old):
-        if old == 0:
-            return None
-        return round((new - old) / old * 100, 2)
+        new = new.to_numpy(dtype=float)
+        old = old.to_numpy(dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.round(np.where(old != 0, (new - old) / old * 100, np.nan), 2)
 
-    merged['CPM_週環比變化_vs_PP7D_(%)'] = merged.apply(
-        lambda x: pct_change(x['CPM_P7D'], x['CPM_PP7D']), axis=1
-    )
-    merged['CPM_月度對比_vs_P30D_(%)'] = merged.apply(
-        lambda x: pct_change(x['CPM_P7D'], x['CPM_P30D']), axis=1
-    )
+    for sfx in suffixes[1:]:
+        if f'CPM_{sfx}' not in merged.columns:
+            continue
+        label = CPM_COMPARE_LABELS.get(sfx, '變化')
+        merged[f'CPM_{label}_vs_{sfx}_(%)'] = pct_change(base_cpm, merged[f'CPM_{sfx}'])
+
+    # CPM × CPA 象限（Prompt 3.5 四種情境）
+    if len(suffixes) > 1 and f'CPA_{base}' in merged.columns and f'CPA_{suffixes[1]}' in merged.columns:
+        ref = suffixes[1]
+        cpm_chg = pct_change(base_cpm, merged[f'CPM_{ref}'])
+        cpa_chg = pct_change(merged[f'CPA_{base}'], merged[f'CPA_{ref}'])
+        merged[f'CPA_變化_vs_{ref}_(%)'] = cpa_chg
+        cpm_up, cpm_down = cpm_chg > flat_tol, cpm_chg < -flat_tol
+        cpa_up, cpa_down = cpa_chg > flat_tol, cpa_chg < -flat_tol
+        merged['CPM×CPA 象限'] = np.select(
+            [cpm_up & cpa_up, cpm_up & ~cpa_up, cpm_down & ~cpa_down, cpm_down & cpa_down],
+            ['① CPM↑ CPA↑ 成本結構惡化', '② CPM↑ CPA持平/↓ 高品質流量',
+             '③ CPM↓ CPA沒改善 劣質流量陷阱', '④ CPM↓ CPA↓ 市場紅利可擴量'],
+            default=''
+        )
+        # 任一期缺 CPA（0 轉換）時無法判斷象限
+        no_cpa = (merged[f'CPA_{base}'] == 0) | (merged[f'CPA_{ref}'] == 0)
+        merged.loc[no_cpa, 'CPM×CPA 象限'] = ''
 
-    if '花費金額_P7D' in merged.columns:
-        merged = merged.sort_values('花費金額_P7D', ascending=False)
+    if f'花費金額_{base}' in merged.columns:
+        merged = merged.sort_values(f'花費金額_{base}', ascending=False)
 
-    return merged
+    return merged.reset_index(drop=True)
 
 # ==========================================
 # 4. Excel 匯出函數（含 AI 回覆）
@@ -619,6 +1101,8 @@ def to_excel_single_sheet_stacked(dfs_list, prompt_text, ai_response=None):
 # 5. AI 分析串接：輔助函式（多層級餵入）
 # ==========================================
 def safe_to_markdown(df):
+    # 區間上下限只留在表格 / Excel；送給 AI 的只保留「樣本信心」一欄，省 token
+    df = df.drop(columns=[c for c in CI_BOUND_COLS if c in df.columns])
     try:
         return df.to_markdown(index=False)
     except ImportError:
@@ -630,17 +1114,17 @@ def get_top_by_spend(df, n=20, min_spend=0):
     if df is None or df.empty:
         return df
 
-    tmp = df.copy()
-
+    # 共用唯讀表：先組合成單一遮罩再切一次，不先整份複製
+    keep = np.ones(len(df), dtype=bool)
     for col in ['行銷活動名稱', '廣告名稱_clean']:
-        if col in tmp.columns:
-            tmp = tmp[tmp[col] != '全帳戶平均']
+        if col in df.columns:
+            keep &= (df[col] != '全帳戶平均').to_numpy()
 
-    if '花費金額 (TWD)' in tmp.columns:
-        tmp = tmp[tmp['花費金額 (TWD)'] >= min_spend]
-        tmp = tmp.sort_values('花費金額 (TWD)', ascending=False).head(n)
+    if '花費金額 (TWD)' in df.columns:
+        keep &= (df['花費金額 (TWD)'] >= min_spend).to_numpy()
+        return df[keep].sort_values('花費金額 (TWD)', ascending=False).head(n)
 
-    return tmp
+    return df[keep]
 
 
 def calc_period_overall(df_period, conv_col):
@@ -665,8 +1149,353 @@ def calc_period_overall(df_period, conv_col):
         'cpc': round(cpc, 2),
     }
 
-def call_gemini_analysis(
-    api_key,
+# REST 端點可用環境變數改指向本地 mock（mock_gemini_server.py）；改指向時一律走 REST
+GEMINI_DEFAULT_API_BASE = "https://generativelanguage.googleapis.com"
+GEMINI_API_BASE = os.environ.get('GEMINI_API_BASE', GEMINI_DEFAULT_API_BASE).rstrip('/')
+
+def use_genai_sdk():
+    return HAS_GENAI and GEMINI_API_BASE == GEMINI_DEFAULT_API_BASE
+
+def gemini_rest_url(model, api_key, method='generateContent'):
+    return f"{GEMINI_API_BASE}/v1beta/models/{model}:{method}?key={api_key}"
+
+# --- LLM 用量紀錄：每次呼叫寫一行 JSON（append-only），供成本 / 延遲統計 ---
+LLM_USAGE_LOG = os.environ.get('LLM_USAGE_LOG', os.path.join('.ads_cache', 'llm_usage.jsonl'))
+
+# 每 1M tokens 美元價格（input / cached input / output）；價格異動時請更新
+GEMINI_PRICING_USD_PER_1M = {
+    'gemini-2.5-pro': {'input': 1.25, 'cached': 0.31, 'output': 10.0},
+    'gemini-2.5-flash': {'input': 0.30, 'cached': 0.075, 'output': 2.50},
+}
+
+# 呼叫端（背景工作）標記的帳戶 / 功能，跨執行緒以 contextvars 傳遞
+_llm_usage_ctx = contextvars.ContextVar('llm_usage_ctx', default={})
+
+@st.cache_resource
+def _llm_usage_lock():
+    return threading.Lock()
+
+def estimate_llm_cost(model_name, prompt_tokens, cached_tokens, response_tokens):
+    price = GEMINI_PRICING_USD_PER_1M.get(model_name)
+    if not price:
+        return 0.0
+    fresh = max(0, prompt_tokens - cached_tokens)
+    return (fresh * price['input'] + cached_tokens * price['cached'] + response_tokens * price['output']) / 1e6
+
+def record_llm_usage(row, usage, ttft, latency, cache_hit=False):
+    """寫入一筆用量紀錄；寫入失敗不影響 AI 呼叫本身"""
+    prompt_tokens = int(usage.get('promptTokenCount', 0) or 0)
+    cached_tokens = int(usage.get('cachedContentTokenCount', 0) or 0)
+    response_tokens = int(usage.get('candidatesTokenCount', 0) or 0)
+    now = datetime.now()
+    rec = {
+        'ts': now.isoformat(timespec='seconds'),
+        'date': now.strftime('%Y-%m-%d'),
+        'account': _llm_usage_ctx.get().get('account', ''),
+        **row,
+        'prompt_tokens': prompt_tokens,
+        'cached_tokens': cached_tokens,
+        'response_tokens': response_tokens,
+        'ttft_s': round(ttft, 3) if ttft is not None else None,
+        'latency_s': round(latency, 3),
+        'cache_hit': bool(cache_hit),
+        'cost_usd': round(estimate_llm_cost(row.get('model'), prompt_tokens, cached_tokens, response_tokens), 6),
+    }
+    try:
+        os.makedirs(os.path.dirname(LLM_USAGE_LOG) or '.', exist_ok=True)
+        with _llm_usage_lock():
+            with open(LLM_USAGE_LOG, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(rec, ensure_ascii=False) + '\n')
+    except OSError:
+        pass
+
+def load_llm_usage():
+    if not os.path.exists(LLM_USAGE_LOG):
+        return pd.DataFrame()
+    try:
+        return pd.read_json(LLM_USAGE_LOG, lines=True, dtype={'account': str, 'date': str})
+    except ValueError:
+        return pd.DataFrame()
+
+def summarize_llm_usage(usage_df, by):
+    """依 by（例如 ['date'] 或 ['account']）彙總：呼叫數、token、成本、延遲 / TTFT 百分位"""
+    if usage_df is None or usage_df.empty:
+        return pd.DataFrame()
+    g = usage_df.groupby(by)
+    out = g.agg(
+        呼叫數=('latency_s', 'size'),
+        失敗數=('status', lambda x: int((x != 'ok').sum())),
+        重試數=('retry', lambda x: int((x > 0).sum())),
+        快取命中=('cache_hit', 'sum'),
+        輸入token=('prompt_tokens', 'sum'),
+        快取token=('cached_tokens', 'sum'),
+        輸出token=('response_tokens', 'sum'),
+        成本_USD=('cost_usd', 'sum'),
+        延遲_p50=('latency_s', lambda x: x.quantile(0.5)),
+        延遲_p95=('latency_s', lambda x: x.quantile(0.95)),
+        TTFT_p50=('ttft_s', lambda x: x.quantile(0.5)),
+        TTFT_p95=('ttft_s', lambda x: x.quantile(0.95)),
+    ).reset_index()
+    if by == ['date']:
+        out['累計成本_USD'] = out['成本_USD'].cumsum()
+    return out.round(4)
+
+# --- 靜態系統指令的 Context Cache：AI_CONSULTANT_PROMPT 只上傳一次，之後每次只送帳戶數據 ---
+GEMINI_PROMPT_CACHE_TTL = int(os.environ.get('GEMINI_PROMPT_CACHE_TTL', '3600'))
+
+@st.cache_resource
+def _genai_client_registry():
+    """(key hash, 服務) → SDK 用戶端；鎖只保護建立用戶端，不在請求進行中持有"""
+    return {}, threading.Lock()
+
+def genai_client(api_key, service='generative'):
+    """
+    每把 Key 各自的 SDK 用戶端（service：'generative' / 'cache'），Key 以 client_options 帶入。
+    不用 genai.configure：它設定的是整個 process 共用的 Key，背景工作跨 session 共用執行緒池，
+    若靠它切換 Key，就得在整個請求（含等待第一段回應）期間持有同一把鎖，所有呼叫都會被串行
+    """
+    registry, lock = _genai_client_registry()
+    key = (hashlib.sha256(str(api_key).encode()).hexdigest(), service)
+    with lock:
+        client = registry.get(key)
+        if client is None:
+            import google.ai.generativelanguage as glm
+            cls = glm.GenerativeServiceClient if service == 'generative' else glm.CacheServiceClient
+            client = registry[key] = cls(client_options={'api_key': api_key})
+        return client
+
+@st.cache_resource
+def _prompt_cache_registry():
+    """
+    (key hash, model, prompt hash) → {'name', 'handle', 'expires'}；建立失敗者 name 為 None
+    第二個 dict 是各快取項目的建立鎖：建立（網路呼叫）只擋同一項目的呼叫，registry 鎖只在讀寫 dict 時持有
+    """
+    return {}, {}, threading.Lock()
+
+@st.cache_resource
+def _prompt_cache_stats():
+    return {'lock': threading.Lock(), 'calls_cached': 0, 'calls_uncached': 0,
+            'prompt_tokens': 0, 'cached_tokens': 0, 'latency_cached': 0.0, 'latency_uncached': 0.0}
+
+def _record_prompt_cache_usage(cached, usage, latency):
+    stats = _prompt_cache_stats()
+    kind = 'cached' if cached else 'uncached'
+    with stats['lock']:
+        stats[f'calls_{kind}'] += 1
+        stats[f'latency_{kind}'] += latency
+        stats['prompt_tokens'] += int(usage.get('promptTokenCount', 0) or 0)
+        stats['cached_tokens'] += int(usage.get('cachedContentTokenCount', 0) or 0)
+
+def get_prompt_cache_stats():
+    stats = _prompt_cache_stats()
+    with stats['lock']:
+        snap = {k: v for k, v in stats.items() if k != 'lock'}
+    for kind in ('cached', 'uncached'):
+        n = snap[f'calls_{kind}']
+        snap[f'avg_latency_{kind}'] = round(snap[f'latency_{kind}'] / n, 2) if n else 0.0
+    # 計費輸入 token：快取命中部分以折扣價計，這裡只回報「以全價計」的部分
+    snap['billed_full_price_tokens'] = snap['prompt_tokens'] - snap['cached_tokens']
+    return snap
+
+def _prompt_cache_key(api_key, model, system_text):
+    return (
+        hashlib.sha256(str(api_key).encode()).hexdigest(),
+        model,
+        hashlib.sha256(system_text.encode('utf-8')).hexdigest(),
+    )
+
+def _create_prompt_cache(api_key, model, system_text):
+    """
+    建立 cachedContents；回傳 (name, sdk handle)。Prompt 太短（低於模型最小快取 token 數）等情況會丟例外
+    SDK 路徑的 handle 為 protos.CachedContent（有 name / model，可直接給 GenerativeModel.from_cached_content）
+    """
+    if use_genai_sdk():
+        # 以這把 Key 的用戶端建立（caching.CachedContent.create 只會用 genai.configure 的全域 Key）
+        request = genai.protos.CreateCachedContentRequest(cached_content=genai.protos.CachedContent(
+            model=f'models/{model}',
+            system_instruction=genai.protos.Content(parts=[genai.protos.Part(text=system_text)]),
+            ttl=timedelta(seconds=GEMINI_PROMPT_CACHE_TTL),
+        ))
+        handle = genai_client(api_key, 'cache').create_cached_content(request)
+        return handle.name, handle
+
+    url = f"{GEMINI_API_BASE}/v1beta/cachedContents?key={api_key}"
+    body = {
+        "model": f"models/{model}",
+        "systemInstruction": {"parts": [{"text": system_text}]},
+        "ttl": f"{GEMINI_PROMPT_CACHE_TTL}s",
+    }
+    r = requests.post(url, headers={'Content-Type': 'application/json'}, json=body)
+    if r.status_code != 200:
+        raise RuntimeError(f"cachedContents {r.status_code}: {r.text[:200]}")
+    return r.json()['name'], None
+
+def get_prompt_cache(api_key, model, system_text):
+    """
+    取得（必要時建立）系統指令的快取；prompt 文字改變 → hash 不同 → 自動建立新快取。
+    回傳 registry entry 或 None（不支援 / 建立失敗時改用 systemInstruction 直送）
+    """
+    registry, building, lock = _prompt_cache_registry()
+    key = _prompt_cache_key(api_key, model, system_text)
+    with lock:
+        entry = registry.get(key)
+        if entry is not None and entry['expires'] > time.time():
+            return entry if entry['name'] else None
+        build_lock = building.setdefault(key, threading.Lock())
+    # 同一項目只建立一次（其他呼叫等它建好再讀）；別的 Key / prompt 的呼叫不受影響
+    with build_lock:
+        with lock:
+            entry = registry.get(key)
+        now = time.time()
+        if entry is None or entry['expires'] <= now:
+            try:
+                name, handle = _create_prompt_cache(api_key, model, system_text)
+                entry = {'name': name, 'handle': handle, 'expires': now + GEMINI_PROMPT_CACHE_TTL - 60}
+            except Exception:
+                # 建立失敗：短時間內不再重試，先走 systemInstruction
+                entry = {'name': None, 'handle': None, 'expires': now + min(GEMINI_PROMPT_CACHE_TTL, 600)}
+            with lock:
+                registry[key] = entry
+    return entry if entry['name'] else None
+
+def invalidate_prompt_cache(api_key, model, system_text):
+    registry, _, lock = _prompt_cache_registry()
+    with lock:
+        registry.pop(_prompt_cache_key(api_key, model, system_text), None)
+
+def build_gemini_payload(user_text, system_text=None, cache_name=None):
+    """REST payload：有快取就引用 cachedContent，否則系統指令走 systemInstruction"""
+    payload = {"contents": [{"role": "user", "parts": [{"text": user_text}]}]}
+    if cache_name:
+        payload["cachedContent"] = cache_name
+    elif system_text:
+        payload["systemInstruction"] = {"parts": [{"text": system_text}]}
+    return payload
+
+DIAGNOSIS_USER_REQUEST = "\n\n# User Request: 請根據上述多層級數據，產生一份廣告優化診斷報告，並明確指出：活動 / AdSet / 廣告層級的調整建議，特別說明 CPM 變化如何影響 CPA 與 CPC。"
+
+class GeminiAPIError(RuntimeError):
+    """API 回傳非 200 或格式不如預期；訊息可直接顯示給使用者（status / retry_after 供批次排程判斷是否限流）"""
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+def _rest_stream_generate(api_key, model_name, payload):
+    """
+    REST 串流（alt=sse）：回傳 (status_code, 文字, usageMetadata, TTFT 秒, 錯誤內容)
+    非 200 時 usageMetadata 位置改放 {'retryAfter': 秒}（有 Retry-After 標頭時）
+    """
+    url = gemini_rest_url(model_name, api_key, 'streamGenerateContent') + '&alt=sse'
+    t0 = time.time()
+    ttft, texts, usage = None, [], {}
+    with requests.post(url, headers={'Content-Type': 'application/json'}, json=payload, stream=True) as r:
+        if r.status_code != 200:
+            retry_after = r.headers.get('Retry-After', '')
+            return r.status_code, None, ({'retryAfter': float(retry_after)} if retry_after.isdigit() else {}), None, r.text
+        for raw in r.iter_lines():
+            if not raw.startswith(b'data:'):
+                continue
+            event = json.loads(raw[5:].decode('utf-8'))
+            if ttft is None:
+                ttft = time.time() - t0
+            for cand in event.get('candidates', [])[:1]:
+                for part in cand.get('content', {}).get('parts', []):
+                    texts.append(part.get('text', ''))
+            usage = event.get('usageMetadata', usage)
+    return 200, ''.join(texts), usage, ttft, ''
+
+def _sdk_stream_generate(api_key, model_name, user_text, system_text, cache_handle, gen_cfg):
+    """SDK 串流：回傳 (文字, usageMetadata, TTFT 秒)；錯誤以 google.api_core 的例外丟出"""
+    if cache_handle is not None:
+        model = genai.GenerativeModel.from_cached_content(cached_content=cache_handle)
+    elif system_text:
+        model = genai.GenerativeModel(model_name, system_instruction=system_text)
+    else:
+        model = genai.GenerativeModel(model_name)
+    # 指定這把 Key 的用戶端（否則 SDK 會用 genai.configure 的全域用戶端）；不持有任何鎖，各請求可同時進行
+    model._client = genai_client(api_key)
+    t0 = time.time()
+    response = model.generate_content(user_text, generation_config=gen_cfg, stream=True)
+    ttft = None
+    for _ in response:
+        if ttft is None:
+            ttft = time.time() - t0
+    meta = getattr(response, 'usage_metadata', None)
+    usage = {
+        'promptTokenCount': getattr(meta, 'prompt_token_count', 0),
+        'cachedContentTokenCount': getattr(meta, 'cached_content_token_count', 0),
+        'candidatesTokenCount': getattr(meta, 'candidates_token_count', 0),
+    }
+    text = response.text if hasattr(response, "text") else str(response)
+    return text, usage, ttft
+
+def is_stale_prompt_cache_error(exc):
+    """SDK 的快取過期或被刪除（對應 REST 的 400 / 403 / 404）"""
+    return type(exc).__name__ in ('InvalidArgument', 'PermissionDenied', 'NotFound')
+
+def gemini_generate_text(api_key, model_name, user_text, system_text=None, use_prompt_cache=False,
+                         json_schema=None, feature='diagnosis', retry=0):
+    """
+    單次 Gemini 呼叫（SDK / REST 共用，皆以串流取得 TTFT）：
+    - 系統指令可走 Context Cache；json_schema 會要求結構化 JSON 輸出
+    - 每次呼叫都寫入用量紀錄（token / TTFT / 延遲 / 重試 / 快取命中）
+    - 回傳文字；失敗丟 GeminiAPIError
+    """
+    cache = get_prompt_cache(api_key, model_name, system_text) if (use_prompt_cache and system_text) else None
+    t0 = time.time()
+    usage_row = {'feature': feature, 'model': model_name, 'retry': retry}
+
+    try:
+        if use_genai_sdk():
+            usage_row['path'] = 'sdk'
+            gen_cfg = None
+            if json_schema is not None:
+                gen_cfg = genai.GenerationConfig(response_mime_type="application/json", response_schema=json_schema)
+            handle = cache['handle'] if cache else None
+            try:
+                text, usage, ttft = _sdk_stream_generate(api_key, model_name, user_text, system_text, handle, gen_cfg)
+            except Exception as e:
+                if handle is None or not is_stale_prompt_cache_error(e):
+                    raise
+                # 與 REST 路徑相同：作廢後改以系統指令直送一次
+                invalidate_prompt_cache(api_key, model_name, system_text)
+                cache = None
+                usage_row['retry'] += 1
+                text, usage, ttft = _sdk_stream_generate(api_key, model_name, user_text, system_text, None, gen_cfg)
+        else:
+            usage_row['path'] = 'rest'
+            data = build_gemini_payload(user_text, system_text, cache['name'] if cache else None)
+            if json_schema is not None:
+                data["generationConfig"] = {"responseMimeType": "application/json", "responseSchema": json_schema}
+            status, text, usage, ttft, err = _rest_stream_generate(api_key, model_name, data)
+            if cache and status in (400, 403, 404):
+                # 快取過期或被刪除：作廢後改以系統指令直送一次
+                invalidate_prompt_cache(api_key, model_name, system_text)
+                cache = None
+                usage_row['retry'] += 1
+                data.pop("cachedContent", None)
+                data["systemInstruction"] = {"parts": [{"text": system_text}]}
+                status, text, usage, ttft, err = _rest_stream_generate(api_key, model_name, data)
+            if status != 200:
+                usage_row['status'] = f'http_{status}'
+                raise GeminiAPIError(f"⚠️ API 連線錯誤 ({status}): {err}", status, usage.get('retryAfter'))
+            if not text:
+                usage_row['status'] = 'bad_format'
+                raise GeminiAPIError(f"⚠️ API 回傳格式不如預期: {str(usage)}")
+    except Exception:
+        usage_row.setdefault('status', 'error')
+        record_llm_usage(usage_row, {}, None, time.time() - t0, cache_hit=bool(cache))
+        raise
+
+    latency = time.time() - t0
+    usage_row['status'] = 'ok'
+    record_llm_usage(usage_row, usage, ttft, latency, cache_hit=bool(cache))
+    if use_prompt_cache:
+        _record_prompt_cache_usage(bool(cache), usage, latency)
+    return text
+
+def build_diagnosis_context(
     alerts_daily,
     alerts_weekly,
     campaign_summary,
@@ -674,9 +1503,14 @@ def call_gemini_analysis(
     ad_p7=None,
     trend_30d=None,
     cpm_change_table=None,
+    cpm_change_adset=None,
     new_creatives=None,
-    new_adsets=None
+    new_adsets=None,
+    bad_apples=None,
+    budget_plan=None,
+    partial_findings=None
 ):
+    """組出診斷用的帳戶數據段落；partial_findings 為 Map-Reduce 模式的分段初步診斷"""
     data_context = "\n\n# 📊 Account Data Summary（多層級視角）\n"
 
     data_context += "\n## 1. Daily Alerts (P1D vs P7D Anomalies)\n"
@@ -718,6 +1552,10 @@ def call_gemini_analysis(
         data_context += "\n\n## 7. CPM Change Table (P7D vs PP7D vs P30D, Campaign Level)\n"
         data_context += safe_to_markdown(cpm_change_table)
 
+    if cpm_change_adset is not None and not cpm_change_adset.empty:
+        data_context += "\n\n## 7b. CPM Change Table (AdSet Level, Top 30 by P7D Spend, with CPM×CPA Quadrant)\n"
+        data_context += safe_to_markdown(cpm_change_adset.head(30))
+
     # 新素材 / 新組合摘要（低 token）
     if new_creatives is not None and not new_creatives.empty:
         data_context += "\n\n## 8. New Creatives Summary (Recent Creatives, P7D Top)\n"
@@ -727,231 +1565,3094 @@ def call_gemini_analysis(
         data_context += "\n\n## 9. New AdSets Summary (New AdSets by Spend Shift, P7D Top)\n"
         data_context += safe_to_markdown(new_adsets)
 
-    full_prompt = (
-        AI_CONSULTANT_PROMPT
-        + data_context
-        + "\n\n# User Request: 請根據上述多層級數據，產生一份廣告優化診斷報告，並明確指出：活動 / AdSet / 廣告層級的調整建議，特別說明 CPM 變化如何影響 CPA 與 CPC。"
-    )
+    if bad_apples is not None and not bad_apples.empty:
+        data_context += "\n\n## 10. One Bad Apple (P7D AdSet Leave-One-Out: CPA without each Ad)\n"
+        data_context += safe_to_markdown(bad_apples.fillna({c: '-' for c in ('廣告 CPA (TWD)', '組合 CPA (TWD)', '移除後組合 CPA (TWD)')}))
+
+    budget_top = budget_plan_for_prompt(budget_plan)
+    if not budget_top.empty:
+        summary = budget_plan_summary(budget_plan)
+        data_context += "\n\n## 11. Budget Reallocation Plan (AdSet Marginal CPA Curves from P30D, Same Total Daily Budget)\n"
+        data_context += (
+            f"模型預估：總日預算 ${summary['budget']:,.0f} 不變，日轉換 {summary['conv_now']:.1f} → "
+            f"{summary['conv_new']:.1f}（{summary['lift_pct']:+.1f}%），{summary['moved']} 個組合需調整；下表為調整金額最大者\n"
+        )
+        data_context += safe_to_markdown(budget_top)
 
-    with st.spinner('🤖 AI 正在分析數據中... (這可能需要 10–20 秒)'):
-        try:
-            if HAS_GENAI:
-                genai.configure(api_key=api_key)
-                model = genai.GenerativeModel('gemini-2.5-pro')
-                response = model.generate_content(full_prompt)
-                return response.text if hasattr(response, "text") else str(response)
-
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-pro:generateContent?key={api_key}"
-            headers = {'Content-Type': 'application/json'}
-            data = {
-                "contents": [{
-                    "parts": [{"text": full_prompt}]
-                }]
-            }
-            response = requests.post(url, headers=headers, json=data)
-
-            if response.status_code == 200:
-                result_json = response.json()
-                try:
-                    return result_json['candidates'][0]['content']['parts'][0]['text']
-                except (KeyError, IndexError):
-                    return f"⚠️ API 回傳格式不如預期: {str(result_json)}"
-            else:
-                return f"⚠️ API 連線錯誤 ({response.status_code}): {response.text}"
+    if partial_findings:
+        data_context += "\n\n## 12. Partial Findings（Map 階段：各行銷活動分段初步診斷，已涵蓋全部活動 / AdSet / 廣告）\n"
+        for idx, findings in enumerate(partial_findings, start=1):
+            data_context += f"\n### 分段 {idx}\n{findings}\n"
 
-        except Exception as e:
-            return f"❌ 系統發生錯誤: {str(e)}\n請檢查 API Key 是否正確，或該 Key 是否有權限存取 2.5 Pro 模型。"
+    return data_context
 
-# ==========================================
-# 6. 主程式 UI
-# ==========================================
-st.title("📊 廣告成效全能分析 v6.4 (Dashboard + Instant DL)")
+def call_gemini_analysis(
+    api_key,
+    alerts_daily,
+    alerts_weekly,
+    campaign_summary,
+    adset_p7=None,
+    ad_p7=None,
+    trend_30d=None,
+    cpm_change_table=None,
+    cpm_change_adset=None,
+    new_creatives=None,
+    new_adsets=None,
+    bad_apples=None,
+    budget_plan=None,
+    use_prompt_cache=True
+):
+    data_context = build_diagnosis_context(
+        alerts_daily, alerts_weekly, campaign_summary, adset_p7, ad_p7, trend_30d,
+        cpm_change_table, cpm_change_adset, new_creatives, new_adsets, bad_apples, budget_plan
+    )
 
-if not HAS_GENAI:
-    st.warning("ℹ️ 提示：未偵測到 `google-generativeai` 套件。系統將自動切換為 **REST API 兼容模式** (只需 API Key 即可運作)。")
-if not HAS_XLSXWRITER:
-    st.warning("⚠️ 警告：未偵測到 `xlsxwriter` 套件。Excel 匯出功能可能會失效。")
+    # 靜態指令（AI_CONSULTANT_PROMPT）走系統指令 / Context Cache，每次只送帳戶數據
+    try:
+        return gemini_generate_text(
+            api_key, 'gemini-2.5-pro', data_context + DIAGNOSIS_USER_REQUEST,
+            system_text=AI_CONSULTANT_PROMPT, use_prompt_cache=use_prompt_cache
+        )
+    except GeminiAPIError as e:
+        return str(e)
+    except Exception as e:
+        return f"❌ 系統發生錯誤: {str(e)}\n請檢查 API Key 是否正確，或該 Key 是否有權限存取 2.5 Pro 模型。"
+
+# --- 大型帳戶 Map-Reduce 診斷：依活動切塊（token 上限）→ 快速模型平行初診 → 2.5 Pro 彙整七段報告 ---
+GEMINI_MAP_MODEL = os.environ.get('GEMINI_MAP_MODEL', 'gemini-2.5-flash')
+MAP_CHUNK_TOKENS = int(os.environ.get('GEMINI_MAP_CHUNK_TOKENS', '6000'))
+MAP_CONCURRENCY = int(os.environ.get('GEMINI_MAP_CONCURRENCY', '8'))
+MAP_OUTPUT_TOKENS = int(os.environ.get('GEMINI_MAP_OUTPUT_TOKENS', '1500'))
+MAP_MAX_RETRIES = 4
+
+# 單次診斷會截斷的上限（get_top_by_spend 的 n）；超過任一項即建議改用 Map-Reduce
+SINGLE_CALL_LIMITS = {'campaigns': 20, 'adsets': 30, 'ads': 50}
+
+MAP_DIAGNOSIS_PROMPT = """
+你是資深成效廣告分析師，負責大型帳戶的「分段初步診斷」。
+你只會看到帳戶中的部分行銷活動（含其 AdSet / 廣告 P7D 明細），之後會有另一位顧問彙整所有分段。
+請使用繁體中文，只輸出條列 findings（不要前言或總結），每條必須包含「層級、名稱、關鍵數字」：
+- 【止血】高花費 0 轉換、CPA 嚴重高於帳戶平均的 活動 / AdSet / 廣告
+- 【預算吸血鬼】花費高、CTR 高但 CVR 顯著偏低的廣告
+- 【害群之馬】同一 AdSet 內只有單一廣告拖累 CPA
+- 【系統偏食】同組內新素材 CPA 較佳但花費遠低於舊素材
+- 【擴量機會】CPA 低於帳戶平均且花費占比低
+- 【穩定基本盤】CPA 穩定、量體大
+每類最多 5 條，沒有就略過該類。
+大型活動的廣告明細可能分成多段（標題標示「續」），只看到部分廣告時不要對整個活動下結論。
+"""
 
-if 'gemini_result' not in st.session_state:
-    st.session_state['gemini_result'] = None
+_CJK_RE = re.compile(r'[\u3000-\u9fff\uff00-\uffef]')
 
-uploaded_file = st.file_uploader("請上傳 CSV 報表檔案", type=['csv'])
+def estimate_tokens(text):
+    """粗估 token 數：CJK 字元 1 字 1 token，其餘約 4 字元 1 token"""
+    text = str(text or '')
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + max(0, len(text) - cjk) // 4
 
-if uploaded_file is not None:
-    try:
-        # 1. 讀取與欄位偵測
-        try:
-            df = pd.read_csv(uploaded_file, encoding='utf-8')
-        except UnicodeDecodeError:
-            uploaded_file.seek(0)
-            df = pd.read_csv(uploaded_file, encoding='cp950')
-        except Exception as e:
-            st.error(f"檔案讀取未知的錯誤: {e}")
-            st.stop()
+def needs_map_reduce(campaign_summary, adset_p7, ad_p7):
+    def n_rows(df):
+        return 0 if df is None else int((df.iloc[:, 0] != '全帳戶平均').sum())
+    return (n_rows(campaign_summary) > SINGLE_CALL_LIMITS['campaigns']
+            or n_rows(adset_p7) > SINGLE_CALL_LIMITS['adsets']
+            or n_rows(ad_p7) > SINGLE_CALL_LIMITS['ads'])
 
-        df.columns = df.columns.str.strip()
-        all_columns = df.columns.tolist()
-        
-        # 側邊欄設定
-        with st.sidebar:
-            st.header("⚙️ 分析設定")
-            
-            st.subheader("🤖 AI 分析設定")
-            gemini_api_key = st.text_input("Gemini API Key", type="password", placeholder="輸入 Key 以啟用 AI 分析")
-            st.caption("[取得 Google AI Studio Key](https://aistudio.google.com/app/apikey)")
-            st.divider()
-            
-            suggested_idx = 0
-            for idx, col in enumerate(all_columns):
-                c_low = col.lower()
-                if '成本' in col or 'cost' in c_low: 
-                    continue
-                if ('free' in c_low and 'course' in c_low):
-                    suggested_idx = idx
-                    break
-                if '購買' in col or 'purchase' in c_low:
-                    suggested_idx = idx
-                    break
-                if '轉換' in col:
-                    suggested_idx = idx
+def partition_campaign_chunks(campaign_summary, adset_p7, detail_p7, token_budget=MAP_CHUNK_TOKENS):
+    """
+    依花費由高到低，把「活動 + 其 AdSet + 其廣告明細」打包成不超過 token_budget 的區塊
+    - 單一活動超過上限時，廣告列依花費順序拆成多段（續段只帶活動列），不丟棄任何一列
+    """
+    camps = campaign_summary[campaign_summary['行銷活動名稱'] != '全帳戶平均']
+    camps = camps.sort_values('花費金額 (TWD)', ascending=False)
+    adsets_by_camp = {k: g for k, g in adset_p7.groupby('行銷活動名稱', sort=False)} if adset_p7 is not None else {}
+    detail = detail_p7[detail_p7['行銷活動名稱'] != '全帳戶平均'] if detail_p7 is not None else None
+    ads_by_camp = {k: g for k, g in detail.groupby('行銷活動名稱', sort=False)} if detail is not None else {}
+
+    def campaign_block(name, camp_row, ads, continued=False):
+        block = f"### 行銷活動：{name}{'（續）' if continued else ''}\n" + safe_to_markdown(camp_row)
+        adsets = adsets_by_camp.get(name)
+        if not continued and adsets is not None and not adsets.empty:
+            block += "\n\nAdSets:\n" + safe_to_markdown(adsets.sort_values('花費金額 (TWD)', ascending=False))
+        if ads is not None and not ads.empty:
+            block += "\n\nAds:\n" + safe_to_markdown(ads)
+        return block + "\n"
+
+    def campaign_blocks(name, camp_row, ads):
+        """單一活動 → [(區塊, token 數)]；放不下時依平均每列 token 數切段，估太多再逐步縮小"""
+        block = campaign_block(name, camp_row, ads)
+        tokens = estimate_tokens(block)
+        if tokens <= token_budget or ads is None or len(ads) <= 1:
+            return [(block, tokens)]
+        row_tokens = max(1.0, estimate_tokens(safe_to_markdown(ads)) / len(ads))
+        parts, start = [], 0
+        while start < len(ads):
+            continued = bool(parts)
+            head_tokens = estimate_tokens(campaign_block(name, camp_row, None, continued))
+            n = max(1, int((token_budget - head_tokens) / row_tokens))
+            while True:
+                block = campaign_block(name, camp_row, ads.iloc[start:start + n], continued)
+                tokens = estimate_tokens(block)
+                if tokens <= token_budget or n == 1:
                     break
-                
-            conversion_col = st.selectbox("🎯 目標轉換欄位:", options=all_columns, index=suggested_idx)
-            
-            def find_col(opts, default):
-                for opt in opts:
-                    for col in all_columns:
-                        if opt in col:
-                            return col
-                return default
-
-            spend_col = find_col(['花費金額 (TWD)', '花費', '金額'], '花費金額 (TWD)')
-            clicks_col = find_col(['連結點擊次數', '連結點擊'], '連結點擊次數')
-            impressions_col = find_col(['曝光次數', '曝光'], '曝光次數')
-
-        # 2. 數據清洗
-        cols_to_numeric = [spend_col, clicks_col, impressions_col, conversion_col]
-        for col in cols_to_numeric:
-            if col in df.columns:
-                if df[col].dtype == 'object':
-                    df[col] = df[col].astype(str).str.replace(',', '', regex=False)
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-
-        if '天數' not in df.columns:
-            st.error("錯誤：CSV 檔案中找不到「天數」欄位，請檢查檔案格式。")
-            st.stop()
-
-        df['天數'] = pd.to_datetime(df['天數'], errors='coerce')
-        df = df.dropna(subset=['天數'])
+                n = max(1, int(n * 0.8))
+            parts.append((block, tokens))
+            start += n
+        return parts
+
+    chunks, current, current_tokens = [], [], 0
+    for i in range(len(camps)):
+        camp_row = camps.iloc[[i]]
+        name = camp_row['行銷活動名稱'].iloc[0]
+        ads = ads_by_camp.get(name)
+        if ads is not None:
+            ads = ads.sort_values('花費金額 (TWD)', ascending=False)
+        for block, tokens in campaign_blocks(name, camp_row, ads):
+            if current and current_tokens + tokens > token_budget:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            current.append(block)
+            current_tokens += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def call_gemini_analysis_map_reduce(
+    api_key,
+    alerts_daily,
+    alerts_weekly,
+    campaign_summary,
+    adset_p7=None,
+    ad_p7=None,
+    detail_p7=None,
+    trend_30d=None,
+    cpm_change_table=None,
+    cpm_change_adset=None,
+    new_creatives=None,
+    new_adsets=None,
+    bad_apples=None,
+    budget_plan=None,
+    use_prompt_cache=True,
+    map_model=GEMINI_MAP_MODEL,
+    chunk_tokens=MAP_CHUNK_TOKENS,
+    map_concurrency=MAP_CONCURRENCY
+):
+    """
+    Map：每個區塊以快速模型平行初診（牆鐘時間 ≈ 最慢的一段）
+    - 平行數不超過這把 Key 的同時請求上限（key_concurrency_limit），每次呼叫前向共用的 limiter 預約 RPM / TPM
+    - 429：整把 Key 暫停後重試（同批次週報），不把限流錯誤當成初診結果交給 Reduce
+    Reduce：帳戶層級表格 + 所有分段 findings → 2.5 Pro 依 AI_CONSULTANT_PROMPT 產出七段報告
+    """
+    if campaign_summary is None or campaign_summary.empty:
+        return call_gemini_analysis(
+            api_key, alerts_daily, alerts_weekly, campaign_summary, adset_p7, ad_p7, trend_30d,
+            cpm_change_table, cpm_change_adset, new_creatives, new_adsets, bad_apples, budget_plan, use_prompt_cache
+        )
 
-        df_std = df.rename(columns={
-            spend_col: '花費金額 (TWD)',
-            clicks_col: '連結點擊次數',
-            impressions_col: '曝光次數'
-        })
-        
-        # 3. 日期區間與資料分組
-        if df_std.empty:
-            st.error("錯誤：資料經過清洗後為空，請檢查原始檔案是否包含有效的日期與數據。")
-            st.stop()
+    chunks = partition_campaign_chunks(campaign_summary, adset_p7, detail_p7, chunk_tokens)
+    acc = campaign_summary[campaign_summary['行銷活動名稱'] == '全帳戶平均']
+    acc_note = ""
+    if not acc.empty and 'CPA (TWD)' in acc.columns:
+        acc_note = f"\n帳戶 P7D 平均 CPA：{acc['CPA (TWD)'].iloc[0]}\n\n"
 
-        max_date = df_std['天數'].max().normalize()
-        today = max_date + timedelta(days=1)
-        
-        p1d_start = max_date
-        df_p1d = df_std[df_std['天數'] == p1d_start].copy()
-        
-        p7d_start = today - timedelta(days=7)
-        p7d_end = today - timedelta(days=1)
-        pp7d_start = p7d_start - timedelta(days=7)
-        pp7d_end = p7d_start - timedelta(days=1)
-        p30d_start = today - timedelta(days=30)
-        p30d_end = today - timedelta(days=1)
-        
-        df_p7d = df_std[(df_std['天數'] >= p7d_start) & (df_std['天數'] <= p7d_end)].copy()
-        df_pp7d = df_std[(df_std['天數'] >= pp7d_start) & (df_std['天數'] <= pp7d_end)].copy()
-        df_p30d = df_std[(df_std['天數'] >= p30d_start) & (df_std['天數'] <= p30d_end)].copy()
+    limiter = get_rate_limiter(api_key)
 
-        # 新素材 / 新廣告組合摘要（供 AI 判讀：避免丟全量表造成 token 壓力）
-        new_creatives_df = build_new_creatives_summary(
-            df_p7d=df_p7d,
-            conv_col=conversion_col,
-            anchor_date=max_date,
-            recent_days=14,
-            top_n=15,
-            min_spend=300
+    def run_map(chunk):
+        user_text = acc_note + chunk
+        n_tokens = estimate_tokens(MAP_DIAGNOSIS_PROMPT) + estimate_tokens(user_text) + MAP_OUTPUT_TOKENS
+        for attempt in range(MAP_MAX_RETRIES + 1):
+            limiter.acquire(n_tokens)
+            try:
+                return gemini_generate_text(
+                    api_key, map_model, user_text, system_text=MAP_DIAGNOSIS_PROMPT,
+                    feature='diagnosis_map', retry=attempt
+                )
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == MAP_MAX_RETRIES:
+                    return f"（本段初診失敗：{e}）"
+                delay = getattr(e, 'retry_after', None) or 2.0 * (2 ** attempt) * (1 + 0.5 * np.random.random())
+                limiter.backoff(min(float(delay), WEEKLY_BATCH_MAX_BACKOFF))
+
+    # 每個分段各自複製一份 context，讓用量紀錄帶到正確的帳戶
+    # 外層背景工作已占用這把 Key 的一個 semaphore 名額（再取會自鎖），因此改以 Key 的上限限制 Map 的平行數
+    key_limit = key_concurrency_limit(api_key) or LLM_DEFAULT_CONCURRENCY_PER_KEY
+    contexts = [contextvars.copy_context() for _ in chunks]
+    with ThreadPoolExecutor(max_workers=max(1, min(map_concurrency, key_limit, len(chunks)))) as pool:
+        partial_findings = list(pool.map(lambda pair: pair[0].run(run_map, pair[1]), zip(contexts, chunks)))
+
+    if all(f.startswith("（本段初診失敗") for f in partial_findings):
+        return f"⚠️ Map 階段全部失敗：{partial_findings[0]}"
+
+    # Reduce：AdSet / 廣告明細已在 Map 階段看過，只帶帳戶層級表格與 findings
+    data_context = build_diagnosis_context(
+        alerts_daily, alerts_weekly, campaign_summary, None, None, trend_30d,
+        cpm_change_table, cpm_change_adset, new_creatives, new_adsets, bad_apples, budget_plan,
+        partial_findings=partial_findings
+    )
+    try:
+        return gemini_generate_text(
+            api_key, 'gemini-2.5-pro', data_context + DIAGNOSIS_USER_REQUEST,
+            system_text=AI_CONSULTANT_PROMPT, use_prompt_cache=use_prompt_cache,
+            feature='diagnosis_reduce'
         )
+    except GeminiAPIError as e:
+        return str(e)
+    except Exception as e:
+        return f"❌ 系統發生錯誤: {str(e)}\n請檢查 API Key 是否正確，或該 Key 是否有權限存取 2.5 Pro 模型。"
+
+# --- 週報草案：結構化 JSON 輸出（response schema + 本地修復，避免重打一次 2.5 Pro） ---
+PLAN_TYPES = [
+    "1. 做簡易的開關、預算調配即可",
+    "2. 補素材",
+    "3. 補受眾",
+    "4. 進行到達頁面優化",
+    "5. 預算縮減、提高",
+    "6. 維持即可",
+]
+
+WEEKLY_LIST_KEYS = ['audience_effective', 'audience_ineffective', 'creative_effective', 'creative_ineffective']
+
+_STR_LIST_SCHEMA = {"type": "ARRAY", "items": {"type": "STRING"}}
+
+WEEKLY_DRAFT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "status_summary": {"type": "STRING"},
+        **{k: _STR_LIST_SCHEMA for k in WEEKLY_LIST_KEYS},
+        "next_week_plan_reco": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "type": {"type": "STRING"},
+                    "recommend": {"type": "BOOLEAN"},
+                    "reason": {"type": "STRING"},
+                    "actions": _STR_LIST_SCHEMA,
+                },
+                "required": ["type", "recommend", "reason", "actions"],
+            },
+        },
+    },
+    "required": ["status_summary"] + WEEKLY_LIST_KEYS + ["next_week_plan_reco"],
+}
 
-        new_adsets_df = build_new_adsets_summary(
-            df_p7d=df_p7d,
-            df_pp7d=df_pp7d,
-            conv_col=conversion_col,
-            top_n=15,
-            min_spend_p7=500,
-            old_spend_threshold=200
-        )
-        
-        # 各區間 Campaign 層級
-        res_p1d_camp = calculate_consolidated_metrics(df_p1d.groupby('行銷活動名稱'), conversion_col)
-        res_p7d_camp = calculate_consolidated_metrics(df_p7d.groupby('行銷活動名稱'), conversion_col)
-        res_pp7d_camp = calculate_consolidated_metrics(df_pp7d.groupby('行銷活動名稱'), conversion_col)
-        
-        # 警示與週趨勢
-        alerts_daily = check_daily_anomalies(res_p1d_camp, res_p7d_camp, '行銷活動名稱')
-        alerts_weekly = check_weekly_trends(res_p7d_camp, res_pp7d_camp, '行銷活動名稱')
+@st.cache_resource
+def _weekly_json_stats():
+    """週報 JSON 解析統計（process 層級）：直接成功 / 本地修復 / 失敗 / 重試次數"""
+    return {'lock': threading.Lock(), 'calls': 0, 'direct': 0, 'repaired': 0, 'failed': 0, 'retries': 0}
+
+def _bump_weekly_stat(**inc):
+    stats = _weekly_json_stats()
+    with stats['lock']:
+        for k, v in inc.items():
+            stats[k] += v
+
+def get_weekly_json_stats():
+    stats = _weekly_json_stats()
+    with stats['lock']:
+        snap = {k: v for k, v in stats.items() if k != 'lock'}
+    snap['success_rate'] = round((snap['direct'] + snap['repaired']) / snap['calls'] * 100, 1) if snap['calls'] else 0.0
+    return snap
+
+def _close_truncated_json(s):
+    """補上被截斷 JSON 的未閉合字串 / 括號（輸出超過 token 上限時常見）"""
+    stack, in_str, esc = [], False, False
+    for ch in s:
+        if in_str:
+            if esc:
+                esc = False
+            elif ch == '\\':
+                esc = True
+            elif ch == '"':
+                in_str = False
+        elif ch == '"':
+            in_str = True
+        elif ch in '{[':
+            stack.append('}' if ch == '{' else ']')
+        elif ch in '}]' and stack:
+            stack.pop()
+    tail = '"' if in_str else ''
+    body = re.sub(r'[,:]\s*$', '', s + tail)
+    return body + ''.join(reversed(stack))
+
+def _loads_or_none(s):
+    try:
+        return json.loads(s)
+    except Exception:
+        return None
 
-        # 各區間多層級匯總
-        res_p1 = collect_period_results(df_p1d, 'P1D', conversion_col)
-        res_p7 = collect_period_results(df_p7d, 'P7D', conversion_col)
-        res_pp7 = collect_period_results(df_pp7d, 'PP7D', conversion_col)
-        res_p30 = collect_period_results(df_p30d, 'P30D', conversion_col)
+def _repair_json_text(s):
+    """依序嘗試：去除 code fence → 擷取最外層 {...} → 移除尾逗號 → 補齊截斷"""
+    s = re.sub(r"^```(?:json)?\s*|\s*```$", "", str(s).strip(), flags=re.IGNORECASE)
+    start = s.find('{')
+    if start == -1:
+        return None
+    try:
+        obj, _ = json.JSONDecoder().raw_decode(s[start:])
+        if isinstance(obj, dict):
+            return obj
+    except ValueError:
+        pass
+    end = s.rfind('}')
+    span, tail = s[start:end + 1], s[start:]
+    # 完整片段優先；找不到才視為截斷並補齊
+    attempts = [(span, False), (tail, True), (span, True)] if end > start else [(tail, True)]
+    for c, close in attempts:
+        for fixed in (c, re.sub(r',\s*([}\]])', r'\1', c)):
+            obj = _loads_or_none(_close_truncated_json(fixed) if close else fixed)
+            if isinstance(obj, dict):
+                return obj
+    return None
+
+def _as_str_list(v):
+    if v is None:
+        return []
+    if isinstance(v, str):
+        return [x.strip(" -•\t") for x in v.splitlines() if x.strip(" -•\t")]
+    if isinstance(v, (list, tuple)):
+        return [str(x).strip() for x in v if str(x).strip()]
+    return [str(v)]
+
+def _match_plan_type(t):
+    t = str(t or '').strip()
+    if t in PLAN_TYPES:
+        return t
+    m = re.match(r'^\s*(\d)', t)
+    if m and 1 <= int(m.group(1)) <= len(PLAN_TYPES):
+        return PLAN_TYPES[int(m.group(1)) - 1]
+    for p in PLAN_TYPES:
+        if t and (t in p or p.split('. ', 1)[-1] in t):
+            return p
+    return None
+
+def normalize_weekly_draft(obj):
+    """依 WEEKLY_DRAFT_SCHEMA 驗證並補齊欄位；型別不符者就地修正"""
+    draft = {'status_summary': str(obj.get('status_summary') or '').strip()}
+    for k in WEEKLY_LIST_KEYS:
+        draft[k] = _as_str_list(obj.get(k))
+
+    plans = []
+    for p in obj.get('next_week_plan_reco') or []:
+        if not isinstance(p, dict):
+            continue
+        t = _match_plan_type(p.get('type'))
+        if not t:
+            continue
+        rec = p.get('recommend', False)
+        if isinstance(rec, str):
+            rec = rec.strip().lower() in ('true', 'yes', '是', '建議', '1')
+        plans.append({
+            'type': t,
+            'recommend': bool(rec),
+            'reason': str(p.get('reason') or '').strip(),
+            'actions': _as_str_list(p.get('actions')),
+        })
+    draft['next_week_plan_reco'] = plans
+    return draft
+
+def parse_weekly_draft(raw_text):
+    """回傳 (draft, 解析方式)；解析方式：direct / repaired / None"""
+    obj = _loads_or_none(raw_text) if raw_text else None
+    how = 'direct' if isinstance(obj, dict) else None
+    if how is None and raw_text:
+        obj = _repair_json_text(raw_text)
+        how = 'repaired' if obj is not None else None
+    if how is None:
+        return None, None
+    return normalize_weekly_draft(obj), how
+
+def _fmt_pct(x):
+    return f"{x:.2f}%"
+
+def _fmt_money(x):
+    return f"${x:,.0f}"
+
+def _weekly_report_ai_prompt(p7_overall, pp7_overall, top_adsets_p7, top_ads_p7):
+    return f"""
+你是一位成效廣告代操顧問。請用「可直接貼給客戶的週報語氣」輸出繁體中文，保持簡潔、可執行。
 
-        # P7D 多層級 DataFrame 給 AI 用
-        p7_detail_df = res_p7[0][1]
-        p7_ad_df     = res_p7[1][1]
-        p7_adset_df  = res_p7[2][1]
-        p7_camp_df   = res_p7[3][1]
+【本週 P7D 概況】
+- 花費：{p7_overall['spend']}
+- 轉換：{p7_overall['conv']}
+- CPA：{p7_overall['cpa']}
+- CTR：{p7_overall['ctr']}%
+- CPC：{p7_overall['cpc']}
 
-        # P30D 行銷活動層級，用於 CPM 變化表
-        p30_camp_df = res_p30[3][1] if len(res_p30) >= 4 else None
+【上週 PP7D 概況】
+- 花費：{pp7_overall['spend']}
+- 轉換：{pp7_overall['conv']}
+- CPA：{pp7_overall['cpa']}
+- CTR：{pp7_overall['ctr']}%
+- CPC：{pp7_overall['cpc']}
 
-        # 30 日帳戶趨勢 DataFrame
-        trend_30d_df = get_trend_data_excel(df_p30d, conversion_col)
+【AdSet（視為受眾單位）P7D Top】
+{safe_to_markdown(top_adsets_p7)}
 
-        # CPM 變化表
-        cpm_change_df = build_cpm_change_table(
-            p7_camp_df,
-            res_pp7d_camp,
-            p30_camp_df
-        )
+【Ad（視為素材單位）P7D Top】
+{safe_to_markdown(top_ads_p7)}
 
-        # ==========================================
-        # [NEW] 調整 1：將下載邏輯提前至此（確保沒做 AI 也能下載）
-        # ==========================================
-        excel_stack = []
-        excel_stack.append(('Trend_Daily_30D', trend_30d_df))
-        if cpm_change_df is not None and not cpm_change_df.empty:
-            excel_stack.append(('CPM_Change_P7D_PP7D_P30D', cpm_change_df))
-        excel_stack.extend(res_p1)
-        excel_stack.extend(res_p7)
-        excel_stack.extend(res_pp7)
-        excel_stack.extend(res_p30)
-        
-        # 取得目前 session state 的結果 (可能是 None，也可能是跑完後的文字)
-        current_ai_result = st.session_state.get('gemini_result', None)
-        
-        # 產生 Excel Bytes
-        excel_bytes = to_excel_single_sheet_stacked(excel_stack, AI_CONSULTANT_PROMPT, current_ai_result)
-        
-        with st.sidebar:
-            st.divider()
-            if excel_bytes:
-                dl_label = "📥 下載完整分析報表"
-                if current_ai_result:
-                    dl_label += " (含 AI 分析)"
-                
-                st.download_button(
-                    label=dl_label,
+請輸出 JSON（務必是 JSON，不能有多餘文字），格式如下：
+{{
+  "status_summary": "一段 2~4 句的現況描述（包含：哪些受眾有效/無效、哪些素材有效/無效）",
+  "audience_effective": ["受眾/AdSet A（理由）", "..."],
+  "audience_ineffective": ["受眾/AdSet B（理由）", "..."],
+  "creative_effective": ["素材/Ad X（理由）", "..."],
+  "creative_ineffective": ["素材/Ad Y（理由）", "..."],
+  "next_week_plan_reco": [
+    {{
+      "type": "1. 做簡易的開關、預算調配即可",
+      "recommend": true,
+      "reason": "為何建議/不建議",
+      "actions": ["具體動作 1", "具體動作 2"]
+    }}
+  ]
+}}
+"""
+
+def build_weekly_markdown(p7_overall, pp7_overall, status_summary, aud_eff, aud_bad, cre_eff, cre_bad,
+                          selected_plans, client_note=''):
+    """週報 Markdown（LINE 可貼）：週報產生器分頁與批次週報共用"""
+    lines = []
+    lines.append("## 📊 本週廣告週報")
+    lines.append("")
+    lines.append("### 1) 簡要概況")
+    lines.append(f"- **P7D** 花費 {_fmt_money(p7_overall['spend'])}｜轉換 {int(p7_overall['conv'])}｜CPA {_fmt_money(p7_overall['cpa'])}｜CTR {_fmt_pct(p7_overall['ctr'])}｜CPC {_fmt_money(p7_overall['cpc'])}")
+    lines.append(f"- **PP7D** 花費 {_fmt_money(pp7_overall['spend'])}｜轉換 {int(pp7_overall['conv'])}｜CPA {_fmt_money(pp7_overall['cpa'])}｜CTR {_fmt_pct(pp7_overall['ctr'])}｜CPC {_fmt_money(pp7_overall['cpc'])}")
+    lines.append("")
+    lines.append("### 2) 現況描述")
+    if status_summary.strip():
+        lines.append(status_summary.strip())
+    lines.append("")
+    lines.append("### 3) 受眾與素材表現")
+    if aud_eff:
+        lines.append("**✅ 有效受眾（AdSet）**")
+        lines += [f"- {x}" for x in aud_eff]
+    if aud_bad:
+        lines.append("**❌ 無效受眾（AdSet）**")
+        lines += [f"- {x}" for x in aud_bad]
+    if cre_eff:
+        lines.append("**✅ 有效素材（Ad）**")
+        lines += [f"- {x}" for x in cre_eff]
+    if cre_bad:
+        lines.append("**❌ 無效素材（Ad）**")
+        lines += [f"- {x}" for x in cre_bad]
+    lines.append("")
+    lines.append("### 4) 下週計畫")
+    if selected_plans:
+        for p in selected_plans:
+            lines.append(f"**{p['type']}**")
+            if p.get("reason"):
+                lines.append(f"- 理由：{p['reason']}")
+            if p.get("actions"):
+                lines.append("- 動作：")
+                lines += [f"  - {a}" for a in p["actions"]]
+    else:
+        lines.append("- 本週建議維持為主，先觀察數據穩定性。")
+    if client_note.strip():
+        lines.append("")
+        lines.append("### 5) 補充")
+        lines.append(client_note.strip())
+    return "\n".join(lines)
+
+def weekly_markdown_from_draft(p7_overall, pp7_overall, draft):
+    """未經人工編輯的草案 → Markdown（與分頁預設勾選相同：清單全採用、計畫依 recommend）"""
+    plans = [
+        {'type': p['type'], 'reason': p.get('reason', ''), 'actions': p.get('actions', [])}
+        for t in PLAN_TYPES for p in draft.get('next_week_plan_reco', [])
+        if p.get('type') == t and p.get('recommend')
+    ]
+    return build_weekly_markdown(
+        p7_overall, pp7_overall, str(draft.get('status_summary', '')),
+        *(draft.get(k, []) for k in WEEKLY_LIST_KEYS), plans
+    )
+
+def _gemini_weekly_raw(api_key, prompt, retry=0):
+    return gemini_generate_text(
+        api_key, "gemini-2.5-pro", prompt, json_schema=WEEKLY_DRAFT_SCHEMA, feature='weekly', retry=retry
+    )
+
+def call_gemini_weekly_draft(api_key, prompt, max_retries=1, base_backoff=2.0):
+    """
+    週報草案（結構化 JSON）：回傳 {'draft': dict 或 None, 'raw': AI 原始文字, 'how': 解析方式}
+    - 先本地修復；只有完全無法修復才重打，最多 max_retries 次
+    - 限流（429）：等 Retry-After（沒有則 base_backoff × 2^n）後重試；其他 API / 連線錯誤直接丟出，由工作面板顯示
+    """
+    raw_text = ""
+    for attempt in range(max_retries + 1):
+        if attempt:
+            _bump_weekly_stat(retries=1)
+        try:
+            raw_text = _gemini_weekly_raw(api_key, prompt, retry=attempt)
+        except Exception as e:
+            if attempt == max_retries or not is_rate_limited(e):
+                _bump_weekly_stat(calls=1, failed=1)
+                raise
+            delay = getattr(e, 'retry_after', None) or base_backoff * (2 ** attempt)
+            time.sleep(min(float(delay), WEEKLY_BATCH_MAX_BACKOFF))
+            continue
+        draft, how = parse_weekly_draft(raw_text)
+        if draft is not None:
+            _bump_weekly_stat(calls=1, **{how: 1})
+            return {'draft': draft, 'raw': raw_text, 'how': how}
+    _bump_weekly_stat(calls=1, failed=1)
+    return {'draft': None, 'raw': raw_text, 'how': None}
+
+# ==========================================
+# 5.5 背景 AI 工作（不阻塞 UI，可同時產生診斷與週報）
+# ==========================================
+# 注意：背景執行緒內不可呼叫任何 st.*，只做純運算 / API 呼叫
+LLM_MAX_WORKERS = int(os.environ.get('LLM_MAX_WORKERS', '8'))
+LLM_DEFAULT_CONCURRENCY_PER_KEY = int(os.environ.get('LLM_CONCURRENCY_PER_KEY', '2'))
+
+@st.cache_resource
+def get_llm_executor():
+    """跨 session 共用的執行緒池（整個 process 只建立一次）"""
+    return ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS, thread_name_prefix='llm-job')
+
+@st.cache_resource
+def _llm_key_semaphores():
+    """key hash → (semaphore, 上限)"""
+    return {}, threading.Lock()
+
+def _get_key_semaphore(api_key, limit):
+    """
+    每個 API Key 一個 semaphore，限制同一把 Key 的同時請求數（跨 session 共用）；
+    上限以第一次建立時為準，之後其他 session 填不同的值也不會另開一個 semaphore
+    """
+    sems, lock = _llm_key_semaphores()
+    sem_key = hashlib.sha256(str(api_key).encode()).hexdigest()
+    with lock:
+        if sem_key not in sems:
+            limit = max(1, int(limit))
+            sems[sem_key] = (threading.BoundedSemaphore(limit), limit)
+        return sems[sem_key][0]
+
+def key_concurrency_limit(api_key):
+    """這把 Key 目前生效的同時請求上限；尚未建立時回傳 None"""
+    sems, lock = _llm_key_semaphores()
+    with lock:
+        entry = sems.get(hashlib.sha256(str(api_key).encode()).hexdigest())
+    return entry[1] if entry else None
+
+def submit_llm_job(job_name, api_key, fn, *args, concurrency=None, usage_context=None, **kwargs):
+    """
+    送出背景 AI 工作並記錄在 session_state['llm_jobs'][job_name]
+    - fn(api_key, *args, **kwargs) 在背景執行緒執行
+    - 等待 per-key semaphore 期間狀態為「排隊中」
+    """
+    sem = _get_key_semaphore(api_key, concurrency or LLM_DEFAULT_CONCURRENCY_PER_KEY)
+    started = threading.Event()
+
+    ctx = dict(usage_context or {})
+
+    def run():
+        token = _llm_usage_ctx.set(ctx)
+        try:
+            with sem:
+                started.set()
+                return fn(api_key, *args, **kwargs)
+        finally:
+            _llm_usage_ctx.reset(token)
+
+    jobs = st.session_state.setdefault('llm_jobs', {})
+    jobs[job_name] = {
+        'future': get_llm_executor().submit(run),
+        'started': started,
+        'submitted_at': time.time(),
+    }
+
+def get_llm_job_status(job_name):
+    """回傳 (狀態, 結果, 已耗時秒數)；狀態：idle / queued / running / done / error"""
+    job = st.session_state.get('llm_jobs', {}).get(job_name)
+    if not job:
+        return 'idle', None, 0.0
+    elapsed = time.time() - job['submitted_at']
+    future = job['future']
+    if not future.done():
+        return ('running' if job['started'].is_set() else 'queued'), None, elapsed
+    exc = future.exception()
+    if exc is not None:
+        return 'error', exc, elapsed
+    return 'done', future.result(), elapsed
+
+def pop_llm_job(job_name):
+    st.session_state.get('llm_jobs', {}).pop(job_name, None)
+
+LLM_JOB_LABELS = {
+    'diagnosis': '🤖 AI 深度診斷',
+    'weekly': '🧾 週報草案',
+}
+
+def _collect_llm_job(job_name, result):
+    """把完成的背景工作結果寫回 session_state（在主執行緒執行）"""
+    if job_name == 'diagnosis':
+        st.session_state['gemini_result'] = result
+    elif job_name == 'weekly':
+        if result.get('draft'):
+            st.session_state['weekly_draft'] = result['draft']
+            st.session_state['weekly_raw_error'] = None
+        else:
+            st.session_state['weekly_raw_error'] = str(result.get('raw', ''))
+
+def render_llm_job_panel(poll_seconds=2):
+    """顯示背景 AI 工作進度；有工作進行中時以 fragment 定時輪詢，完成後整頁刷新一次"""
+    def panel():
+        finished = False
+        for job_name in list(st.session_state.get('llm_jobs', {})):
+            status, result, elapsed = get_llm_job_status(job_name)
+            label = LLM_JOB_LABELS.get(job_name, job_name)
+            if status == 'queued':
+                st.caption(f"⏳ {label}：排隊中（等待 API Key 可用額度）… {elapsed:.0f}s")
+            elif status == 'running':
+                st.caption(f"🔄 {label}：AI 產生中，可先切換其他分頁… {elapsed:.0f}s")
+            elif status == 'done':
+                _collect_llm_job(job_name, result)
+                pop_llm_job(job_name)
+                finished = True
+            elif status == 'error':
+                # GeminiAPIError 的訊息本身就是給使用者看的（含 HTTP 狀態與 API 回傳內容）
+                message = str(result) if isinstance(result, GeminiAPIError) else f"❌ 系統發生錯誤: {result}"
+                st.session_state.setdefault('llm_job_errors', {})[job_name] = message
+                pop_llm_job(job_name)
+                finished = True
+        if finished:
+            st.rerun()
+
+    has_active = bool(st.session_state.get('llm_jobs'))
+    st.fragment(panel, run_every=poll_seconds if has_active else None)()
+
+# ==========================================
+# 5.6 分析管線與跨 session 共用資料集（依檔案內容雜湊只存一份）
+# ==========================================
+# 多位分析師同時開啟同一份匯出檔時，原始資料、清洗結果、各區間切片、彙總表與 Excel bytes
+# 在整個 process 只存一份；session_state 只保存 key（handle）。
+# 共用物件一律唯讀：UI 端若要加欄位 / 改值，請先 .copy()
+DATASET_STORE_MAX_MB = float(os.environ.get('DATASET_STORE_MAX_MB', '2048'))
+DATASET_STORE_IDLE_SECONDS = float(os.environ.get('DATASET_STORE_IDLE_SECONDS', '1800'))
+
+def find_col(all_columns, opts, default):
+    """依關鍵字順序找出第一個包含該字串的欄位"""
+    for opt in opts:
+        for col in all_columns:
+            if opt in col:
+                return col
+    return default
+
+def find_breakdown_cols(all_columns):
+    """偵測細分維度欄位：{標準名稱: 檔案內欄名}"""
+    lowered = {str(c).strip().lower(): c for c in all_columns}
+    found = {}
+    for canonical, opts in BREAKDOWN_COLS.items():
+        for opt in opts:
+            if opt.lower() in lowered:
+                found[canonical] = lowered[opt.lower()]
+                break
+    return found
+
+def _header_key(name):
+    return str(name).strip().lower().replace('（', '(').replace('）', ')')
+
+def find_hour_col(all_columns):
+    """逐小時匯出的小時欄（完整欄名比對）；沒有時回傳 None"""
+    by_key = {_header_key(c): c for c in all_columns}
+    for opt in HOUR_COLS:
+        if _header_key(opt) in by_key:
+            return by_key[_header_key(opt)]
+    return None
+
+def parse_hour(value):
+    """'13:00:00 - 13:59:59' / '13' / 13 → 13；無法辨識 → -1"""
+    m = re.match(r'\s*(\d{1,2})', str(value))
+    return int(m.group(1)) if m and int(m.group(1)) < 24 else -1
+
+def suggest_conversion_index(all_columns):
+    """預設的目標轉換欄位：免費課程 > 購買 > 轉換（排除成本類欄位）"""
+    for idx, col in enumerate(all_columns):
+        c_low = col.lower()
+        if '成本' in col or 'cost' in c_low:
+            continue
+        if ('free' in c_low and 'course' in c_low):
+            return idx
+        if '購買' in col or 'purchase' in c_low:
+            return idx
+        if '轉換' in col:
+            return idx
+    return 0
+
+def default_analysis_columns(all_columns):
+    """不經 UI 時的欄位選擇（與側邊欄預設相同）：(轉換, 花費, 點擊, 曝光)"""
+    spend_col, clicks_col, impressions_col = (
+        find_col(all_columns, opts, canonical) for canonical, opts in STANDARD_METRIC_COLS.items()
+    )
+    return all_columns[suggest_conversion_index(all_columns)], spend_col, clicks_col, impressions_col
+
+def read_csv_bytes(file_bytes):
+    """讀取上傳檔 bytes：先試 UTF-8，失敗改 cp950；有 pyarrow 時與 read_csv_path 相同交給 Arrow CSV reader"""
+    if HAS_PYARROW:
+        return _read_csv_arrow(lambda: pa.BufferReader(file_bytes))
+    try:
+        df = pd.read_csv(io.BytesIO(file_bytes), encoding='utf-8')
+    except UnicodeDecodeError:
+        df = pd.read_csv(io.BytesIO(file_bytes), encoding='cp950')
+    df.columns = df.columns.str.strip()
+    return df
+
+# 花費 / 點擊 / 曝光：標準欄名 → 偵測用關鍵字（依序比對）
+STANDARD_METRIC_COLS = {
+    '花費金額 (TWD)': ['花費金額 (TWD)', '花費', '金額'],
+    '連結點擊次數': ['連結點擊次數', '連結點擊'],
+    '曝光次數': ['曝光次數', '曝光'],
+}
+# 細分維度（Ads Manager「細分」匯出）：欄名需完全相符（不分大小寫），避免「平台」誤配到「裝置平台」
+BREAKDOWN_COLS = {
+    '年齡': ['年齡', 'Age'],
+    '性別': ['性別', 'Gender'],
+    '平台': ['平台', 'Platform', 'Publisher platform'],
+    '版位': ['版位', 'Placement'],
+    '裝置平台': ['裝置平台', 'Device platform'],
+    '曝光裝置': ['曝光裝置', 'Impression device'],
+    '國家/地區': ['國家/地區', '國家', 'Country'],
+}
+# 逐小時匯出（天數 + 小時欄，例如「一天中的時段（廣告帳戶時區）」= 00:00:00 - 00:59:59）
+# 只認完整欄名（不分大小寫、全半形括號視為相同），避免其他含「時段」字樣的欄位被誤判
+HOUR_COLS = [
+    '一天中的時段（廣告帳戶時區）', '一天中的時段（曝光者時區）', '一天中的時段', '時段',
+    'Time of day (ad account time zone)', "Time of day (viewer's time zone)",
+    'Hourly stats aggregated by advertiser time zone', 'Hourly stats aggregated by audience time zone',
+    'Hour of day',
+]
+INTRADAY_TRAILING_DAYS = 7
+INGEST_MAX_WORKERS = int(os.environ.get('INGEST_MAX_WORKERS', str(min(8, os.cpu_count() or 2))))
+
+def expand_upload_parts(name, data):
+    """上傳檔 → [(分檔名稱, CSV bytes), ...]；.zip 取出其中所有 CSV（含 .csv.gz），.gz 先解壓"""
+    low = name.lower()
+    if low.endswith('.zip'):
+        parts = []
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            for info in zf.infolist():
+                member = info.filename
+                if info.is_dir() or member.startswith('__MACOSX/') or os.path.basename(member).startswith('.'):
+                    continue
+                if member.lower().endswith(('.csv', '.csv.gz')):
+                    parts.extend(expand_upload_parts(f"{name}/{member}", zf.read(info)))
+        return parts
+    if low.endswith('.gz'):
+        return [(name[:-3], gzip.decompress(data))]
+    return [(name, data)]
+
+def normalize_part_columns(df):
+    """各分檔表頭可能不一致（例如 花費金額 / 花費）：統一成標準欄名，合併時才能對齊"""
+    cols = df.columns.tolist()
+    rename = {}
+    for canonical, opts in STANDARD_METRIC_COLS.items():
+        found = find_col(cols, opts, None)
+        if found is not None and found != canonical and canonical not in cols:
+            rename[found] = canonical
+    for canonical, found in find_breakdown_cols(cols).items():
+        if found != canonical and canonical not in cols:
+            rename[found] = canonical
+    return df.rename(columns=rename) if rename else df
+
+def read_csv_path(path):
+    """
+    讀取伺服器端 CSV：memory-map 後交給 Arrow CSV reader 解碼（多執行緒、不先整份讀進記憶體）
+    - 先以 UTF-8 解碼，失敗改 cp950（與上傳檔相同）
+    - 轉 pandas 時 self_destruct 邊轉邊釋放 Arrow 緩衝區，避免同時存在兩份
+    - 沒有 pyarrow 時改用 pandas（memory_map=True）
+    """
+    if not HAS_PYARROW:
+        try:
+            df = pd.read_csv(path, encoding='utf-8', memory_map=True)
+        except UnicodeDecodeError:
+            df = pd.read_csv(path, encoding='cp950', memory_map=True)
+        df.columns = df.columns.str.strip()
+        return df
+
+    return _read_csv_arrow(lambda: pa.memory_map(path, 'r'))
+
+def _read_csv_arrow(open_source):
+    """open_source() → Arrow 來源（memory map / BufferReader）；Arrow CSV reader 多執行緒解析後轉 pandas"""
+    # Arrow 遇到非 UTF-8 位元組不會報錯：表頭無法解碼、字串欄變成 binary 即視為 cp950 檔
+    for encoding in ('utf8', 'cp950'):
+        with open_source() as source:
+            table = pa_csv.read_csv(source, read_options=pa_csv.ReadOptions(encoding=encoding))
+        try:
+            looks_undecoded = any('\ufffd' in name for name in table.column_names) or any(
+                pa.types.is_binary(field.type) for field in table.schema
+            )
+        except UnicodeDecodeError:
+            looks_undecoded = True
+        if not looks_undecoded:
+            break
+    df = table.to_pandas(self_destruct=True, split_blocks=True, date_as_object=False)
+    del table
+    df.columns = df.columns.str.strip()
+    return df
+
+def _ingest_parts(parts, n_files):
+    """
+    parts: [(分檔名稱, bytes 或 伺服器端 CSV 路徑), ...] → {'df': 合併後原始資料, 'ingest': 摘要}
+    - 各分檔以執行緒池平行解析：上傳的 bytes 與伺服器端檔案都交給 Arrow CSV reader（解析時釋放 GIL；
+      沒有 pyarrow 時退回 pandas C parser，此時多個分檔平行的效益有限）
+    - 欄位依 STANDARD_METRIC_COLS 統一後以欄位聯集合併
+    - 多個分檔時移除完全相同的列（依日期 / 活動切分匯出時常有重疊）
+    """
+    t0 = time.perf_counter()
+    if not parts:
+        raise ValueError("檔案中找不到 CSV（壓縮檔內需包含 .csv）。")
+
+    def parse(part):
+        part_name, source = part
+        try:
+            if isinstance(source, str) and source.lower().endswith('.parquet'):
+                df = pd.read_parquet(source)
+                df.columns = df.columns.str.strip()
+            else:
+                df = read_csv_path(source) if isinstance(source, str) else read_csv_bytes(source)
+            return normalize_part_columns(df)
+        except Exception as e:
+            raise ValueError(f"{part_name}：{e}") from e
+
+    if len(parts) == 1:
+        frames = [parse(parts[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=min(INGEST_MAX_WORKERS, len(parts)), thread_name_prefix='ingest') as pool:
+            frames = list(pool.map(parse, parts))
+
+    rows_in = sum(len(f) for f in frames)
+    df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True, sort=False)
+    del frames
+    if len(parts) > 1:
+        df = df.drop_duplicates(ignore_index=True)
+
+    return {
+        'df': df,
+        'ingest': {
+            'files': n_files,
+            'parts': [name for name, _ in parts],
+            'rows_in': rows_in,
+            'duplicates': rows_in - len(df),
+            'seconds': time.perf_counter() - t0,
+        },
+    }
+
+def ingest_uploads(files):
+    """多檔 / 壓縮檔上傳：[(檔名, bytes), ...]"""
+    parts = []
+    for name, data in files:
+        parts.extend(expand_upload_parts(name, data))
+    return _ingest_parts(parts, len(files))
+
+# ------------------------------------------
+# 伺服器端資料夾（不經上傳：大檔直接 memory-map 讀取，不受上傳大小限制）
+# ------------------------------------------
+ADS_DATA_DIR = os.environ.get('ADS_DATA_DIR', '').strip()
+SERVER_EXPORT_SUFFIXES = ('.csv', '.csv.gz', '.zip', '.parquet')
+
+def list_server_exports(data_dir=ADS_DATA_DIR):
+    """列出資料夾內（含子資料夾）可讀的匯出檔：[(相對路徑, 位元組數, 修改時間), ...]，新的在前"""
+    if not data_dir or not os.path.isdir(data_dir):
+        return []
+    found = []
+    for root, dirs, files in os.walk(data_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for fn in files:
+            if fn.startswith('.') or not fn.lower().endswith(SERVER_EXPORT_SUFFIXES):
+                continue
+            full = os.path.join(root, fn)
+            st_ = os.stat(full)
+            found.append((os.path.relpath(full, data_dir), st_.st_size, st_.st_mtime))
+    return sorted(found, key=lambda x: x[2], reverse=True)
+
+def resolve_server_export(rel_path, data_dir=ADS_DATA_DIR):
+    """相對路徑 → 絕對路徑；拒絕跳出資料夾的路徑（../ 或 symlink）"""
+    base = os.path.realpath(data_dir)
+    full = os.path.realpath(os.path.join(base, rel_path))
+    if os.path.commonpath([base, full]) != base or not os.path.isfile(full):
+        raise ValueError(f"不允許的檔案路徑：{rel_path}")
+    return full
+
+def account_name_from_source(name):
+    """檔名（去掉副檔名）作為帳戶識別：用量統計與每日快照共用"""
+    return re.sub(r'(\.csv)?(\.gz|\.zip|\.parquet)?$', '', os.path.basename(name) or 'account', flags=re.I)
+
+def snapshot_account_for_export(rel_path):
+    """伺服器匯出檔 → 每日快照的帳戶鍵：相對路徑（去掉副檔名），不同資料夾的同名檔不會併成同一個帳戶"""
+    stem = re.sub(r'(\.csv)?(\.gz|\.zip|\.parquet)?$', '', os.path.normpath(rel_path), flags=re.I)
+    return stem.replace(os.sep, '/')
+
+def server_exports_signature(rel_paths, data_dir=ADS_DATA_DIR):
+    """伺服器檔案的快取鍵：路徑 + 大小 + 修改時間（不讀內容，大檔不必為了算雜湊多掃一遍）"""
+    sig = []
+    for rel in sorted(rel_paths):
+        st_ = os.stat(resolve_server_export(rel, data_dir))
+        sig.append(f"{rel}:{st_.st_size}:{st_.st_mtime_ns}")
+    return hashlib.sha256('|'.join(sig).encode('utf-8')).hexdigest()
+
+def ingest_server_exports(rel_paths, data_dir=ADS_DATA_DIR):
+    """伺服器資料夾內的檔案：.csv 走 memory-map + Arrow、.parquet 直接讀；.gz / .zip 先解壓再解析"""
+    parts = []
+    for rel in rel_paths:
+        full = resolve_server_export(rel, data_dir)
+        if rel.lower().endswith(('.csv', '.parquet')):
+            parts.append((rel, full))
+        else:
+            with open(full, 'rb') as f:
+                parts.extend(expand_upload_parts(rel, f.read()))
+    return _ingest_parts(parts, len(rel_paths))
+
+PIPELINE_MAX_WORKERS = int(os.environ.get('PIPELINE_MAX_WORKERS', str(min(4, os.cpu_count() or 1))))
+
+def run_task_graph(tasks, max_workers=None):
+    """
+    小型 task graph 執行器
+    - tasks: {名稱: (依賴名稱 tuple, fn(results))}；fn 可讀取 results 內已完成的依賴
+    - 依賴都完成的階段立即送進執行緒池（pandas groupby / 排序大多會釋放 GIL；
+      不用 process pool 是因為每個 process 都要再序列化一份 df_std）
+    - 回傳 (results, timings)：results 以名稱為鍵，與完成先後無關；timings 為各階段秒數與 'wall' 總時間
+    - max_workers <= 1 時依宣告順序逐一執行（方便比較 / 除錯）
+    """
+    workers = PIPELINE_MAX_WORKERS if max_workers is None else int(max_workers)
+    for name, (deps, _) in tasks.items():
+        missing = [d for d in deps if d not in tasks]
+        if missing:
+            raise ValueError(f"task {name} 依賴不存在的階段：{missing}")
+
+    results, timings = {}, {}
+    t_wall = time.perf_counter()
+
+    def run(name):
+        t0 = time.perf_counter()
+        value = tasks[name][1](results)
+        return value, time.perf_counter() - t0
+
+    if workers <= 1:
+        pending = list(tasks)
+        while pending:
+            ready = [n for n in pending if all(d in results for d in tasks[n][0])]
+            if not ready:
+                raise ValueError(f"task graph 有循環依賴：{pending}")
+            for name in ready:
+                results[name], timings[name] = run(name)
+                pending.remove(name)
+        timings['wall'] = time.perf_counter() - t_wall
+        return results, timings
+
+    waiting = dict(tasks)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pipeline') as pool:
+        while waiting or running:
+            for name in [n for n, (deps, _) in waiting.items() if all(d in results for d in deps)]:
+                running[pool.submit(run, name)] = name
+                del waiting[name]
+            if not running:
+                raise ValueError(f"task graph 有循環依賴：{list(waiting)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name], timings[name] = future.result()
+    timings['wall'] = time.perf_counter() - t_wall
+    return results, timings
+
+def cpm_period_tables(bundle, level_label):
+    """CPM 變化表的 ((區間, 表), ...)；第一個為基準期"""
+    idx, _ = CPM_LEVELS[level_label]
+    return (('P7D', bundle['res_p7'][idx][1]), ('PP7D', bundle['res_pp7'][idx][1]), ('P30D', bundle['res_p30'][idx][1]))
+
+def period_frame(bundle, period):
+    """取得 P1D / P7D / PP7D / P30D 的資料：df_std（已依日期排序）上的連續切片，唯讀"""
+    lo, hi = bundle['period_bounds'][period]
+    return bundle['df_std'].iloc[lo:hi]
+
+def report_periods(max_date):
+    """以資料最後一天為基準的分析區間：{'P1D': (起, 迄), ...}（含頭尾，皆為當日 00:00）"""
+    today = max_date + timedelta(days=1)
+    p7d_start = today - timedelta(days=7)
+    return {
+        'P1D': (max_date, max_date),
+        'P7D': (p7d_start, today - timedelta(days=1)),
+        'PP7D': (p7d_start - timedelta(days=7), p7d_start - timedelta(days=1)),
+        'P30D': (today - timedelta(days=30), today - timedelta(days=1)),
+    }
+
+def standardize_frame(df_raw, conversion_col, spend_col, clicks_col, impressions_col):
+    """
+    清洗 → 標準欄名 → 依日期排序（stable，同日保留原順序）→ 廣告名稱_clean
+    df_raw 為共用唯讀物件：清洗結果以新欄位組成，只在最後依日期排序時整份取一次
+    """
+    if '天數' not in df_raw.columns:
+        raise ValueError("錯誤：CSV 檔案中找不到「天數」欄位，請檢查檔案格式。")
+
+    # 數據清洗（轉好的欄位另外放，不改動 df_raw）
+    cleaned = {}
+    for col in [spend_col, clicks_col, impressions_col, conversion_col]:
+        if col in df_raw.columns and col not in cleaned:
+            values = df_raw[col]
+            if values.dtype == 'object' or pd.api.types.is_string_dtype(values):
+                values = values.astype(str).str.replace(',', '', regex=False)
+            cleaned[col] = pd.to_numeric(values, errors='coerce').fillna(0)
+    dates = pd.to_datetime(df_raw['天數'], errors='coerce')
+    cleaned['天數'] = dates
+    hour_col = find_hour_col(df_raw.columns)
+    if hour_col is not None:
+        cleaned['小時'] = map_unique(df_raw[hour_col], parse_hour).astype(np.int8)
+
+    # 丟掉無效日期並依日期排序；之後各區間皆為連續位置區段
+    date_ns = dates.to_numpy(dtype='datetime64[ns]')
+    valid_pos = np.flatnonzero(~np.isnat(date_ns))
+    order = valid_pos[np.argsort(date_ns[valid_pos], kind='stable')]
+
+    df_std = df_raw.assign(**cleaned).take(order)
+    df_std.index = pd.RangeIndex(len(df_std))
+    breakdown_rename = {
+        found: canonical for canonical, found in find_breakdown_cols(df_std.columns).items()
+        if found != canonical and canonical not in df_std.columns
+    }
+    df_std.rename(columns={
+        spend_col: '花費金額 (TWD)',
+        clicks_col: '連結點擊次數',
+        impressions_col: '曝光次數',
+        **breakdown_rename
+    }, inplace=True)
+
+    if df_std.empty:
+        raise ValueError("錯誤：資料經過清洗後為空，請檢查原始檔案是否包含有效的日期與數據。")
+
+    # 廣告名稱_clean 在全量資料上算一次（依不重複名稱），各區間切片直接沿用
+    df_std['廣告名稱_clean'] = map_unique(df_std['廣告名稱'], clean_ad_name)
+    if hour_col is not None and hour_col != '小時':
+        df_std = df_std.drop(columns=[hour_col])
+    return df_std
+
+def collapse_hourly(df_std, conversion_col, trailing_days=INTRADAY_TRAILING_DAYS):
+    """
+    逐小時 df_std（含 小時 欄）→ (逐日 df_std, 盤中用的逐小時資料)
+    - 逐日：依 天數 / 活動 / 組合 / 廣告 / 細分維度 加總，既有的 P1D / P7D… 匯總完全沿用
+    - 逐小時：只留最近 trailing_days + 1 天與必要欄位，名稱欄轉 category 節省記憶體
+    """
+    metrics = list(dict.fromkeys(['花費金額 (TWD)', conversion_col, '連結點擊次數', '曝光次數']))
+    keys = ['天數', '行銷活動名稱', '廣告組合名稱', '廣告名稱', '廣告名稱_clean']
+    keys += [c for c in BREAKDOWN_COLS if c in df_std.columns]
+    daily = df_std.groupby(keys, sort=True, dropna=False)[metrics].sum().reset_index()
+
+    sorted_days = df_std['天數'].to_numpy()
+    since = pd.Timestamp(sorted_days[-1]).normalize() - timedelta(days=trailing_days)
+    lo = int(sorted_days.searchsorted(np.datetime64(since, 'ns'), side='left'))
+    recent = df_std.iloc[lo:]
+    recent = recent[recent['小時'] >= 0]
+    hourly = pd.DataFrame({
+        '天數': recent['天數'].to_numpy(),
+        '小時': recent['小時'].to_numpy(),
+        **{c: pd.Categorical(recent[c]) for c in ['行銷活動名稱', '廣告組合名稱']},
+        **{m: recent[m].to_numpy() for m in metrics},
+    })
+    return daily, hourly
+
+def build_analysis_bundle(df_raw, conversion_col, spend_col, clicks_col, impressions_col, max_workers=None,
+                          snapshot_account=None):
+    """
+    清洗 → 區間切片 → 各層級匯總 → 警示 / CPM / 害群之馬 → excel_stack
+    不呼叫任何 st.*；資料有問題時丟 ValueError（訊息可直接顯示給使用者）
+    snapshot_account：有給時先增量更新 SQLite 每日快照（見 5.11）；檔案涵蓋整個 P30D 時，各區間多層級匯總
+    改由視窗快照讀出（此時與全量匯總相同，結果只取決於檔案內容，可依內容雜湊存入預先計算快取）
+    """
+    t_prepare = time.perf_counter()
+    df_std = standardize_frame(df_raw, conversion_col, spend_col, clicks_col, impressions_col)
+    if snapshot_account is None:
+        return assemble_analysis_bundle(df_std, conversion_col, time.perf_counter() - t_prepare, max_workers)
+
+    # 檔案沒涵蓋整個 P30D（只匯出最近幾天）時，視窗快照會含有檔案以外的歷史 → 不讀快照
+    p30d_start = report_periods(pd.Timestamp(df_std['天數'].iloc[-1]).normalize())['P30D'][0]
+    covers_p30d = bool(df_std['天數'].iloc[0] <= p30d_start)
+    # 視窗在更新快照的同一個交易內讀回：同帳戶另一個檔案同時處理時，也不會讀到它寫入的視窗
+    snapshot = refresh_snapshots(snapshot_account, df_std, conversion_col, read_windows=covers_p30d)
+    window_results = {}
+    if snapshot is not None:
+        snapshot['windows'] = covers_p30d
+        window_results = snapshot.pop('window_results', {})
+
+    def snapshot_tasks(periods):
+        read = lambda window: (lambda r: window_results[window])
+        return {
+            'res_p1': ((), read('P1D')), 'res_p7': ((), read('P7D')),
+            'res_pp7': ((), read('PP7D')), 'res_p30': ((), read('P30D')),
+        }
+    # 快照比此檔新（例如重跑舊檔）或檔案不夠長時，照常全量匯總
+    bundle = assemble_analysis_bundle(
+        df_std, conversion_col, time.perf_counter() - t_prepare, max_workers,
+        snapshot_tasks if snapshot is not None and snapshot['windows'] else None
+    )
+    bundle['snapshot'] = snapshot
+    return bundle
+
+def assemble_analysis_bundle(df_std, conversion_col, prepare_seconds=0.0, max_workers=None, task_overrides=None):
+    """
+    df_std（標準欄名、已依日期排序）→ bundle
+    - 各匯總階段以 run_task_graph 併行；excel_stack 順序固定，與併行與否無關
+    - task_overrides(periods) 可回傳 {階段名稱: (依賴, fn)} 取代預設的 pandas 實作（DuckDB 後端用）
+    """
+    t_slice = time.perf_counter()
+    hourly_df = None
+    if '小時' in df_std.columns:
+        df_std, hourly_df = collapse_hourly(df_std, conversion_col)
+    sorted_days = df_std['天數'].to_numpy()
+    max_date = pd.Timestamp(sorted_days[-1]).normalize()
+    periods = report_periods(max_date)
+
+    period_bounds = {}
+
+    def range_bounds(start, end):
+        lo = int(sorted_days.searchsorted(np.datetime64(start, 'ns'), side='left'))
+        hi = int(sorted_days.searchsorted(np.datetime64(end, 'ns'), side='right'))
+        return lo, hi
+
+    def period_slice(name):
+        """區間內的連續列（二分搜尋位置 + iloc 切片，不掃全表、不複製）"""
+        lo, hi = period_bounds[name] = range_bounds(*periods[name])
+        return df_std.iloc[lo:hi]
+
+    df_p1d = period_slice('P1D')
+    df_p7d = period_slice('P7D')
+    df_pp7d = period_slice('PP7D')
+    df_p30d = period_slice('P30D')
+
+    # 逐小時匯出的最後一天通常還沒結束：每日警示改以最後一個完整日為 P1D、基準也往前一天，
+    # 不拿半天的數字去比整天的 P7D 日均（今天目前為止的表現由盤中警示負責）
+    alert_periods = periods
+    if hourly_df is not None and not hourly_df.empty:
+        last_hour = hourly_df.loc[hourly_df['天數'] == hourly_df['天數'].max(), '小時'].max()
+        if last_hour < 23:
+            alert_periods = report_periods(max_date - timedelta(days=1))
+    df_alert_p1d, df_alert_p7d = df_p1d, df_p7d
+    if alert_periods is not periods:
+        df_alert_p1d = df_std.iloc[slice(*range_bounds(*alert_periods['P1D']))]
+        df_alert_p7d = df_std.iloc[slice(*range_bounds(*alert_periods['P7D']))]
+    prepare_seconds += time.perf_counter() - t_slice
+
+    # 區間只存位置範圍，用 period_frame() 取切片（避免共用倉庫把 view 當成複本計算容量）
+    breakdown_dims = [c for c in BREAKDOWN_COLS if c in df_std.columns]
+    alert_day = alert_periods['P1D'][0]
+    b = {
+        'df_std': df_std, 'max_date': max_date, 'periods': periods, 'period_bounds': period_bounds,
+        'breakdown_dims': breakdown_dims, 'hourly_df': hourly_df, 'alert_day': alert_day,
+    }
+    conv = conversion_col
+    camp = lambda df: calculate_consolidated_metrics(df.groupby('行銷活動名稱'), conv)
+    daily_base = 'camp_p7d' if alert_periods is periods else 'camp_alert_p7d'
+    cpm_level = lambda r, label: build_cpm_change_table(cpm_period_tables(r, label), CPM_LEVELS[label][1])
+
+    # 以下各階段都只讀 df_std 的區間切片，彼此獨立（或只依賴上游結果）→ 交給 task graph 併行
+    tasks = {
+        # 新素材 / 新廣告組合摘要（供 AI 判讀：避免丟全量表造成 token 壓力）
+        'new_creatives_df': ((), lambda r: build_new_creatives_summary(
+            df_p7d=df_p7d, conv_col=conv, anchor_date=max_date, recent_days=14, top_n=15, min_spend=300
+        )),
+        'new_adsets_df': ((), lambda r: build_new_adsets_summary(
+            df_p7d=df_p7d, df_pp7d=df_pp7d, conv_col=conv, top_n=15, min_spend_p7=500, old_spend_threshold=200
+        )),
+        # 害群之馬：P7D 廣告組合 Leave-One-Out
+        'bad_apple_df': ((), lambda r: build_one_bad_apple_table(df_p7d, conv)),
+        # 各區間 Campaign 層級 → 警示與週趨勢
+        'camp_p1d': ((), lambda r: camp(df_alert_p1d)),
+        'camp_p7d': ((), lambda r: camp(df_p7d)),
+        'camp_pp7d': ((), lambda r: camp(df_pp7d)),
+        'alerts_daily': (('camp_p1d', daily_base), lambda r: check_daily_anomalies(r['camp_p1d'], r[daily_base], '行銷活動名稱')),
+        'alerts_weekly': (('camp_p7d', 'camp_pp7d'), lambda r: check_weekly_trends(r['camp_p7d'], r['camp_pp7d'], '行銷活動名稱')),
+        # 逐小時匯出才有：今日已過時段 vs 過去 7 日同時段
+        'alerts_intraday': ((), lambda r: check_intraday_anomalies(hourly_df, conv)),
+        # 各區間多層級匯總
+        'res_p1': ((), lambda r: collect_period_results(df_p1d, 'P1D', conv)),
+        'res_p7': ((), lambda r: collect_period_results(df_p7d, 'P7D', conv)),
+        'res_pp7': ((), lambda r: collect_period_results(df_pp7d, 'PP7D', conv)),
+        'res_p30': ((), lambda r: collect_period_results(df_p30d, 'P30D', conv)),
+        # 30 日帳戶趨勢
+        'trend_30d_df': ((), lambda r: get_trend_data_excel(df_p30d, conv)),
+        # CPM 變化表（行銷活動 / 廣告組合層級）
+        'cpm_change_df': (('res_p7', 'res_pp7', 'res_p30'), lambda r: cpm_level(r, '行銷活動 (Campaign)')),
+        'cpm_change_adset_df': (('res_p7', 'res_pp7', 'res_p30'), lambda r: cpm_level(r, '廣告組合 (AdSet)')),
+        # P30D 稀疏立方體：儀表板與細分維度下鑽都從這裡 roll-up
+        'breakdown_cube': ((), lambda r: build_breakdown_cube(df_p30d, conv, breakdown_dims)),
+        # 預算重分配：廣告組合反應曲線（P30D 立方體）→ 預設調整上限下的最適分配；同樣只用到最後完整日
+        'budget_curves_df': (('breakdown_cube',), lambda r: fit_adset_response_curves(r['breakdown_cube'], periods, alert_day)),
+        'budget_plan_df': (('budget_curves_df',), lambda r: optimize_budget_allocation(r['budget_curves_df'])),
+        # 月底花費 / 轉換預估（全帳戶 / 活動 / 組合）：序列只到最後完整日，未結束的半天由預估補上
+        'forecast_df': (('breakdown_cube',), lambda r: build_forecast_table(r['breakdown_cube'], periods, alert_day)),
+    }
+    if daily_base != 'camp_p7d':
+        tasks[daily_base] = ((), lambda r: camp(df_alert_p7d))
+    if task_overrides is not None:
+        tasks.update(task_overrides(periods))
+    results, timings = run_task_graph(tasks, max_workers=max_workers)
+    for key in tasks:
+        if not key.startswith('camp_'):
+            b[key] = results[key]
+    timings['prepare'] = prepare_seconds
+    b['stage_timings'] = timings
+
+    # 下載用的堆疊表（沒做 AI 也能下載）
+    excel_stack = [('Trend_Daily_30D', b['trend_30d_df'])]
+    if b['cpm_change_df'] is not None and not b['cpm_change_df'].empty:
+        excel_stack.append(('CPM_Change_P7D_PP7D_P30D', b['cpm_change_df']))
+    if b['cpm_change_adset_df'] is not None and not b['cpm_change_adset_df'].empty:
+        excel_stack.append(('CPM_Change_AdSet_P7D_PP7D_P30D', b['cpm_change_adset_df']))
+    if b['bad_apple_df'] is not None and not b['bad_apple_df'].empty:
+        excel_stack.append(('One_Bad_Apple_P7D', b['bad_apple_df']))
+    if not b['budget_plan_df'].empty:
+        excel_stack.append(('Budget_Reallocation_P30D_Curves', b['budget_plan_df']))
+    if not b['forecast_df'].empty:
+        excel_stack.append((f"Forecast_MonthEnd_{b['forecast_df'].attrs['month']}", b['forecast_df']))
+    if not b['alerts_intraday'].empty:
+        excel_stack.append(('Intraday_Alerts', b['alerts_intraday']))
+    excel_stack.extend(b['res_p1'])
+    excel_stack.extend(b['res_p7'])
+    excel_stack.extend(b['res_pp7'])
+    excel_stack.extend(b['res_p30'])
+    b['excel_stack'] = excel_stack
+    return b
+
+def estimate_nbytes(obj, _seen=None):
+    """估算物件佔用記憶體（DataFrame 以 deep memory_usage 計；同一物件只算一次）"""
+    seen = set() if _seen is None else _seen
+    if obj is None or id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if hasattr(obj, 'estimated_nbytes'):
+        return int(obj.estimated_nbytes())
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(index=True, deep=True))
+    if isinstance(obj, (bytes, bytearray, str)):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(estimate_nbytes(v, seen) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(estimate_nbytes(v, seen) for v in obj)
+    return 0
+
+class DatasetStore:
+    """
+    process 內共用的資料集倉庫
+    - key → {value, nbytes, refs（引用中的 session id）, last_access}
+    - 同一個 key 同時只建構一次，其他 session 等待同一份結果
+    - 總量超過上限時依 LRU 淘汰：先淘汰沒有 session 引用的，再淘汰閒置過久的
+      （Streamlit 沒有 session 結束通知，關掉分頁的 session 靠閒置時間回收）
+    - 被淘汰的 key 仍被 session 持有時，下次 rerun 會依原始上傳檔重建
+    - 衍生資料（例如結果表的檢視索引）可掛在 parent key 底下：parent 被淘汰時一併淘汰
+    """
+    def __init__(self, max_bytes, idle_seconds):
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self._entries = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+        self._counters = {'hits': 0, 'builds': 0, 'evictions': 0}
+
+    def get_or_build(self, key, builder, session_id=None, parent=None):
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry['last_access'] = time.time()
+                    if session_id:
+                        entry['refs'].add(session_id)
+                    self._counters['hits'] += 1
+                    return entry['value']
+                pending = self._building.get(key)
+                if pending is None:
+                    pending = self._building[key] = threading.Event()
+                    break
+            # 其他 session 正在建構同一份資料：等它完成後重新查詢（失敗的話改由自己建構）
+            pending.wait()
+
+        try:
+            value = builder()
+        except BaseException:
+            with self._lock:
+                self._building.pop(key, None)
+            pending.set()
+            raise
+
+        nbytes = estimate_nbytes(value)
+        with self._lock:
+            self._entries[key] = {
+                'value': value,
+                'nbytes': nbytes,
+                'refs': {session_id} if session_id else set(),
+                'last_access': time.time(),
+                'parent': parent,
+            }
+            self._building.pop(key, None)
+            self._counters['builds'] += 1
+            self._evict_locked(protect=key)
+        pending.set()
+        return value
+
+    def release(self, key, session_id):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['refs'].discard(session_id)
+            self._evict_locked()
+
+    def refresh_nbytes(self, key):
+        """值建好之後又長大（例如索引補上排序名次快取）：重新估算大小，必要時淘汰"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry['nbytes'] = estimate_nbytes(entry['value'])
+            self._evict_locked(protect=key)
+
+    def _drop_locked(self, key, protect=None):
+        """移除 key 與掛在它底下的衍生資料（protect 除外），回傳釋放的 bytes"""
+        entry = self._entries.pop(key)
+        self._counters['evictions'] += 1
+        freed = entry['nbytes']
+        for child in [k for k, e in self._entries.items() if e['parent'] == key and k != protect]:
+            if child in self._entries:
+                freed += self._drop_locked(child, protect)
+        return freed
+
+    def _evict_locked(self, protect=None):
+        total = sum(e['nbytes'] for e in self._entries.values())
+        if total <= self.max_bytes:
+            return
+        now = time.time()
+        # 第一輪：沒有引用者；第二輪：閒置超過 idle_seconds（皆依最久未使用優先）
+        for only_unreferenced in (True, False):
+            for key in list(self._entries):
+                if total <= self.max_bytes:
+                    return
+                if key == protect or key not in self._entries:   # 已隨 parent 一起淘汰
+                    continue
+                entry = self._entries[key]
+                if only_unreferenced and entry['refs']:
+                    continue
+                if not only_unreferenced and now - entry['last_access'] < self.idle_seconds:
+                    continue
+                total -= self._drop_locked(key, protect)
+
+    def stats(self):
+        with self._lock:
+            sessions = set()
+            for e in self._entries.values():
+                sessions |= e['refs']
+            return {
+                'entries': len(self._entries),
+                'total_mb': sum(e['nbytes'] for e in self._entries.values()) / 1024 ** 2,
+                'max_mb': self.max_bytes / 1024 ** 2,
+                'sessions': len(sessions),
+                **self._counters,
+            }
+
+@st.cache_resource
+def get_dataset_store():
+    """整個 process 共用一個資料集倉庫"""
+    return DatasetStore(DATASET_STORE_MAX_MB * 1024 ** 2, DATASET_STORE_IDLE_SECONDS)
+
+def get_session_uid():
+    if 'session_uid' not in st.session_state:
+        st.session_state['session_uid'] = uuid.uuid4().hex
+    return st.session_state['session_uid']
+
+def acquire_dataset(slot, key, builder, parent=None):
+    """
+    從共用倉庫取得資料（不存在則建構），並把 key 登記為本 session 在 slot 上的 handle；
+    同一個 slot 換成新 key 時釋放舊 key 的引用；parent：掛在哪個 key 底下（隨它一起淘汰）
+    """
+    store = get_dataset_store()
+    sid = get_session_uid()
+    handles = st.session_state.setdefault('dataset_handles', {})
+    value = store.get_or_build(key, builder, sid, parent)
+    old_key = handles.get(slot)
+    if old_key is not None and old_key != key:
+        store.release(old_key, sid)
+    handles[slot] = key
+    return value
+
+def uploaded_files_digest(uploaded_files):
+    """
+    多個上傳檔的內容雜湊（與上傳順序無關）；同一批上傳物件在 session 內只計算一次
+    """
+    file_ids = tuple(getattr(f, 'file_id', None) for f in uploaded_files)
+    memo = st.session_state.get('upload_digest')
+    if memo and None not in file_ids and memo[0] == file_ids:
+        return memo[1]
+    part_digests = sorted(hashlib.sha256(f.getvalue()).hexdigest() for f in uploaded_files)
+    digest = part_digests[0] if len(part_digests) == 1 else hashlib.sha256('|'.join(part_digests).encode()).hexdigest()
+    st.session_state['upload_digest'] = (file_ids, digest)
+    return digest
+
+# ==========================================
+# 5.7 詳細數據表：伺服器端分頁 / 排序 / 名稱篩選
+# ==========================================
+# 結果表（例如 P30D 詳細層級可達數萬列）不整份送到瀏覽器：篩選、排序、切頁都在伺服器端完成，
+# 每次互動只序列化目前這一頁
+TABLE_NAME_COLS = ('行銷活動名稱', '廣告組合名稱', '廣告名稱', '廣告名稱_clean')
+TABLE_PAGE_SIZES = [25, 50, 100, 200]
+
+class TableIndex:
+    """
+    單一結果表的檢視索引（建立一次，跨 session 共用）
+    - 名稱字元倒排索引：字元 → 含該字元的列位置；查詢時先取交集縮小候選，再做子字串確認
+    - 各欄排序名次快取（第一次以該欄排序時才計算）
+    - 「全帳戶平均」統計列不參與篩選 / 排序，固定顯示在每頁最上方
+    - 只存列位置，不持有原表：rank() / view() / page() 由呼叫端傳入同一張表（bundle 被淘汰時原表才能釋放）
+    """
+    def __init__(self, df):
+        non_numeric = df.select_dtypes(exclude=[np.number]).columns
+        if len(non_numeric) > 0:
+            is_summary = (df[non_numeric[0]] == '全帳戶平均').to_numpy(dtype=bool)
+        else:
+            is_summary = np.zeros(len(df), dtype=bool)
+        self.summary_pos = np.flatnonzero(is_summary)
+        self.body_pos = np.flatnonzero(~is_summary)
+
+        name_cols = [c for c in TABLE_NAME_COLS if c in df.columns]
+        body = df.iloc[self.body_pos]
+        if name_cols:
+            keys = body[name_cols[0]].astype(str)
+            for col in name_cols[1:]:
+                keys = keys + ' / ' + body[col].astype(str)
+            self.keys = keys.str.lower().to_numpy(dtype=object)
+        else:
+            self.keys = np.array([''] * len(body), dtype=object)
+
+        postings = {}
+        for i, key in enumerate(self.keys):
+            for ch in set(key):
+                postings.setdefault(ch, []).append(i)
+        self.postings = {ch: np.asarray(pos, dtype=np.int32) for ch, pos in postings.items()}
+        self._ranks = {}
+        self._base_nbytes = (
+            sum(len(k) for k in self.keys) + self.keys.nbytes
+            + self.summary_pos.nbytes + self.body_pos.nbytes
+            + sum(p.nbytes for p in self.postings.values())
+        )
+
+    def estimated_nbytes(self):
+        """索引本身的大小（含之後補上的排序名次；原表屬於 bundle，不重複計入）"""
+        return self._base_nbytes + sum(r.nbytes for r in list(self._ranks.values()))
+
+    def _search_term(self, term):
+        cand = None
+        for ch in sorted(set(term), key=lambda c: len(self.postings.get(c, ()))):
+            pos = self.postings.get(ch)
+            if pos is None:
+                return np.empty(0, dtype=np.int32)
+            cand = pos if cand is None else np.intersect1d(cand, pos, assume_unique=True)
+            if len(cand) == 0:
+                return cand
+        keys = self.keys
+        return cand[np.fromiter((term in keys[i] for i in cand), dtype=bool, count=len(cand))]
+
+    def search(self, query):
+        """空白分隔的多個關鍵字皆須出現（不分大小寫）；回傳 body 內的位置"""
+        hits = None
+        for term in str(query or '').lower().split():
+            found = self._search_term(term)
+            hits = found if hits is None else np.intersect1d(hits, found, assume_unique=True)
+        return np.arange(len(self.keys)) if hits is None else hits
+
+    def rank(self, df, col, ascending=True):
+        """各列在該欄排序後的名次（NaN 排最後）"""
+        cache_key = (col, bool(ascending))
+        if cache_key not in self._ranks:
+            values = df[col].iloc[self.body_pos].reset_index(drop=True)
+            order = values.sort_values(ascending=ascending, kind='stable', na_position='last').index.to_numpy()
+            ranks = np.empty(len(order), dtype=np.int64)
+            ranks[order] = np.arange(len(order))
+            self._ranks[cache_key] = ranks
+        return self._ranks[cache_key]
+
+    def view(self, df, query='', sort_col=None, ascending=True):
+        """篩選 + 排序後的 body 位置（尚未分頁）"""
+        hits = self.search(query)
+        if sort_col is not None and sort_col in df.columns:
+            hits = hits[np.argsort(self.rank(df, sort_col, ascending)[hits], kind='stable')]
+        return hits
+
+    def page(self, df, hits, page, page_size):
+        """取出第 page 頁（1 起算）；統計列固定在最上方"""
+        sel = hits[(page - 1) * page_size: page * page_size]
+        return df.iloc[np.concatenate([self.summary_pos, self.body_pos[sel]])]
+
+def table_index_key(table_name, dataset_key):
+    return ('table_index',) + tuple(dataset_key) + (table_name,)
+
+def get_table_index(table_name, df, dataset_key, slot):
+    """
+    結果表的檢視索引，依 (資料集, 表名) 存在共用倉庫、掛在資料集（bundle）底下隨它一起淘汰
+    slot 以表格元件區分：下鑽換條件時釋放前一個條件的索引，不會在 session 內越積越多
+    """
+    return acquire_dataset(slot, table_index_key(table_name, dataset_key), lambda: TableIndex(df), parent=tuple(dataset_key))
+
+def render_paged_table(df, table_name, dataset_key, widget_key):
+    """伺服器端分頁表格：名稱篩選 / 排序 / 每頁筆數 / 頁碼，只把目前頁送到瀏覽器"""
+    if df is None or df.empty:
+        st.info("此區間沒有資料。")
+        return
+    index = get_table_index(table_name, df, dataset_key, f'index:{widget_key}')
+    page_key = f"{widget_key}_page"
+
+    def reset_page():
+        st.session_state[page_key] = 1
+
+    c1, c2, c3, c4 = st.columns([3, 2, 1, 1])
+    query = c1.text_input(
+        "🔎 名稱篩選（活動 / 組合 / 廣告，空白分隔多個關鍵字）", key=f"{widget_key}_q", on_change=reset_page
+    )
+    sort_col = c2.selectbox(
+        "排序欄位", ['（預設：花費由高到低）'] + list(df.columns), key=f"{widget_key}_sort", on_change=reset_page
+    )
+    ascending = c3.checkbox("遞增排序", value=False, key=f"{widget_key}_asc", on_change=reset_page)
+    page_size = c4.selectbox("每頁筆數", TABLE_PAGE_SIZES, index=1, key=f"{widget_key}_size", on_change=reset_page)
+
+    hits = index.view(df, query, None if sort_col not in df.columns else sort_col, ascending)
+    if sort_col in df.columns:
+        get_dataset_store().refresh_nbytes(table_index_key(table_name, dataset_key))   # 排序名次快取可能剛長大
+    n_pages = max(1, -(-len(hits) // page_size))
+    if st.session_state.get(page_key, 1) > n_pages:
+        st.session_state[page_key] = n_pages
+    page = st.number_input(f"頁碼（共 {n_pages} 頁）", min_value=1, max_value=n_pages, step=1, key=page_key)
+
+    st.dataframe(index.page(df, hits, int(page), page_size), use_container_width=True, hide_index=True)
+    filtered = f"，篩選後 {len(hits):,} 列" if str(query).strip() else ""
+    st.caption(f"共 {len(index.body_pos):,} 列{filtered} · 第 {int(page)} / {n_pages} 頁 · 每頁 {page_size} 列")
+
+# ==========================================
+# 5.8 DuckDB 後端（選用）：超長歷史直接以 SQL 查詢伺服器端檔案
+# ==========================================
+# 分析只用到最近 30 天：DuckDB 先在檔案上篩出 P30D 視窗（Parquet 可用統計值跳過舊資料），
+# 各層級匯總 / 30 日趨勢 / 新廣告組合都在視窗表上以 SQL 計算，pandas 只載入視窗內的列
+# → 記憶體只跟「30 天的資料量」有關，與歷史長度無關；DuckDB 預設使用所有核心，超過上限時溢寫到磁碟
+ANALYSIS_BACKEND = os.environ.get('ANALYSIS_BACKEND', 'pandas').strip().lower()
+DUCKDB_MEMORY_LIMIT = os.environ.get('DUCKDB_MEMORY_LIMIT', '2GB')
+DUCKDB_THREADS = int(os.environ.get('DUCKDB_THREADS', '0'))  # 0 = 所有核心
+DUCKDB_TEMP_DIR = os.environ.get('DUCKDB_TEMP_DIR', os.path.join('.ads_cache', 'duckdb_tmp'))
+DUCKDB_SUFFIXES = ('.csv', '.csv.gz', '.parquet')
+
+def _sql_ident(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def _sql_str(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+def duckdb_connect():
+    con = duckdb.connect(database=':memory:')
+    os.makedirs(DUCKDB_TEMP_DIR, exist_ok=True)
+    con.execute(f"SET memory_limit = {_sql_str(DUCKDB_MEMORY_LIMIT)}")
+    con.execute(f"SET temp_directory = {_sql_str(DUCKDB_TEMP_DIR)}")
+    if DUCKDB_THREADS > 0:
+        con.execute(f"SET threads = {DUCKDB_THREADS}")
+    # 不需保留檔案列順序，讓大查詢可以併行 / 溢寫
+    con.execute("SET preserve_insertion_order = false")
+    return con
+
+def duckdb_source_sql(paths):
+    """檔案清單 → FROM 來源（CSV 一律以字串讀入，清洗在 SQL 中做；Parquet 保留原型別）"""
+    files = '[' + ', '.join(_sql_str(p) for p in paths) + ']'
+    is_parquet = [p.lower().endswith('.parquet') for p in paths]
+    if all(is_parquet):
+        return f"read_parquet({files}, union_by_name = true)"
+    if any(is_parquet):
+        raise ValueError("DuckDB 模式不支援同時混用 CSV 與 Parquet，請分開分析。")
+    return f"read_csv({files}, header = true, all_varchar = true, union_by_name = true)"
+
+def describe_duckdb_sources(rel_paths, data_dir=ADS_DATA_DIR):
+    """
+    只讀表頭 / schema（不掃資料），作為 DuckDB 模式的 raw 項目
+    columns 為去除前後空白後的欄名（與 pandas 路徑相同），source_columns 對應回檔案內原始欄名與型別
+    """
+    unsupported = [r for r in rel_paths if not r.lower().endswith(DUCKDB_SUFFIXES)]
+    if unsupported:
+        raise ValueError(f"DuckDB 模式只支援 CSV / .csv.gz / Parquet：{unsupported}")
+    paths = [resolve_server_export(r, data_dir) for r in rel_paths]
+    con = duckdb_connect()
+    try:
+        schema = con.execute(f"DESCRIBE SELECT * FROM {duckdb_source_sql(paths)}").fetchall()
+    except duckdb.Error as e:
+        raise ValueError(f"DuckDB 無法讀取檔案（CSV 需為 UTF-8；cp950 檔請關閉 DuckDB 模式）：{e}") from e
+    finally:
+        con.close()
+    source_columns = {str(name).strip(): (name, str(col_type)) for name, col_type, *_ in schema}
+    return {
+        'df': None,
+        'columns': list(source_columns),
+        'source_columns': source_columns,
+        'paths': paths,
+        'ingest': {'files': len(rel_paths), 'parts': list(rel_paths), 'rows_in': None, 'duplicates': None, 'seconds': 0.0},
+    }
+
+def _duckdb_standard_view_sql(source, source_columns, conversion_col, spend_col, clicks_col, impressions_col, dedup):
+    """標準欄名的 SQL 視圖：數值欄去千分位轉 DOUBLE（無法轉換視為 0）、日期轉 TIMESTAMP、廣告名稱_clean"""
+    def col(name):
+        if name not in source_columns:
+            raise ValueError(f"錯誤：檔案中找不到「{name}」欄位，請檢查檔案格式。")
+        return _sql_ident(source_columns[name][0])
+
+    def num(name):
+        if name not in source_columns:
+            return "0"
+        if source_columns[name][1].upper() == 'VARCHAR':
+            return f"COALESCE(TRY_CAST(REPLACE({col(name)}, ',', '') AS DOUBLE), 0)"
+        return f"COALESCE(TRY_CAST({col(name)} AS DOUBLE), 0)"
+
+    day = col('天數')
+    day_expr = f"COALESCE(TRY_CAST({day} AS TIMESTAMP), TRY_STRPTIME(CAST({day} AS VARCHAR), '%Y/%m/%d'))"
+    ad = f"CAST({col('廣告名稱')} AS VARCHAR)"
+    select = ',\n'.join([
+        f"{day_expr} AS \"天數\"",
+        f"CAST({col('行銷活動名稱')} AS VARCHAR) AS \"行銷活動名稱\"",
+        f"CAST({col('廣告組合名稱')} AS VARCHAR) AS \"廣告組合名稱\"",
+        f"{ad} AS \"廣告名稱\"",
+        f"{num(spend_col)} AS \"花費金額 (TWD)\"",
+        f"{num(clicks_col)} AS \"連結點擊次數\"",
+        f"{num(impressions_col)} AS \"曝光次數\"",
+        f"{num(conversion_col)} AS {_sql_ident(conversion_col)}",
+        f"TRIM(REGEXP_REPLACE({ad}, ' - 複本.*$', '')) AS \"廣告名稱_clean\"",
+    ] + [
+        f"CAST({col(found)} AS VARCHAR) AS {_sql_ident(canonical)}"
+        for canonical, found in find_breakdown_cols(list(source_columns)).items()
+    ])
+    src = f"(SELECT DISTINCT * FROM {source})" if dedup else source
+    return f"SELECT * FROM (SELECT {select} FROM {src}) WHERE \"天數\" IS NOT NULL"
+
+def _restore_integer_columns(df, cols):
+    """SQL SUM 一律回傳浮點；值全為整數的欄位轉回 int64，與 pandas 後端同型別"""
+    for c in cols:
+        if c in df.columns and df[c].dtype.kind == 'f':
+            v = df[c].to_numpy()
+            if np.isfinite(v).all() and (v == np.floor(v)).all():
+                df[c] = v.astype(np.int64)
+    return df
+
+def duckdb_aggregate(con, keys, conv_col, start, end, table='win'):
+    """區間 [start, end] 依 keys 加總 花費 / 轉換 / 點擊 / 曝光（鍵為 NULL 的列與 pandas groupby 一樣排除；FSUM 為補償求和，與 pandas 一致）"""
+    metrics = ['花費金額 (TWD)', conv_col, '連結點擊次數', '曝光次數']
+    key_sql = ', '.join(_sql_ident(k) for k in keys)
+    sums = ', '.join(f"FSUM({_sql_ident(m)}) AS {_sql_ident(m)}" for m in metrics)
+    not_null = ''.join(f" AND {_sql_ident(k)} IS NOT NULL" for k in keys)
+    df = con.execute(
+        f"SELECT {key_sql}, {sums} FROM {table} WHERE \"天數\" BETWEEN ? AND ?{not_null} "
+        f"GROUP BY {key_sql} ORDER BY {key_sql}",
+        [pd.Timestamp(start).to_pydatetime(), pd.Timestamp(end).to_pydatetime()]
+    ).df()
+    return _restore_integer_columns(df, metrics)
+
+def collect_period_results_duckdb(con, start, end, period_name_short, conv_col):
+    """collect_period_results 的 SQL 版：同樣 4 個層級、同樣表名與欄位"""
+    levels = [
+        (f'{period_name_short}_Detail_詳細(組合+廣告)', ['行銷活動名稱', '廣告組合名稱', '廣告名稱']),
+        (f'{period_name_short}_Ad_廣告', ['廣告名稱_clean']),
+        (f'{period_name_short}_AdSet_廣告組合', ['行銷活動名稱', '廣告組合名稱']),
+        (f'{period_name_short}_Campaign_行銷活動', ['行銷活動名稱']),
+    ]
+    return [
+        (name, finalize_consolidated_metrics(duckdb_aggregate(con, keys, conv_col, start, end), conv_col))
+        for name, keys in levels
+    ]
+
+def get_trend_data_duckdb(con, start, end, conv_col):
+    """get_trend_data_excel 的 SQL 版"""
+    acc_daily = duckdb_aggregate(con, ['天數'], conv_col, start, end)
+    return finalize_trend_data(acc_daily, conv_col)
+
+def build_new_adsets_summary_duckdb(con, periods, conv_col, top_n=15, min_spend_p7=500, old_spend_threshold=200):
+    """build_new_adsets_summary 的 SQL 版"""
+    keys = ['行銷活動名稱', '廣告組合名稱']
+    p7 = duckdb_aggregate(con, keys, conv_col, *periods['P7D'])
+    if p7.empty:
+        return pd.DataFrame()
+    pp7 = duckdb_aggregate(con, keys, conv_col, *periods['PP7D'])
+    return summarize_new_adsets(
+        p7.rename(columns={conv_col: '轉換'}), pp7.rename(columns={conv_col: '轉換'}),
+        top_n, min_spend_p7, old_spend_threshold
+    )
+
+def build_analysis_bundle_duckdb(raw, conversion_col, spend_col, clicks_col, impressions_col, max_workers=None):
+    """
+    DuckDB 後端的 bundle（輸出格式與 build_analysis_bundle 相同）
+    1) 檔案 → 標準化 SQL 視圖 → 取最後一天
+    2) 只把 P30D 視窗寫成 DuckDB 表（超過 memory_limit 時溢寫到 DUCKDB_TEMP_DIR）
+    3) 各區間多層級匯總 / 30 日趨勢 / 新廣告組合以 SQL 計算；其餘階段在 pandas 視窗資料上計算
+    """
+    t_prepare = time.perf_counter()
+    con = duckdb_connect()
+    # DuckDB 連線不可跨執行緒同時使用：SQL 階段各自開 cursor，並以鎖串行送出（每個查詢內部已用滿所有核心）
+    sql_lock = threading.Lock()
+    try:
+        view_sql = _duckdb_standard_view_sql(
+            duckdb_source_sql(raw['paths']), raw['source_columns'],
+            conversion_col, spend_col, clicks_col, impressions_col, dedup=len(raw['paths']) > 1
+        )
+        con.execute(f"CREATE VIEW ads AS {view_sql}")
+        max_day = con.execute('SELECT MAX("天數") FROM ads').fetchone()[0]
+        if max_day is None:
+            raise ValueError("錯誤：資料經過清洗後為空，請檢查原始檔案是否包含有效的日期與數據。")
+        periods = report_periods(pd.Timestamp(max_day).normalize())
+        window_start = min(start for start, _ in periods.values())
+        con.execute(
+            'CREATE TABLE win AS SELECT * FROM ads WHERE "天數" >= ?',
+            [pd.Timestamp(window_start).to_pydatetime()]
+        )
+        df_std = con.execute('SELECT * FROM win ORDER BY "天數"').df()
+        df_std = _restore_integer_columns(df_std, ['花費金額 (TWD)', conversion_col, '連結點擊次數', '曝光次數'])
+        prepare_seconds = time.perf_counter() - t_prepare
+
+        def sql_task(fn, *args):
+            def run(_results):
+                with sql_lock:
+                    cur = con.cursor()
+                    try:
+                        return fn(cur, *args)
+                    finally:
+                        cur.close()
+            return ((), run)
+
+        def overrides(p):
+            return {
+                'res_p1': sql_task(collect_period_results_duckdb, *p['P1D'], 'P1D', conversion_col),
+                'res_p7': sql_task(collect_period_results_duckdb, *p['P7D'], 'P7D', conversion_col),
+                'res_pp7': sql_task(collect_period_results_duckdb, *p['PP7D'], 'PP7D', conversion_col),
+                'res_p30': sql_task(collect_period_results_duckdb, *p['P30D'], 'P30D', conversion_col),
+                'trend_30d_df': sql_task(get_trend_data_duckdb, *p['P30D'], conversion_col),
+                'new_adsets_df': sql_task(build_new_adsets_summary_duckdb, p, conversion_col),
+            }
+
+        bundle = assemble_analysis_bundle(df_std, conversion_col, prepare_seconds, max_workers, overrides)
+    finally:
+        con.close()
+    bundle['backend'] = 'duckdb'
+    return bundle
+
+# ==========================================
+# 5.9 細分維度（年齡 / 性別 / 版位 / 平台…）：P30D 稀疏 N 維立方體
+# ==========================================
+# 含細分維度的匯出檔列數是一般匯出的 10～50 倍：在 P30D 視窗上先彙總一次成「只存有資料格子」的立方體
+# （各維度以 int32 代碼存放 + 4 個加總指標），任何 層級 × 細分維度 × 區間 的匯總都從立方體 roll-up，
+# 不再回頭 groupby 原始列
+CUBE_ENTITY_DIMS = ['天數', '行銷活動名稱', '廣告組合名稱', '廣告名稱']
+CUBE_ROLLUP_CACHE_SIZE = 64
+# 細分維度下鑽可選的層級 → 立方體維度
+BREAKDOWN_LEVELS = {
+    '全帳戶': [],
+    '行銷活動': ['行銷活動名稱'],
+    '廣告組合': ['行銷活動名稱', '廣告組合名稱'],
+    '廣告': ['廣告名稱_clean'],
+}
+
+def _combine_codes(code_arrays):
+    """多個維度代碼 → 單一格子代碼（逐維重新編碼，值域不超過列數，不會溢位）"""
+    key = np.zeros(len(code_arrays[0]), dtype=np.int64) if code_arrays else np.zeros(0, dtype=np.int64)
+    for codes in code_arrays:
+        key = key * (int(codes.max()) + 1 if len(codes) else 1) + codes
+        key = pd.factorize(key)[0].astype(np.int64)
+    return key
+
+class BreakdownCube:
+    """
+    稀疏 N 維立方體：維度為 天數 / 行銷活動 / 廣告組合 / 廣告 / 各細分維度，另可取衍生維度 廣告名稱_clean
+    rollup() 回傳與 groupby(...).agg(sum).reset_index() 同格式的表（鍵為 NaN 的格子同樣排除），結果有 LRU 快取
+    """
+    def __init__(self, df, conv_col, breakdown_dims):
+        self.conv_col = conv_col
+        self.metrics = ['花費金額 (TWD)', conv_col, '連結點擊次數', '曝光次數']
+        self.breakdown_dims = list(breakdown_dims)
+        self.dims = CUBE_ENTITY_DIMS + self.breakdown_dims
+        self.source_rows = len(df)
+
+        row_codes, self.labels = [], {}
+        for d in self.dims:
+            codes, uniques = pd.factorize(df[d], use_na_sentinel=False)
+            row_codes.append(codes.astype(np.int64))
+            self.labels[d] = pd.Index(uniques)
+        cell = _combine_codes(row_codes)
+        _, first = np.unique(cell, return_index=True)
+        self.codes = {d: c[first].astype(np.int32) for d, c in zip(self.dims, row_codes)}
+        # 加總用 pandas groupby（與原始列 groupby 同樣是補償求和，避免四捨五入邊界值出現 0.01 的差異）
+        self.values = df[self.metrics].astype(np.float64).groupby(cell).sum().to_numpy()
+        self._int_metrics = [m for m in self.metrics if df[m].dtype.kind in 'iu']
+        self._days = self.labels['天數'].to_numpy(dtype='datetime64[ns]')[self.codes['天數']]
+
+        # 衍生維度：廣告名稱_clean 由 廣告名稱 的不重複值對應，不另存一份代碼
+        clean_codes, clean_labels = pd.factorize(
+            map_unique(pd.Series(self.labels['廣告名稱']), clean_ad_name), use_na_sentinel=False
+        )
+        self._clean_map = clean_codes.astype(np.int32)
+        self.labels['廣告名稱_clean'] = pd.Index(clean_labels)
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def n_cells(self):
+        return len(self.values)
+
+    def estimated_nbytes(self):
+        n = self.values.nbytes + self._days.nbytes + self._clean_map.nbytes
+        n += sum(c.nbytes for c in self.codes.values())
+        n += sum(int(idx.memory_usage(deep=True)) for idx in self.labels.values())
+        with self._lock:
+            n += sum(int(df.memory_usage(deep=True).sum()) for df in self._cache.values())
+        return n
+
+    def dim_codes(self, dim):
+        if dim == '廣告名稱_clean':
+            return self._clean_map[self.codes['廣告名稱']]
+        return self.codes[dim]
+
+    def _na_code(self, dim):
+        na = np.flatnonzero(pd.isna(self.labels[dim]))
+        return int(na[0]) if len(na) else -1
+
+    def values_of(self, dim):
+        """某維度的所有值（不含 NaN），依名稱排序"""
+        return sorted(x for x in self.labels[dim] if pd.notna(x))
+
+    def rollup(self, dims, start=None, end=None, filters=None):
+        """
+        依 dims 加總 [start, end]（含頭尾）內的格子；filters = {維度: [允許的值, ...]}
+        回傳 DataFrame：dims 欄 + 花費 / 轉換 / 點擊 / 曝光，依 dims 排序（與 groupby 相同）
+        """
+        dims = list(dims)
+        filters = {d: tuple(v) for d, v in (filters or {}).items()}
+        cache_key = (tuple(dims), start, end, tuple(sorted(filters.items())))
+        with self._lock:
+            if cache_key in self._cache:
+                self._cache.move_to_end(cache_key)
+                return self._cache[cache_key]
+
+        mask = np.ones(self.n_cells, dtype=bool)
+        if start is not None:
+            mask &= self._days >= np.datetime64(pd.Timestamp(start), 'ns')
+        if end is not None:
+            mask &= self._days <= np.datetime64(pd.Timestamp(end), 'ns')
+        for d, allowed in filters.items():
+            mask &= np.isin(self.dim_codes(d), np.flatnonzero(self.labels[d].isin(allowed)))
+        for d in dims:
+            na = self._na_code(d)
+            if na >= 0:
+                mask &= self.dim_codes(d) != na
+
+        sel = np.flatnonzero(mask)
+        dim_codes = [self.dim_codes(d)[sel].astype(np.int64) for d in dims]
+        group = _combine_codes(dim_codes) if dims else np.zeros(len(sel), dtype=np.int64)
+        _, first = np.unique(group, return_index=True)
+        summed = pd.DataFrame(self.values[sel]).groupby(group).sum().to_numpy()
+
+        out = pd.DataFrame({d: self.labels[d].take(c[first]) for d, c in zip(dims, dim_codes)})
+        for j, m in enumerate(self.metrics):
+            out[m] = np.rint(summed[:, j]).astype(np.int64) if m in self._int_metrics else summed[:, j]
+        if dims:
+            out = out.sort_values(dims, kind='stable', ignore_index=True)
+
+        with self._lock:
+            self._cache[cache_key] = out
+            while len(self._cache) > CUBE_ROLLUP_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return out
+
+def build_breakdown_cube(df_p30d, conv_col, breakdown_dims):
+    return BreakdownCube(df_p30d, conv_col, breakdown_dims)
+
+def breakdown_metrics_table(cube, level_dims, breakdowns, period_range, filters=None):
+    """層級 × 細分維度 × 區間 的匯總表（含 CPA / CTR / CVR / CPM / CPC 與全帳戶平均列），格式同 collect_period_results"""
+    start, end = period_range
+    rolled = cube.rollup(list(level_dims) + list(breakdowns), start, end, filters)
+    return finalize_consolidated_metrics(rolled, cube.conv_col)
+
+# ==========================================
+# 5.10 預先計算快取（precompute_daemon.py 於背景寫入、UI 開檔時直接載入）
+# ==========================================
+# 目錄結構：PRECOMPUTE_DIR/<程式版本>/<內容雜湊>/{raw.parquet, raw.json, bundle_<轉換欄>.pkl, excel_<轉換欄>.xlsx,
+#                                                  export_<轉換欄>.zip（Parquet 包，見 5.15）, manifest.json}
+#          PRECOMPUTE_DIR/<程式版本>/by_signature/<伺服器檔簽章>（內容為內容雜湊，伺服器資料夾模式用）
+# - 內容雜湊與上傳單一檔案時的 uploaded_files_digest 相同 → 上傳同一份檔案也會命中
+# - 程式版本 = app.py 原始碼雜湊：程式一改，舊的預先計算結果自動失效（bundle 欄位可能已不同）
+# - bundle 以 pickle 儲存：目錄只能由 daemon 寫入，勿指向不受信任的位置
+#   pickle 內只放 pandas / numpy 物件（UI 以 __main__ 執行 app.py，pickle 到 app.* 類別會在載入時重新 import 整個 app）；
+#   BreakdownCube 載入後由 P30D 切片重建
+PRECOMPUTE_DIR = os.environ.get('PRECOMPUTE_DIR', os.path.join('.ads_cache', 'precomputed'))
+try:
+    with open(os.path.abspath(__file__), 'rb') as _src:
+        PRECOMPUTE_VERSION = hashlib.sha256(_src.read()).hexdigest()[:12]
+except (NameError, OSError):
+    PRECOMPUTE_VERSION = 'dev'
+
+def file_content_digest(path, chunk_size=1 << 20):
+    """檔案內容 sha256（分塊讀取，不整份載入記憶體）"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _precompute_path(*parts):
+    return os.path.join(PRECOMPUTE_DIR, PRECOMPUTE_VERSION, *parts)
+
+def _conversion_slug(conversion_col):
+    return hashlib.sha256(str(conversion_col).encode('utf-8')).hexdigest()[:16]
+
+def _atomic_write(path, write):
+    """先寫暫存檔再 os.replace：UI 同時讀取時不會讀到寫一半的檔案"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _write_bytes(data):
+    def write(tmp):
+        with open(tmp, 'wb') as f:
+            f.write(data)
+    return write
+
+def save_precomputed(digest, raw, conversion_col, bundle, excel_bytes, signature=None, source=None):
+    slug = _conversion_slug(conversion_col)
+    if HAS_PYARROW:
+        _atomic_write(_precompute_path(digest, 'raw.parquet'), lambda tmp: raw['df'].to_parquet(tmp, index=False))
+    else:
+        _atomic_write(_precompute_path(digest, 'raw.pkl'), lambda tmp: raw['df'].to_pickle(tmp))
+    _atomic_write(_precompute_path(digest, 'raw.json'), _write_bytes(json.dumps(raw['ingest'], ensure_ascii=False).encode('utf-8')))
+    portable = {k: v for k, v in bundle.items() if k != 'breakdown_cube'}
+    _atomic_write(_precompute_path(digest, f'bundle_{slug}.pkl'), _write_bytes(pickle.dumps(portable, protocol=5)))
+    if excel_bytes:
+        _atomic_write(_precompute_path(digest, f'excel_{slug}.xlsx'), _write_bytes(excel_bytes))
+    if HAS_PYARROW:
+        _atomic_write(_precompute_path(digest, f'export_{slug}.zip'), lambda tmp: write_parquet_bundle(bundle, conversion_col, tmp))
+    manifest = {
+        'digest': digest, 'conversion_col': conversion_col, 'source': source,
+        'created_at': datetime.now().isoformat(timespec='seconds'), 'version': PRECOMPUTE_VERSION,
+    }
+    _atomic_write(_precompute_path(digest, 'manifest.json'), _write_bytes(json.dumps(manifest, ensure_ascii=False).encode('utf-8')))
+    if signature:
+        _atomic_write(_precompute_path('by_signature', signature), _write_bytes(digest.encode('ascii')))
+    return manifest
+
+def precomputed_digest_for_signature(signature):
+    try:
+        with open(_precompute_path('by_signature', signature), 'r', encoding='ascii') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def load_precomputed_raw(digest):
+    """{'df', 'ingest'}；沒有預先計算結果時回傳 None"""
+    if not digest:
+        return None
+    try:
+        with open(_precompute_path(digest, 'raw.json'), 'r', encoding='utf-8') as f:
+            ingest = json.load(f)
+        parquet_path = _precompute_path(digest, 'raw.parquet')
+        if os.path.exists(parquet_path):
+            df = pd.read_parquet(parquet_path)
+        else:
+            df = pd.read_pickle(_precompute_path(digest, 'raw.pkl'))
+    except (OSError, ValueError):
+        return None
+    return {'df': df, 'ingest': ingest}
+
+def load_precomputed_bundle(digest, conversion_col):
+    if not digest:
+        return None
+    path = _precompute_path(digest, f'bundle_{_conversion_slug(conversion_col)}.pkl')
+    try:
+        with open(path, 'rb') as f:
+            bundle = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return None
+    bundle['breakdown_cube'] = build_breakdown_cube(period_frame(bundle, 'P30D'), conversion_col, bundle['breakdown_dims'])
+    bundle['precomputed_at'] = datetime.fromtimestamp(os.path.getmtime(path)).strftime('%m-%d %H:%M')
+    return bundle
+
+def load_precomputed_excel(digest, conversion_col):
+    if not digest:
+        return None
+    try:
+        with open(_precompute_path(digest, f'excel_{_conversion_slug(conversion_col)}.xlsx'), 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+def precomputed_export_path(digest, conversion_col):
+    """預先計算好的 Parquet 包路徑；沒有時回傳 None"""
+    if not digest:
+        return None
+    path = _precompute_path(digest, f'export_{_conversion_slug(conversion_col)}.zip')
+    return path if os.path.exists(path) else None
+
+def precompute_export(rel_path, data_dir=ADS_DATA_DIR):
+    """
+    單一匯出檔的完整管線：讀取 → 清洗 / 各區間匯總 / 警示 / CPM / 新素材與新組合 → Excel / Parquet 包 → 寫入預先計算快取
+    轉換欄位用與 UI 相同的預設（suggest_conversion_index）；分析師改選其他欄位時 UI 會即時計算
+    """
+    t0 = time.perf_counter()
+    full = resolve_server_export(rel_path, data_dir)
+    signature = server_exports_signature([rel_path], data_dir)
+    digest = file_content_digest(full)
+    raw = ingest_server_exports([rel_path], data_dir)
+    conversion_col, spend_col, clicks_col, impressions_col = default_analysis_columns(raw['df'].columns.tolist())
+    bundle = build_analysis_bundle(
+        raw['df'], conversion_col, spend_col, clicks_col, impressions_col,
+        snapshot_account=snapshot_account_for_export(rel_path)
+    )
+    excel_bytes = to_excel_single_sheet_stacked(bundle['excel_stack'], AI_CONSULTANT_PROMPT, None)
+    manifest = save_precomputed(digest, raw, conversion_col, bundle, excel_bytes, signature, source=rel_path)
+    manifest['seconds'] = round(time.perf_counter() - t0, 2)
+    if bundle['snapshot'] is not None:
+        manifest['snapshot_changed_days'] = len(bundle['snapshot']['changed_days'])
+    return manifest
+
+# ==========================================
+# 5.11 每日快照（SQLite）：各層級逐日加總 + 區間視窗加總，新的一天進來只做增量
+# ==========================================
+# - snapshot_daily：每個 資料集（帳戶 + 轉換欄位）× 層級 × 實體 × 日 的加總
+# - snapshot_window：P1D / P7D / PP7D / P30D 視窗加總；新的一天 → 加上滑進來的日、減掉滑出去的日
+# - snapshot_days：每日原始列的內容雜湊，用來找出「新增」或「被重述（數字改過）」的日子，只重算那幾天
+# - 指標以 10^-6 定點整數存放：加加減減不會累積浮點誤差，與全量重算的加總一致
+# - 省下的是各區間多層級匯總（4 個區間 × 4 個層級的 groupby）與重述日以外的重算；
+#   清洗（standardize_frame）與逐列雜湊仍掃整個檔案，立方體 / 警示 / CPM / 害群之馬 / 預算 / 預估仍在區間切片上照常計算，
+#   所以新的一天進來的成本不是「只有一天」，而是省掉匯總那一段（長歷史檔案的大宗仍是讀檔與清洗）
+SNAPSHOT_DB = os.environ.get('SNAPSHOT_DB', os.path.join('.ads_cache', 'snapshots.sqlite'))
+SNAPSHOT_SCALE = 1_000_000
+SNAPSHOT_METRICS = ['spend', 'conv', 'clicks', 'impr']
+SNAPSHOT_WINDOWS = ('P1D', 'P7D', 'PP7D', 'P30D')
+# 與 collect_period_results 相同順序：(表名後綴, 層級鍵)
+SNAPSHOT_LEVELS = [
+    ('Detail_詳細(組合+廣告)', ['行銷活動名稱', '廣告組合名稱', '廣告名稱']),
+    ('Ad_廣告', ['廣告名稱_clean']),
+    ('AdSet_廣告組合', ['行銷活動名稱', '廣告組合名稱']),
+    ('Campaign_行銷活動', ['行銷活動名稱']),
+]
+_SNAPSHOT_KEYS = ['k1', 'k2', 'k3']
+
+def snapshot_connect(db_path=None):
+    db_path = db_path or SNAPSHOT_DB
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    # isolation_level=None：交易由 refresh_snapshots 以 BEGIN IMMEDIATE 自行控制（多個 daemon worker 同時寫入時不會讀到一半）
+    con = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    con.execute("PRAGMA journal_mode=WAL")
+    metric_cols = ', '.join(f"{m} INTEGER NOT NULL" for m in SNAPSHOT_METRICS)
+    con.executescript(f"""
+        CREATE TABLE IF NOT EXISTS snapshot_daily (
+            dataset TEXT NOT NULL, level INTEGER NOT NULL, k1 TEXT NOT NULL, k2 TEXT NOT NULL, k3 TEXT NOT NULL,
+            day TEXT NOT NULL, {metric_cols},
+            PRIMARY KEY (dataset, day, level, k1, k2, k3)
+        );
+        CREATE TABLE IF NOT EXISTS snapshot_window (
+            dataset TEXT NOT NULL, window TEXT NOT NULL, level INTEGER NOT NULL,
+            k1 TEXT NOT NULL, k2 TEXT NOT NULL, k3 TEXT NOT NULL, {metric_cols},
+            PRIMARY KEY (dataset, window, level, k1, k2, k3)
+        );
+        CREATE TABLE IF NOT EXISTS snapshot_days (
+            dataset TEXT NOT NULL, day TEXT NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (dataset, day)
+        );
+        CREATE TABLE IF NOT EXISTS snapshot_meta (
+            dataset TEXT PRIMARY KEY, max_date TEXT NOT NULL, updated_at TEXT NOT NULL
+        );
+    """)
+    return con
+
+def snapshot_dataset_key(account, conversion_col):
+    return f"{account}|{conversion_col}"
+
+def _column_hash(values):
+    """逐列 uint64 雜湊；文字欄先 factorize 只雜湊不重複值（名稱欄重複度高，比逐列雜湊字串快一個量級）"""
+    if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_datetime64_any_dtype(values):
+        return pd.util.hash_array(values.to_numpy())
+    codes, uniques = pd.factorize(values)
+    hashed = np.append(pd.util.hash_array(np.asarray(uniques, dtype=object)), np.uint64(0))
+    return hashed[codes]  # 缺值 code = -1 → 最後一格的 0
+
+def _snapshot_day_digests(df_std, conversion_col):
+    """df_std（依日期排序）→ {日: 'rows:hash'}；同一天的列順序不影響雜湊"""
+    cols = ['天數', '行銷活動名稱', '廣告組合名稱', '廣告名稱', '花費金額 (TWD)', conversion_col, '連結點擊次數', '曝光次數']
+    cols += [c for c in ('小時', *BREAKDOWN_COLS) if c in df_std.columns]
+    row_hash = np.zeros(len(df_std), dtype=np.uint64)
+    for c in dict.fromkeys(cols):
+        row_hash = row_hash * np.uint64(0x100000001B3) ^ _column_hash(df_std[c])
+    days = df_std['天數'].to_numpy(dtype='datetime64[D]')
+    starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+    sums = np.add.reduceat(row_hash, starts)   # uint64 相加自動取模
+    counts = np.diff(np.r_[starts, len(days)])
+    return {str(days[s]): f"{n}:{h:016x}" for s, n, h in zip(starts, counts, sums)}
+
+def _snapshot_daily_frame(df_days, conversion_col):
+    """指定日子的原始列 → 各層級逐日加總（定點整數），欄位：level, k1~k3, day, 指標"""
+    source = {'spend': '花費金額 (TWD)', 'conv': conversion_col, 'clicks': '連結點擊次數', 'impr': '曝光次數'}
+    frames = []
+    for level, (_, keys) in enumerate(SNAPSHOT_LEVELS):
+        g = df_days.groupby(['天數'] + keys)[list(dict.fromkeys(source.values()))].sum().reset_index()
+        out = pd.DataFrame({'level': level, 'day': g['天數'].dt.strftime('%Y-%m-%d')})
+        for i, k in enumerate(_SNAPSHOT_KEYS):
+            out[k] = g[keys[i]].astype(str) if i < len(keys) else ''
+        for m, col in source.items():
+            out[m] = np.rint(g[col].to_numpy(dtype=np.float64) * SNAPSHOT_SCALE).astype(np.int64)
+        frames.append(out)
+    return pd.concat(frames, ignore_index=True)
+
+def _snapshot_read_days(con, dataset, days):
+    if not days:
+        return pd.DataFrame(columns=['level', *_SNAPSHOT_KEYS, 'day', *SNAPSHOT_METRICS])
+    marks = ', '.join('?' * len(days))
+    return pd.read_sql_query(
+        f"SELECT level, k1, k2, k3, day, {', '.join(SNAPSHOT_METRICS)} FROM snapshot_daily "
+        f"WHERE dataset = ? AND day IN ({marks})", con, params=[dataset, *days]
+    )
+
+def _sqlite_rows(df, cols):
+    """DataFrame → sqlite3 可直接綁定的 tuple（numpy 整數轉為 Python int）"""
+    return df[cols].astype(object).itertuples(index=False, name=None)
+
+def _window_days(periods, window):
+    if periods is None:
+        return set()
+    start, end = periods[window]
+    return {d.strftime('%Y-%m-%d') for d in pd.date_range(start, end, freq='D')}
+
+def refresh_snapshots(account, df_std, conversion_col, db_path=None, read_windows=False):
+    """
+    以 df_std（標準欄名、依日期排序）增量更新快照；回傳摘要
+    read_windows：在同一個交易內（提交前）讀回更新後的四個視窗，放在摘要的 'window_results'
+    （{區間: [(表名, DataFrame), ...]}）；提交後再另開連線讀，可能讀到同帳戶另一個檔案剛寫入的視窗
+    - 新增 / 重述的日子：重算該日各層級加總，視窗加上 (新 − 舊)
+    - 視窗滑動（最後一天往後移）：滑進來的日加上、滑出去的日減掉（讀 snapshot_daily，不碰原始列）
+    - 檔案日期範圍內、但檔案裡已經沒有的日子視為刪除；更早的日子留在快照，之後視窗滑動時沿用
+      （bundle 只在檔案涵蓋整個 P30D 時讀視窗快照，見 build_analysis_bundle）
+    快照已有比此檔更新的日子時不更新，回傳 None
+    """
+    t0 = time.perf_counter()
+    dataset = snapshot_dataset_key(account, conversion_col)
+    digests = _snapshot_day_digests(df_std, conversion_col)
+    con = snapshot_connect(db_path)
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        stored = dict(con.execute("SELECT day, digest FROM snapshot_days WHERE dataset = ?", (dataset,)).fetchall())
+        row = con.execute("SELECT max_date FROM snapshot_meta WHERE dataset = ?", (dataset,)).fetchone()
+        old_periods = report_periods(pd.Timestamp(row[0])) if row else None
+        new_max = pd.Timestamp(max(digests))
+        if row and pd.Timestamp(row[0]) > new_max:
+            con.execute("ROLLBACK")
+            return None
+        new_periods = report_periods(new_max)
+
+        first_day, last_day = min(digests), max(digests)
+        changed = sorted(d for d, h in digests.items() if stored.get(d) != h)
+        removed = sorted(d for d in stored if first_day <= d <= last_day and d not in digests)
+
+        # 變動日的新加總（只取這些日子的原始列：df_std 已依日期排序，用二分搜尋切片）
+        sorted_days = df_std['天數'].to_numpy(dtype='datetime64[D]')
+        pieces = []
+        for d in changed:
+            lo = int(sorted_days.searchsorted(np.datetime64(d), side='left'))
+            hi = int(sorted_days.searchsorted(np.datetime64(d), side='right'))
+            pieces.append(df_std.iloc[lo:hi])
+        new_daily = (
+            _snapshot_daily_frame(pd.concat(pieces), conversion_col) if pieces
+            else _snapshot_read_days(con, dataset, [])
+        )
+
+        # 視窗差額：變動日 (新 − 舊)、未變動日只處理滑進 / 滑出
+        touched = set(changed) | set(removed)
+        slide = set()
+        for w in SNAPSHOT_WINDOWS:
+            slide |= _window_days(old_periods, w) ^ _window_days(new_periods, w)
+        old_daily = _snapshot_read_days(con, dataset, sorted(touched | (slide & set(stored))))
+
+        deltas = []
+        for w in SNAPSHOT_WINDOWS:
+            old_w, new_w = _window_days(old_periods, w), _window_days(new_periods, w)
+            minus = old_daily[old_daily['day'].isin(old_w & (touched | (old_w - new_w)))]
+            plus_stored = old_daily[old_daily['day'].isin((new_w - old_w) - touched)]
+            plus_new = new_daily[new_daily['day'].isin(new_w)]
+            for frame, sign in ((minus, -1), (plus_stored, 1), (plus_new, 1)):
+                if not frame.empty:
+                    part = frame[['level', *_SNAPSHOT_KEYS]].assign(window=w)
+                    for m in SNAPSHOT_METRICS:
+                        part[m] = frame[m].to_numpy(dtype=np.int64) * sign
+                    deltas.append(part)
+
+        # 寫回：逐日表（刪舊插新）、視窗表（累加差額後清掉全為 0 的列）、日雜湊、最後一天
+        marks = ', '.join('?' * len(touched))
+        if touched:
+            con.execute(f"DELETE FROM snapshot_daily WHERE dataset = ? AND day IN ({marks})", [dataset, *sorted(touched)])
+            con.execute(f"DELETE FROM snapshot_days WHERE dataset = ? AND day IN ({marks})", [dataset, *sorted(touched)])
+        metric_list = ', '.join(SNAPSHOT_METRICS)
+        con.executemany(
+            f"INSERT INTO snapshot_daily (dataset, level, k1, k2, k3, day, {metric_list}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ((dataset, *r) for r in _sqlite_rows(new_daily, ['level', *_SNAPSHOT_KEYS, 'day', *SNAPSHOT_METRICS]))
+        )
+        n_delta_rows = 0
+        if deltas:
+            delta = pd.concat(deltas, ignore_index=True).groupby(['window', 'level', *_SNAPSHOT_KEYS], as_index=False)[SNAPSHOT_METRICS].sum()
+            n_delta_rows = len(delta)
+            con.executemany(
+                f"INSERT INTO snapshot_window (dataset, window, level, k1, k2, k3, {metric_list}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                f"ON CONFLICT (dataset, window, level, k1, k2, k3) DO UPDATE SET "
+                + ', '.join(f"{m} = {m} + excluded.{m}" for m in SNAPSHOT_METRICS),
+                ((dataset, *r) for r in _sqlite_rows(delta, ['window', 'level', *_SNAPSHOT_KEYS, *SNAPSHOT_METRICS]))
+            )
+            con.execute(
+                "DELETE FROM snapshot_window WHERE dataset = ? AND "
+                + ' AND '.join(f"{m} = 0" for m in SNAPSHOT_METRICS), (dataset,)
+            )
+        con.executemany(
+            "INSERT INTO snapshot_days (dataset, day, digest) VALUES (?, ?, ?)",
+            ((dataset, d, digests[d]) for d in changed)
+        )
+        con.execute(
+            "INSERT INTO snapshot_meta (dataset, max_date, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (dataset) DO UPDATE SET max_date = excluded.max_date, updated_at = excluded.updated_at",
+            (dataset, new_max.strftime('%Y-%m-%d'), datetime.now().isoformat(timespec='seconds'))
+        )
+        window_rows = _snapshot_read_windows(con, dataset) if read_windows else None
+        con.execute("COMMIT")
+    except BaseException:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+    summary = {
+        'dataset': dataset, 'max_date': new_max, 'changed_days': changed, 'removed_days': removed,
+        'window_delta_rows': n_delta_rows, 'seconds': time.perf_counter() - t0,
+    }
+    if window_rows is not None:
+        summary['window_results'] = {
+            w: _snapshot_window_tables(window_rows[window_rows['window'] == w], conversion_col, w)
+            for w in SNAPSHOT_WINDOWS
+        }
+    return summary
+
+def _snapshot_read_windows(con, dataset, window=None):
+    sql = (f"SELECT window, level, k1, k2, k3, {', '.join(SNAPSHOT_METRICS)} FROM snapshot_window "
+           f"WHERE dataset = ?")
+    params = [dataset]
+    if window is not None:
+        sql += " AND window = ?"
+        params.append(window)
+    return pd.read_sql_query(sql + " ORDER BY window, level, k1, k2, k3", con, params=params)
+
+def snapshot_period_results(account, conversion_col, window, db_path=None):
+    """從視窗快照組出與 collect_period_results 相同的 [(表名, DataFrame), ...]"""
+    dataset = snapshot_dataset_key(account, conversion_col)
+    con = snapshot_connect(db_path)
+    try:
+        rows = _snapshot_read_windows(con, dataset, window)
+    finally:
+        con.close()
+    return _snapshot_window_tables(rows, conversion_col, window)
+
+def _snapshot_window_tables(rows, conversion_col, window):
+    """單一視窗的快照列 → [(表名, DataFrame), ...]"""
+    metric_names = {'spend': '花費金額 (TWD)', 'conv': conversion_col, 'clicks': '連結點擊次數', 'impr': '曝光次數'}
+    results = []
+    for level, (suffix, keys) in enumerate(SNAPSHOT_LEVELS):
+        part = rows[rows['level'] == level]
+        df = pd.DataFrame({k: part[f'k{i + 1}'].to_numpy() for i, k in enumerate(keys)})
+        for m, col in metric_names.items():
+            df[col] = part[m].to_numpy(dtype=np.float64) / SNAPSHOT_SCALE
+        df = _restore_integer_columns(df, list(metric_names.values()))
+        results.append((f'{window}_{suffix}', finalize_consolidated_metrics(df, conversion_col)))
+    return results
+
+# ==========================================
+# 5.12 批次週報（多帳戶）：依每把 Key 的 RPM / TPM 額度排程（token bucket），限流時退避重試
+# ==========================================
+# - 每把 Key 兩個桶：RPM（每次請求 1）與 TPM（prompt 估計 token + 預留輸出）；都有額度才送出
+# - 預約制：桶可以透支，透支多少就等多久 → 執行緒依序排隊，不忙等、也不會一次全部衝出去
+# - 429：整把 Key 暫停（Retry-After 或指數退避），其他執行緒的預約也一起往後延
+# - 總時間 ≈ max(帳戶數 / RPM, 總 token / TPM) + 單次延遲，而不是逐一呼叫的加總
+GEMINI_RPM_LIMIT = float(os.environ.get('GEMINI_RPM_LIMIT', '150'))
+GEMINI_TPM_LIMIT = float(os.environ.get('GEMINI_TPM_LIMIT', '2000000'))
+WEEKLY_OUTPUT_TOKENS = int(os.environ.get('WEEKLY_OUTPUT_TOKENS', '1500'))
+WEEKLY_BATCH_MAX_WORKERS = int(os.environ.get('WEEKLY_BATCH_MAX_WORKERS', '64'))
+WEEKLY_BATCH_MAX_BACKOFF = 60.0
+
+class TokenBucket:
+    """
+    每分鐘 rate_per_minute 個 token；reserve() 回傳需等待秒數（可透支）
+    容量只有 burst_seconds 秒的額度：以均勻速度送出，任一 60 秒視窗內都不會超過每分鐘額度太多
+    """
+
+    def __init__(self, rate_per_minute, burst_seconds=1.0):
+        self.rate = float(rate_per_minute) / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, n):
+        with self.lock:
+            self._refill()
+            self.tokens -= n
+            return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds):
+        """被限流：清空並再透支 seconds 秒的額度，之後的預約都往後排"""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+class KeyRateLimiter:
+    """單一 API Key 的 RPM + TPM 額度"""
+
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    def acquire(self, n_tokens):
+        """預約一次請求與 n_tokens 個 token；睡到額度可用為止，回傳等待秒數"""
+        wait = max(self.requests.reserve(1), self.tokens.reserve(n_tokens))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def backoff(self, seconds):
+        self.requests.pause(seconds)
+        self.tokens.pause(seconds)
+
+@st.cache_resource
+def _rate_limiters():
+    return {}, threading.Lock()
+
+def get_rate_limiter(api_key, rpm=GEMINI_RPM_LIMIT, tpm=GEMINI_TPM_LIMIT):
+    """每把 API Key（依額度設定）一個 limiter，整個 process 共用"""
+    limiters, lock = _rate_limiters()
+    key = (hashlib.sha256(str(api_key).encode()).hexdigest(), float(rpm), float(tpm))
+    with lock:
+        if key not in limiters:
+            limiters[key] = KeyRateLimiter(rpm, tpm)
+        return limiters[key]
+
+def is_rate_limited(exc):
+    """REST 429 或 SDK 的 ResourceExhausted"""
+    return getattr(exc, 'status', None) == 429 or type(exc).__name__ == 'ResourceExhausted'
+
+def call_gemini_weekly_draft_scheduled(api_key, prompt, limiter, max_retries=4, base_backoff=2.0):
+    """
+    call_gemini_weekly_draft 的排程版：每次嘗試前先向 limiter 預約額度
+    - 429：Retry-After（沒有則 base_backoff × 2^n，加隨機抖動）期間整把 Key 暫停
+    - 其他連線錯誤：只有此請求退避；JSON 無法修復：直接重打
+    回傳 {'draft', 'raw', 'how', 'attempts', 'waited'}
+    """
+    n_tokens = estimate_tokens(prompt) + WEEKLY_OUTPUT_TOKENS
+    raw_text, waited = "", 0.0
+    for attempt in range(max_retries + 1):
+        if attempt:
+            _bump_weekly_stat(retries=1)
+        waited += limiter.acquire(n_tokens)
+        try:
+            raw_text = _gemini_weekly_raw(api_key, prompt, retry=attempt)
+        except Exception as e:
+            raw_text = str(e)
+            if attempt == max_retries:
+                break
+            delay = getattr(e, 'retry_after', None) or base_backoff * (2 ** attempt) * (1 + 0.5 * np.random.random())
+            delay = min(float(delay), WEEKLY_BATCH_MAX_BACKOFF)
+            if is_rate_limited(e):
+                limiter.backoff(delay)
+            else:
+                time.sleep(delay)
+                waited += delay
+            continue
+        draft, how = parse_weekly_draft(raw_text)
+        if draft is not None:
+            _bump_weekly_stat(calls=1, **{how: 1})
+            return {'draft': draft, 'raw': raw_text, 'how': how, 'attempts': attempt + 1, 'waited': waited}
+    _bump_weekly_stat(calls=1, failed=1)
+    return {'draft': None, 'raw': raw_text, 'how': None, 'attempts': max_retries + 1, 'waited': waited}
+
+def weekly_report_inputs(bundle, conversion_col):
+    """bundle → 週報 prompt 的輸入（與週報產生器分頁相同：P7D / PP7D 概況、Top AdSet / Ad）"""
+    return {
+        'p7_overall': calc_period_overall(period_frame(bundle, 'P7D'), conversion_col),
+        'pp7_overall': calc_period_overall(period_frame(bundle, 'PP7D'), conversion_col),
+        'top_adsets': get_top_by_spend(bundle['res_p7'][2][1], n=12, min_spend=500),
+        'top_ads': get_top_by_spend(bundle['res_p7'][1][1], n=12, min_spend=300),
+    }
+
+def weekly_inputs_for_export(rel_path, data_dir=ADS_DATA_DIR):
+    """
+    伺服器資料夾內單一匯出檔 → {'account', 'conversion_col', ...weekly_report_inputs}
+    有背景預先計算結果就直接載入，否則跑一次完整管線（轉換欄位同 UI 預設）
+    account 為相對路徑（去掉副檔名，與每日快照的帳戶鍵相同）：不同資料夾的同名檔是不同帳戶
+    """
+    digest = precomputed_digest_for_signature(server_exports_signature([rel_path], data_dir))
+    raw = load_precomputed_raw(digest) or ingest_server_exports([rel_path], data_dir)
+    all_columns = raw['df'].columns.tolist()
+    conversion_col, spend_col, clicks_col, impressions_col = default_analysis_columns(all_columns)
+    bundle = load_precomputed_bundle(digest, conversion_col) or build_analysis_bundle(
+        raw['df'], conversion_col, spend_col, clicks_col, impressions_col
+    )
+    return {
+        'account': snapshot_account_for_export(rel_path), 'conversion_col': conversion_col,
+        **weekly_report_inputs(bundle, conversion_col),
+    }
+
+def _safe_filename(name):
+    return re.sub(r'[\\/:*?"<>|\s]+', '_', str(name)).strip('._') or 'account'
+
+def _weekly_output_base(out_dir, account):
+    """帳戶（相對路徑，'/' 分隔）→ 輸出檔路徑（不含副檔名）：保留子資料夾，clientA/export 與 clientB/export 不會互相覆蓋"""
+    return os.path.join(out_dir, *(_safe_filename(part) for part in str(account).split('/')))
+
+def run_weekly_batch(api_key, jobs, out_dir, rpm=GEMINI_RPM_LIMIT, tpm=GEMINI_TPM_LIMIT,
+                     max_workers=None, max_retries=4, on_done=None):
+    """
+    多帳戶週報：jobs 為 weekly_inputs_for_export 形式的 dict（可為產生器，邊產生邊送出）
+    - 每個帳戶寫出 <帳戶>.json（草案 + 重試 / 等待資訊）與 <帳戶>.md（LINE Markdown，草案預設勾選）；
+      帳戶為相對路徑時保留子資料夾（<out>/clientA/export.json）
+    - 執行緒數不是瓶頸（預設 WEEKLY_BATCH_MAX_WORKERS），實際送出速度由 limiter 控制
+    - on_done(row) 於每個帳戶完成時呼叫；回傳每個帳戶一列的摘要
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    limiter = get_rate_limiter(api_key, rpm, tpm)
+
+    def one(job):
+        t0 = time.perf_counter()
+        token = _llm_usage_ctx.set({'account': job['account']})
+        try:
+            prompt = _weekly_report_ai_prompt(job['p7_overall'], job['pp7_overall'], job['top_adsets'], job['top_ads'])
+            result = call_gemini_weekly_draft_scheduled(api_key, prompt, limiter, max_retries=max_retries)
+        finally:
+            _llm_usage_ctx.reset(token)
+        base = _weekly_output_base(out_dir, job['account'])
+        payload = {
+            'account': job['account'], 'conversion_col': job.get('conversion_col'),
+            'generated_at': datetime.now().isoformat(timespec='seconds'),
+            'p7_overall': job['p7_overall'], 'pp7_overall': job['pp7_overall'],
+            'how': result['how'], 'attempts': result['attempts'], 'draft': result['draft'],
+        }
+        if result['draft'] is None:
+            payload['raw'] = result['raw']
+        _atomic_write(base + '.json', _write_bytes(json.dumps(payload, ensure_ascii=False, indent=2).encode('utf-8')))
+        if result['draft'] is not None:
+            md = weekly_markdown_from_draft(job['p7_overall'], job['pp7_overall'], result['draft'])
+            _atomic_write(base + '.md', _write_bytes(md.encode('utf-8')))
+        row = {
+            'account': job['account'], 'ok': result['draft'] is not None, 'how': result['how'],
+            'attempts': result['attempts'], 'waited': round(result['waited'], 2),
+            'seconds': round(time.perf_counter() - t0, 2),
+        }
+        if on_done is not None:
+            on_done(row)
+        return row
+
+    rows = []
+    with ThreadPoolExecutor(max_workers=max_workers or WEEKLY_BATCH_MAX_WORKERS, thread_name_prefix='weekly-batch') as pool:
+        futures = [pool.submit(one, job) for job in jobs]
+        for f in futures:
+            rows.append(f.result())
+    return rows
+
+# ==========================================
+# 5.13 預算重分配：廣告組合邊際 CPA 曲線 + 總預算不變下的最適分配
+# ==========================================
+# 每個廣告組合的日轉換 ≈ a · 花費^b（0 < b < 1：邊際效益遞減），以 P30D 逐日 花費 / 轉換 擬合：
+# - Poisson 迴歸（log 連結；0 轉換的日子照樣可用），所有組合一起以 bincount 做 Newton 迭代，不逐組合迴圈
+# - 先以「各組合各自截距、共用彈性」估出帳戶共同彈性，各組合再向它收縮（天數少 / 花費變化小的組合幾乎沿用帳戶值）
+# - 最適分配：未觸及上下限的組合邊際轉換 a·b·s^(b−1) 相等（KKT），對拉格朗日乘數二分搜尋
+BUDGET_MAX_CHANGE = float(os.environ.get('BUDGET_MAX_CHANGE', '0.3'))   # 每個組合日花費最多調整 ±30%
+BUDGET_MIN_ACTIVE_DAYS = 7          # P30D 有花費的天數不足者維持現狀
+BUDGET_ELASTICITY_BOUNDS = (0.1, 0.95)
+BUDGET_PRIOR_WEIGHT = (1.0, 4.0)    # (截距, 彈性) 向帳戶值收縮的強度
+BUDGET_PLAN_AI_ROWS = 20
+BUDGET_CURVE_KEYS = ['行銷活動名稱', '廣告組合名稱']
+
+def _pooled_elasticity(group, x, y, y_sum, n, iters=30):
+    """各組合截距消去（profile likelihood）後的共同彈性；x 已在組內置中"""
+    beta = 0.7
+    for _ in range(iters):
+        w = np.exp(beta * x)
+        w_sum = np.bincount(group, weights=w, minlength=n)
+        mean = np.bincount(group, weights=w * x, minlength=n) / w_sum
+        var = np.bincount(group, weights=w * x * x, minlength=n) / w_sum - mean ** 2
+        info = float((y_sum * var).sum())
+        if info <= 1e-12:
+            break
+        step = float(np.clip(((y * x).sum() - (y_sum * mean).sum()) / info, -1, 1))
+        beta += step
+        if abs(step) < 1e-8:
+            break
+    return float(np.clip(beta, *BUDGET_ELASTICITY_BOUNDS))
+
+def fit_adset_response_curves(cube, periods, as_of=None, iters=50):
+    """
+    P30D 立方體 → 每個廣告組合一列：活躍天數 / P30D 花費與轉換 / 目前日均花費（近 7 個完整日 ÷ 7）/ 曲線 a、b
+    只含近 7 日仍有花費的組合（已停的組合不參與分配）
+    as_of：最後一個完整日（逐小時匯出最後一天未結束時為 alert_day）；之後的半天不參與擬合，也不算進目前日均
+    """
+    conv = cube.conv_col
+    start, end = periods['P30D']
+    end = pd.Timestamp(as_of) if as_of is not None else pd.Timestamp(end)
+    daily = cube.rollup(['天數'] + BUDGET_CURVE_KEYS, start, end)
+    daily = daily[daily['花費金額 (TWD)'] > 0]
+    if daily.empty:
+        return pd.DataFrame()
+    group, uniques = pd.MultiIndex.from_frame(daily[BUDGET_CURVE_KEYS]).factorize()
+    n = len(uniques)
+    spend = daily['花費金額 (TWD)'].to_numpy(dtype=np.float64)
+    y = daily[conv].to_numpy(dtype=np.float64)
+    days = daily['天數'].to_numpy(dtype='datetime64[ns]')
+    p7_start, p7_end = (np.datetime64(d, 'ns') for d in (end - timedelta(days=6), end))
+    in_p7 = (days >= p7_start) & (days <= p7_end)
+
+    count = np.bincount(group, minlength=n)
+    log_s = np.log(spend)
+    m = np.bincount(group, weights=log_s, minlength=n) / count
+    x = log_s - m[group]
+    y_sum = np.bincount(group, weights=y, minlength=n)
+    spend_sum = np.bincount(group, weights=spend, minlength=n)
+
+    # 帳戶共同曲線：a0 · s^b0 的總和對上實際總轉換
+    beta0 = _pooled_elasticity(group, x, y, y_sum, n)
+    alpha0 = np.log(max(y.sum(), 0.5) / np.exp(beta0 * log_s).sum()) + beta0 * m
+    lam_a, lam_b = BUDGET_PRIOR_WEIGHT
+
+    # 各組合 (α, β) 的 Poisson MAP：2×2 Newton，所有組合同時更新
+    alpha = np.log((y_sum + 0.5) / count)
+    beta = np.full(n, beta0)
+    for _ in range(iters):
+        mu = np.exp(alpha[group] + beta[group] * x)
+        r = y - mu
+        g_a = np.bincount(group, weights=r, minlength=n) - lam_a * (alpha - alpha0)
+        g_b = np.bincount(group, weights=r * x, minlength=n) - lam_b * (beta - beta0)
+        h_aa = np.bincount(group, weights=mu, minlength=n) + lam_a
+        h_ab = np.bincount(group, weights=mu * x, minlength=n)
+        h_bb = np.bincount(group, weights=mu * x * x, minlength=n) + lam_b
+        det = h_aa * h_bb - h_ab * h_ab
+        d_a = np.clip((h_bb * g_a - h_ab * g_b) / det, -2, 2)
+        d_b = np.clip((h_aa * g_b - h_ab * g_a) / det, -1, 1)
+        alpha += d_a
+        beta += d_b
+        if max(np.abs(d_a).max(), np.abs(d_b).max()) < 1e-8:
+            break
+    b = np.clip(beta, *BUDGET_ELASTICITY_BOUNDS)
+
+    curves = pd.DataFrame({k: uniques.get_level_values(i) for i, k in enumerate(BUDGET_CURVE_KEYS)})
+    curves['活躍天數'] = count
+    curves['P30D 花費 (TWD)'] = spend_sum
+    curves['P30D 轉換'] = y_sum
+    curves['目前日均花費 (TWD)'] = np.bincount(group[in_p7], weights=spend[in_p7], minlength=n) / 7
+    curves['曲線 a'] = np.exp(alpha - b * m)     # 組內幾何平均花費處的預估值不受彈性截斷影響
+    curves['彈性 b'] = b
+    curves.attrs['pooled_elasticity'] = beta0
+    return curves[curves['目前日均花費 (TWD)'] > 0].reset_index(drop=True)
+
+def optimize_budget_allocation(curves, max_change=BUDGET_MAX_CHANGE, min_active_days=BUDGET_MIN_ACTIVE_DAYS):
+    """
+    總日預算不變、各組合在 目前 ×(1 ± max_change) 內，最大化預估日轉換
+    回傳建議表（依花費增減排序）；邊際 CPA = 多花 1 元預算換到的轉換之倒數
+    """
+    if curves is None or curves.empty:
+        return pd.DataFrame()
+    cur = curves['目前日均花費 (TWD)'].to_numpy(dtype=np.float64)
+    a = curves['曲線 a'].to_numpy(dtype=np.float64)
+    b = curves['彈性 b'].to_numpy(dtype=np.float64)
+    movable = curves['活躍天數'].to_numpy() >= min_active_days
+    lo = np.where(movable, cur * (1 - max_change), cur)
+    hi = np.where(movable, cur * (1 + max_change), cur)
+    log_ab = np.log(a * b)
+
+    def allocate(log_lam):
+        return np.clip(np.exp((log_ab - log_lam) / (1 - b)), lo, hi)
+
+    # log 邊際轉換在上下限處的範圍即乘數的搜尋區間；總花費對乘數單調遞減
+    lam_lo = float((log_ab + (b - 1) * np.log(hi)).min()) - 1
+    lam_hi = float((log_ab + (b - 1) * np.log(lo)).max()) + 1
+    budget = cur.sum()
+    for _ in range(100):
+        mid = (lam_lo + lam_hi) / 2
+        if allocate(mid).sum() > budget:
+            lam_lo = mid
+        else:
+            lam_hi = mid
+    new = allocate((lam_lo + lam_hi) / 2)
+
+    plan = curves[BUDGET_CURVE_KEYS + ['活躍天數', '彈性 b', '目前日均花費 (TWD)']].copy()
+    plan['建議日均花費 (TWD)'] = new
+    plan['調整 (%)'] = (new / cur - 1) * 100
+    plan['目前邊際 CPA (TWD)'] = cur ** (1 - b) / (a * b)
+    plan['建議邊際 CPA (TWD)'] = new ** (1 - b) / (a * b)
+    plan['預估日轉換_目前'] = a * cur ** b
+    plan['預估日轉換_建議'] = a * new ** b
+    plan = plan.assign(_delta=new - cur).sort_values('_delta', ascending=False, kind='stable')
+    return plan.drop(columns='_delta').reset_index(drop=True).round(2)
+
+def budget_plan_summary(plan):
+    """建議表 → 總日花費與預估日轉換（目前 / 建議）"""
+    if plan is None or plan.empty:
+        return None
+    conv_now, conv_new = plan['預估日轉換_目前'].sum(), plan['預估日轉換_建議'].sum()
+    return {
+        'adsets': len(plan),
+        'moved': int((plan['調整 (%)'].abs() >= 1).sum()),
+        'budget': float(plan['目前日均花費 (TWD)'].sum()),
+        'conv_now': float(conv_now),
+        'conv_new': float(conv_new),
+        'lift_pct': float((conv_new / conv_now - 1) * 100) if conv_now > 0 else 0.0,
+    }
+
+def budget_plan_for_prompt(plan, n=BUDGET_PLAN_AI_ROWS):
+    """給 AI 的精簡版：只留有調整的組合，加碼 / 減碼各取調整金額最大的 n / 2 個"""
+    if plan is None or plan.empty:
+        return pd.DataFrame()
+    moved = plan[plan['調整 (%)'].abs() >= 1]
+    delta = moved['建議日均花費 (TWD)'] - moved['目前日均花費 (TWD)']
+    top = pd.concat([moved[delta > 0].head(n // 2), moved[delta < 0].tail(n - n // 2)])
+    return top.drop(columns=['活躍天數', '彈性 b', '預估日轉換_目前', '預估日轉換_建議'])
+
+# ==========================================
+# 5.14 月底預估：全帳戶 / 各活動 / 各組合的花費與轉換（星期季節性指數平滑，所有序列一次計算）
+# ==========================================
+# - P30D 立方體 roll-up 成 (序列, 天) 矩陣（沒資料的日子為 0），花費與轉換各自為一條序列
+# - 模型：加法星期季節性的指數平滑（level + 7 個星期效果）；時間方向逐日迭代，序列方向全部向量化
+#   α 對每條序列以網格選一步預測誤差最小者，γ 固定
+# - 月底預估 = 本月至今實際 + 剩餘天數預測總和；區間由一步誤差與 α 推得（剩餘天數的誤差會累積到後面每一天）
+FORECAST_ALPHAS = np.array([0.05, 0.1, 0.2, 0.3, 0.5, 0.7])
+FORECAST_GAMMA = 0.1
+FORECAST_LEVELS = {
+    '全帳戶': [],
+    '行銷活動': ['行銷活動名稱'],
+    '廣告組合': ['行銷活動名稱', '廣告組合名稱'],
+}
+
+def forecast_month(as_of):
+    """預估的月份：以最後一個完整日的隔天（通常就是今天）所在月份為準 → (月初, 月底)"""
+    month_start = (as_of + timedelta(days=1)).replace(day=1)
+    month_end = month_start + pd.offsets.MonthEnd(0)
+    return month_start, month_end
+
+def seasonal_es_forecast(Y, first_day, horizon, level=CI_LEVEL):
+    """
+    Y：(序列數, 天數) 逐日值，第一欄為 first_day；回傳各序列未來 horizon 天的
+    {'path', 'path_lo', 'path_hi'}（逐日）與 {'total', 'total_lo', 'total_hi'}（horizon 天總和），下限不低於 0
+    """
+    Y = np.asarray(Y, dtype=np.float64)
+    n, T = Y.shape
+    weekday0 = pd.Timestamp(first_day).weekday()
+    init = min(7, T)
+    # (α 數, 序列數) 同時平滑；初始 level = 第一週平均，星期效果 = 各完整週內「各天 − 該週平均」再跨週平均
+    alphas = FORECAST_ALPHAS[:, None]
+    level_ = np.broadcast_to(Y[:, :init].mean(axis=1), (len(FORECAST_ALPHAS), n)).copy()
+    season = np.zeros((len(FORECAST_ALPHAS), n, 7))
+    weeks = T // 7
+    if weeks:
+        block = Y[:, :weeks * 7].reshape(n, weeks, 7)
+        deviation = (block - block.mean(axis=2, keepdims=True)).mean(axis=1)
+        season[:, :, (weekday0 + np.arange(7)) % 7] = deviation
+    sse = np.zeros_like(level_)
+    for t in range(init, T):
+        wd = (weekday0 + t) % 7
+        err = Y[:, t] - (level_ + season[:, :, wd])
+        sse += err * err
+        level_ += alphas * err
+        season[:, :, wd] += FORECAST_GAMMA * (1 - alphas) * err
+
+    best = sse.argmin(axis=0)
+    cols = np.arange(n)
+    alpha = FORECAST_ALPHAS[best]
+    lvl, ssn = level_[best, cols], season[best, cols]
+    # 自由度扣掉由同一段資料估出的 6 個星期效果（加總為 0）與 α
+    sigma = np.sqrt(sse[best, cols] / max(T - init - 7, 1))
+
+    h = np.arange(1, horizon + 1)
+    path = lvl[:, None] + ssn[:, (weekday0 + T + h - 1) % 7]
+    z = NormalDist().inv_cdf(0.5 + level / 2)
+    step_sd = sigma[:, None] * np.sqrt(1 + (h - 1) * alpha[:, None] ** 2)
+    # 第 j 天的誤差經 level 傳到之後每一天：總和的變異數 = σ² Σ_j (1 + (horizon − j)·α)²
+    total_sd = sigma * np.sqrt(((1 + (horizon - h)[None, :] * alpha[:, None]) ** 2).sum(axis=1))
+    path = np.maximum(path, 0)
+    total = path.sum(axis=1)
+    return {
+        'path': path,
+        'path_lo': np.maximum(path - z * step_sd, 0),
+        'path_hi': path + z * step_sd,
+        'total': total,
+        'total_lo': np.maximum(total - z * total_sd, 0),
+        'total_hi': total + z * total_sd,
+    }
+
+def forecast_window(cube, periods, as_of):
+    """
+    P30D 內實際有資料的日子（帳戶開始投放不滿 30 天時，不把之前的空白日當成 0 花費）
+    序列只取到 as_of：逐小時匯出未結束的最後一天不當成整天，改由預估補上
+    """
+    start, end = pd.Timestamp(periods['P30D'][0]), min(pd.Timestamp(periods['P30D'][1]), pd.Timestamp(as_of))
+    days = cube.rollup(['天數'], start, end)['天數']
+    return (max(start, days.min()) if len(days) else start), end
+
+def _forecast_series(cube, dims, start, end, filters=None):
+    """立方體 → (名稱表, 花費矩陣, 轉換矩陣)：每個 dims 組合一列、start ~ end 每天一欄"""
+    days = pd.date_range(start, end, freq='D')
+    daily = cube.rollup(['天數'] + list(dims), start, end, filters)
+    if dims:
+        entity, uniques = pd.MultiIndex.from_frame(daily[list(dims)]).factorize()
+        names = pd.DataFrame({d: uniques.get_level_values(i) for i, d in enumerate(dims)})
+    else:
+        entity, names = np.zeros(len(daily), dtype=np.int64), pd.DataFrame(index=[0])
+    day_idx = days.get_indexer(daily['天數'])
+    spend = np.zeros((len(names), len(days)))
+    conv = np.zeros((len(names), len(days)))
+    spend[entity, day_idx] = daily['花費金額 (TWD)'].to_numpy(dtype=np.float64)
+    conv[entity, day_idx] = daily[cube.conv_col].to_numpy(dtype=np.float64)
+    return names, spend, conv
+
+def build_forecast_table(cube, periods, as_of, level=CI_LEVEL):
+    """
+    全帳戶 + 各活動 + 各組合的月底花費 / 轉換預估（含區間），所有層級的序列疊成一個矩陣一次計算
+    as_of：最後一個完整日（bundle['alert_day']）；逐小時匯出的最後一天若未結束，本月至今只算到 as_of，該天整天由預估補上
+    名稱欄：層級 / 行銷活動名稱 / 廣告組合名稱（該層級用不到的欄為空字串）
+    attrs：month（YYYY-MM）、remaining_days
+    """
+    start, end = forecast_window(cube, periods, as_of)
+    month_start, month_end = forecast_month(end)
+    horizon = (month_end - end).days
+    names, spends, convs = [], [], []
+    for label, dims in FORECAST_LEVELS.items():
+        n, s, c = _forecast_series(cube, dims, start, end)
+        names.append(n.assign(層級=label))
+        spends.append(s)
+        convs.append(c)
+    names = pd.concat(names, ignore_index=True).reindex(columns=['層級'] + FORECAST_LEVELS['廣告組合']).fillna('')
+    spend, conv = np.vstack(spends), np.vstack(convs)
+    if len(names) == 0 or spend.shape[1] == 0:
+        return pd.DataFrame()
+
+    days = pd.date_range(start, end, freq='D')
+    in_month = np.asarray(days >= month_start)
+    fc_spend = seasonal_es_forecast(spend, start, horizon, level)
+    fc_conv = seasonal_es_forecast(conv, start, horizon, level)
+    mtd_spend, mtd_conv = spend[:, in_month].sum(axis=1), conv[:, in_month].sum(axis=1)
+
+    out = names
+    out['本月至今花費 (TWD)'] = mtd_spend
+    out['近7日日均花費 (TWD)'] = spend[:, -7:].mean(axis=1)
+    out['預估月底花費 (TWD)'] = mtd_spend + fc_spend['total']
+    out['月底花費下限 (TWD)'] = mtd_spend + fc_spend['total_lo']
+    out['月底花費上限 (TWD)'] = mtd_spend + fc_spend['total_hi']
+    out['本月至今轉換'] = mtd_conv
+    out['預估月底轉換'] = mtd_conv + fc_conv['total']
+    out['月底轉換下限'] = mtd_conv + fc_conv['total_lo']
+    out['月底轉換上限'] = mtd_conv + fc_conv['total_hi']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['預估月底 CPA (TWD)'] = np.where(
+            out['預估月底轉換'] > 0, out['預估月底花費 (TWD)'] / out['預估月底轉換'], 0
+        )
+    # 近 30 日都沒花費的序列（已停）不列出；各層級內依預估月底花費排序
+    out['_order'] = out['層級'].map({label: i for i, label in enumerate(FORECAST_LEVELS)})
+    out = out[spend.sum(axis=1) > 0]
+    out = out.sort_values(['_order', '預估月底花費 (TWD)'], ascending=[True, False], kind='stable')
+    out = out.drop(columns='_order').reset_index(drop=True).round(2)
+    out.attrs.update(month=f"{month_start:%Y-%m}", remaining_days=horizon)
+    return out
+
+def forecast_daily_frame(cube, periods, as_of, filters, metric, level=CI_LEVEL):
+    """儀表板用：單一對象（filters 篩出，None 為全帳戶）P30D 實際（到 as_of）+ 到月底的逐日預估與區間，index 為日期；metric 為 'spend' / 'conv'"""
+    start, end = forecast_window(cube, periods, as_of)
+    _, spend, conv = _forecast_series(cube, [], start, end, filters)
+    y = spend if metric == 'spend' else conv
+    horizon = (forecast_month(end)[1] - end).days
+    fc = seasonal_es_forecast(y, start, horizon, level)
+    future = pd.date_range(end + timedelta(days=1), periods=horizon, freq='D')
+    actual = pd.DataFrame({'實際': y[0]}, index=pd.date_range(start, end, freq='D'))
+    predicted = pd.DataFrame({'預估': fc['path'][0], '下限': fc['path_lo'][0], '上限': fc['path_hi'][0]}, index=future)
+    return pd.concat([actual, predicted])
+
+# ==========================================
+# 5.15 大量匯出：Parquet 包 / 逐表串流寫入的 CSV zip（皆附 manifest.json）
+# ==========================================
+# 單一工作表的 Excel 寫入慢、開啟慢，下游 BI 還得重新解析；另提供兩種給 pipeline 用的格式：
+# - Parquet 包：每張表一個 .parquet（zstd，保留欄位型別）直接寫進 zip 項目（不再壓縮）；read_parquet_bundle() 讀回
+# - CSV zip：每張表每 EXPORT_CSV_CHUNK_ROWS 列寫一次到 zip 項目（UTF-8、無 BOM），寫到暫存檔，不在記憶體組出整份
+# - manifest.json：資料日期 / 轉換欄 / 區間，與每張表的來源名稱、檔名、列數、欄位型別
+# 限制：Streamlit 的下載按鈕只接受完整內容（bytes），下載時整份檔案會在伺服器記憶體裡放一次；
+# 這裡只做到「按下時才產生」（deferred，沒按就不占記憶體），以及逐表 / 逐塊寫出時不另外組出整份資料表
+EXPORT_FORMAT_VERSION = 1
+EXPORT_CSV_CHUNK_ROWS = 50_000
+EXPORT_SPOOL_MAX_BYTES = 64 * 1024 * 1024  # 暫存在記憶體的上限，超過才落到作業系統自動清除的匿名暫存檔
+
+def export_tables(bundle):
+    """匯出的表：excel_stack 全部 + P1D / P7D 警示 + 新素材 / 新組合摘要"""
+    tables = list(bundle['excel_stack'])
+    extra = [
+        ('Alerts_Daily_P1D', bundle['alerts_daily']), ('Alerts_Weekly_P7D', bundle['alerts_weekly']),
+        ('New_Creatives_Summary', bundle['new_creatives_df']), ('New_AdSets_Summary', bundle['new_adsets_df']),
+    ]
+    return tables + [(name, df) for name, df in extra if df is not None and not df.empty]
+
+def _export_entries(bundle, suffix):
+    """[(表名稱, zip 內檔名, df)]：檔名加序號，保留原順序也避免清洗後撞名"""
+    return [
+        (name, f"{i:02d}_{_safe_filename(name)}{suffix}", df)
+        for i, (name, df) in enumerate(export_tables(bundle), start=1)
+    ]
+
+def _export_manifest(bundle, conversion_col, fmt, entries):
+    return {
+        'format': fmt,
+        'format_version': EXPORT_FORMAT_VERSION,
+        'app_version': PRECOMPUTE_VERSION,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'conversion_col': conversion_col,
+        'max_date': f"{bundle['max_date']:%Y-%m-%d}",
+        'periods': {p: [f"{s:%Y-%m-%d}", f"{e:%Y-%m-%d}"] for p, (s, e) in bundle['periods'].items()},
+        'tables': [
+            {
+                'name': name, 'file': file, 'rows': len(df),
+                'columns': [{'name': str(c), 'dtype': str(t)} for c, t in df.dtypes.items()],
+            }
+            for name, file, df in entries
+        ],
+    }
+
+def _arrow_safe(df):
+    """object 欄混有字串與數字（例如摘要列）時 pyarrow 無法推斷型別 → 該欄轉字串（缺值保留）"""
+    mixed = [
+        c for c in df.columns
+        if df[c].dtype == object and df[c].dropna().map(type).nunique() > 1
+    ]
+    if not mixed:
+        return df
+    return df.assign(**{c: df[c].map(lambda v: v if pd.isna(v) else str(v)) for c in mixed})
+
+def write_parquet_bundle(bundle, conversion_col, target):
+    """所有匯出表 → Parquet 包（target 為路徑或可寫入的二進位檔案物件）；回傳 manifest"""
+    if not HAS_PYARROW:
+        raise ValueError("Parquet 匯出需要 pyarrow")
+    entries = [(name, file, _arrow_safe(df)) for name, file, df in _export_entries(bundle, '.parquet')]
+    manifest = _export_manifest(bundle, conversion_col, 'parquet', entries)
+    with zipfile.ZipFile(target, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for _, file, df in entries:
+            with zf.open(file, 'w', force_zip64=True) as f:
+                df.to_parquet(f, index=False, compression='zstd')
+        zf.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+    return manifest
+
+def write_csv_zip(bundle, conversion_col, target, chunk_rows=EXPORT_CSV_CHUNK_ROWS):
+    """所有匯出表 → CSV zip；每張表分塊寫入 zip 項目（壓縮串流），回傳 manifest"""
+    entries = _export_entries(bundle, '.csv')
+    manifest = _export_manifest(bundle, conversion_col, 'csv', entries)
+    with zipfile.ZipFile(target, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+        for _, file, df in entries:
+            with io.TextIOWrapper(zf.open(file, 'w', force_zip64=True), encoding='utf-8', newline='') as text:
+                for start in range(0, max(len(df), 1), chunk_rows):
+                    df.iloc[start:start + chunk_rows].to_csv(text, header=start == 0, index=False)
+        zf.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+    return manifest
+
+def read_parquet_bundle(source):
+    """Parquet 包 → (manifest, {表名稱: DataFrame})；給下游 pipeline 直接載入"""
+    with zipfile.ZipFile(source) as zf:
+        manifest = json.loads(zf.read('manifest.json'))
+        tables = {}
+        for t in manifest['tables']:
+            with zf.open(t['file']) as f:
+                tables[t['name']] = pd.read_parquet(f)
+    return manifest, tables
+
+def export_download(write, bundle, conversion_col):
+    """
+    下載按鈕的 deferred callable 用：write（write_parquet_bundle / write_csv_zip）先寫到 SpooledTemporaryFile，
+    回傳整份內容 bytes（download_button 需要完整 bytes，無法從檔案串流給瀏覽器）。
+    暫存檔在 with 結束時就關閉並由系統刪除，不會留下有路徑的檔案，在 Windows 上也一樣
+    """
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES) as f:
+        write(bundle, conversion_col, f)
+        f.seek(0)
+        return f.read()
+
+def read_export_file(path, fallback):
+    """預先計算好的匯出檔 → bytes（讀完即關檔）；檔案已被清掉時改呼叫 fallback() 即時產生"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return fallback()
+
+# ==========================================
+# 6. 主程式 UI
+# ==========================================
+st.title("📊 廣告成效全能分析 v6.4 (Dashboard + Instant DL)")
+
+if not HAS_GENAI:
+    st.warning("ℹ️ 提示：未偵測到 `google-generativeai` 套件。系統將自動切換為 **REST API 兼容模式** (只需 API Key 即可運作)。")
+if not HAS_XLSXWRITER:
+    st.warning("⚠️ 警告：未偵測到 `xlsxwriter` 套件。Excel 匯出功能可能會失效。")
+
+if 'gemini_result' not in st.session_state:
+    st.session_state['gemini_result'] = None
+
+# 資料來源：上傳檔案，或（有設定 ADS_DATA_DIR 時）直接讀伺服器資料夾內的大檔
+data_source = "上傳檔案"
+if ADS_DATA_DIR:
+    data_source = st.radio("資料來源", ["上傳檔案", "伺服器資料夾"], horizontal=True, key="data_source")
+
+source_names, raw_key, raw_loader = [], None, None
+precompute_digest = None  # 背景 daemon 預先計算結果的內容雜湊（有的話直接載入）
+if data_source == "伺服器資料夾":
+    server_exports = list_server_exports()
+    export_sizes = {rel: size for rel, size, _ in server_exports}
+    if not server_exports:
+        st.info(f"資料夾 `{ADS_DATA_DIR}` 內沒有 CSV / .csv.gz / .zip / .parquet 檔案。")
+    selected_exports = st.multiselect(
+        f"選擇 `{ADS_DATA_DIR}` 內的匯出檔（可多選）",
+        list(export_sizes), format_func=lambda rel: f"{rel}（{export_sizes[rel] / 1024 ** 2:,.1f} MB）"
+    )
+    use_duckdb = HAS_DUCKDB and st.checkbox(
+        "🦆 DuckDB 直接查詢（超長歷史：只載入最近 30 天，不支援 .zip 與 cp950 編碼）",
+        value=(ANALYSIS_BACKEND == 'duckdb'), key="use_duckdb"
+    )
+    if selected_exports:
+        source_names = selected_exports
+        if use_duckdb:
+            # 與 pandas 路徑分開快取（bundle / Excel 鍵都以 raw_key 最後一段為內容雜湊）
+            raw_key = ('raw', 'duckdb', 'duckdb:' + server_exports_signature(selected_exports))
+            raw_loader = lambda: describe_duckdb_sources(selected_exports)
+        else:
+            raw_key = ('raw', 'server', server_exports_signature(selected_exports))
+            raw_loader = lambda: ingest_server_exports(selected_exports)
+            if len(selected_exports) == 1:
+                precompute_digest = precomputed_digest_for_signature(raw_key[-1])
+else:
+    uploaded_files = st.file_uploader(
+        "請上傳 CSV 報表檔案（可多檔；支援 .zip / .gz 壓縮檔）",
+        type=['csv', 'zip', 'gz'], accept_multiple_files=True
+    )
+    if uploaded_files:
+        source_names = [getattr(f, 'name', '') or 'upload.csv' for f in uploaded_files]
+        raw_key = ('raw', uploaded_files_digest(uploaded_files))
+        precompute_digest = raw_key[-1] if len(uploaded_files) == 1 else None
+        raw_loader = lambda: ingest_uploads(list(zip(source_names, (f.getvalue() for f in uploaded_files))))
+
+if raw_key is not None:
+    try:
+        # 1. 讀取與欄位偵測（多檔平行解析、合併去重；依內容雜湊跨 session 共用）
+        content_hash = raw_key[-1]
+        try:
+            with st.spinner("讀取資料中…"):
+                raw = acquire_dataset('raw', raw_key, lambda: load_precomputed_raw(precompute_digest) or raw_loader())
+        except Exception as e:
+            st.error(f"檔案讀取未知的錯誤: {e}")
+            st.stop()
+
+        df = raw['df']
+        # DuckDB 模式不預先載入資料，只有表頭
+        all_columns = raw['columns'] if df is None else df.columns.tolist()
+        ingest_info = raw['ingest']
+        if df is not None and (ingest_info['files'] > 1 or len(ingest_info['parts']) > 1):
+            st.caption(
+                f"📦 已合併 {ingest_info['files']} 個檔案（{len(ingest_info['parts'])} 個 CSV）："
+                f"{len(df):,} 列，移除重複 {ingest_info['duplicates']:,} 列，解析 {ingest_info['seconds']:.1f} 秒"
+            )
+        # 帳戶識別（用量 / 成本統計用）：以檔名為準
+        account_name = account_name_from_source(source_names[0])
+        
+        # 側邊欄設定
+        with st.sidebar:
+            st.header("⚙️ 分析設定")
+            
+            st.subheader("🤖 AI 分析設定")
+            gemini_api_key = st.text_input("Gemini API Key", type="password", placeholder="輸入 Key 以啟用 AI 分析")
+            st.caption("[取得 Google AI Studio Key](https://aistudio.google.com/app/apikey)")
+            llm_concurrency = st.number_input(
+                "同一把 Key 同時執行的 AI 工作數", min_value=1, max_value=8,
+                value=LLM_DEFAULT_CONCURRENCY_PER_KEY, step=1
+            )
+            active_limit = key_concurrency_limit(gemini_api_key) if gemini_api_key else None
+            if active_limit is not None and active_limit != llm_concurrency:
+                st.caption(f"ℹ️ 這把 Key 的同時工作數已設為 {active_limit}（與其他 session 共用，重新啟動服務後才會套用新值）")
+            st.divider()
+            
+            suggested_idx = suggest_conversion_index(all_columns)
+            conversion_col = st.selectbox("🎯 目標轉換欄位:", options=all_columns, index=suggested_idx)
+
+            spend_col, clicks_col, impressions_col = (
+                find_col(all_columns, opts, canonical) for canonical, opts in STANDARD_METRIC_COLS.items()
+            )
+
+        # 2~3. 清洗、區間切片與各層級匯總（同一份檔案 + 轉換欄位，所有 session 共用一份）
+        try:
+            bundle_key = ('bundle', content_hash, conversion_col)
+            if df is None:
+                bundle_builder = lambda: build_analysis_bundle_duckdb(
+                    raw, conversion_col, spend_col, clicks_col, impressions_col
+                )
+            else:
+                bundle_builder = lambda: (
+                    load_precomputed_bundle(precompute_digest, conversion_col)
+                    or build_analysis_bundle(df, conversion_col, spend_col, clicks_col, impressions_col)
+                )
+            bundle = acquire_dataset('bundle', bundle_key, bundle_builder)
+        except ValueError as e:
+            st.error(str(e))
+            st.stop()
+
+        max_date = bundle['max_date']
+        df_p7d, df_pp7d, df_p30d = (period_frame(bundle, p) for p in ('P7D', 'PP7D', 'P30D'))
+        new_creatives_df = bundle['new_creatives_df']
+        new_adsets_df = bundle['new_adsets_df']
+        bad_apple_df = bundle['bad_apple_df']
+        alerts_daily, alerts_weekly = bundle['alerts_daily'], bundle['alerts_weekly']
+        hourly_df, alerts_intraday = bundle['hourly_df'], bundle['alerts_intraday']
+        res_p1, res_p7, res_pp7, res_p30 = bundle['res_p1'], bundle['res_p7'], bundle['res_pp7'], bundle['res_p30']
+
+        # P7D 多層級 DataFrame 給 AI 用
+        p7_detail_df = res_p7[0][1]
+        p7_ad_df     = res_p7[1][1]
+        p7_adset_df  = res_p7[2][1]
+        p7_camp_df   = res_p7[3][1]
+
+        trend_30d_df = bundle['trend_30d_df']
+        breakdown_cube, breakdown_dims = bundle['breakdown_cube'], bundle['breakdown_dims']
+        cpm_change_df = bundle['cpm_change_df']
+        cpm_change_adset_df = bundle['cpm_change_adset_df']
+        budget_curves_df = bundle['budget_curves_df']
+
+        def current_budget_plan():
+            """戰情室滑桿調整過上限時即時重算（只跑分配，曲線沿用 bundle）；否則用預設上限的結果"""
+            max_change = st.session_state.get('budget_max_change', round(BUDGET_MAX_CHANGE * 100)) / 100
+            if max_change == BUDGET_MAX_CHANGE:
+                return bundle['budget_plan_df']
+            return optimize_budget_allocation(budget_curves_df, max_change)
+
+        # ==========================================
+        # [NEW] 調整 1：將下載邏輯提前至此（確保沒做 AI 也能下載）
+        # ==========================================
+        # 取得目前 session state 的結果 (可能是 None，也可能是跑完後的文字)
+        current_ai_result = st.session_state.get('gemini_result', None)
+        
+        # 產生 Excel Bytes（同資料 + 同 AI 回覆只產生一次）
+        ai_digest = hashlib.sha256(str(current_ai_result or '').encode('utf-8')).hexdigest()
+        excel_bytes = acquire_dataset(
+            'excel', ('excel', content_hash, conversion_col, ai_digest),
+            lambda: (
+                (None if current_ai_result else load_precomputed_excel(precompute_digest, conversion_col))
+                or to_excel_single_sheet_stacked(bundle['excel_stack'], AI_CONSULTANT_PROMPT, current_ai_result)
+            )
+        )
+        
+        with st.sidebar:
+            st.divider()
+            if excel_bytes:
+                dl_label = "📥 下載完整分析報表"
+                if current_ai_result:
+                    dl_label += " (含 AI 分析)"
+                
+                st.download_button(
+                    label=dl_label,
                     data=excel_bytes,
                     file_name=f"Full_Report_{max_date.strftime('%Y%m%d')}.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
@@ -959,148 +4660,310 @@ if uploaded_file is not None:
             else:
                 st.error("Excel 產生失敗 (xlsxwriter 未安裝)")
 
+            # Parquet 包 / CSV zip：按下時才逐表寫到暫存檔（有背景預先計算的 Parquet 包時直接讀檔）
+            export_path = precomputed_export_path(precompute_digest, conversion_col)
+            if HAS_PYARROW:
+                build_parquet = lambda: export_download(write_parquet_bundle, bundle, conversion_col)
+                st.download_button(
+                    label="📦 下載 Parquet 包（pipeline 用）",
+                    data=(lambda: read_export_file(export_path, build_parquet)) if export_path else build_parquet,
+                    file_name=f"Full_Report_{max_date.strftime('%Y%m%d')}_parquet.zip",
+                    mime="application/zip",
+                    on_click="ignore"
+                )
+            st.download_button(
+                label="🗜️ 下載 CSV zip",
+                data=lambda: export_download(write_csv_zip, bundle, conversion_col),
+                file_name=f"Full_Report_{max_date.strftime('%Y%m%d')}_csv.zip",
+                mime="application/zip",
+                on_click="ignore"
+            )
+            st.caption("ℹ️ Parquet 包 / CSV zip 按下才產生；下載時整份檔案會暫存在伺服器記憶體一次（Streamlit 下載按鈕的限制）")
+
+            store_stats = get_dataset_store().stats()
+            st.caption(
+                f"🗄️ 共用資料集：{store_stats['entries']} 份 / {store_stats['total_mb']:.1f} MB"
+                f"（上限 {store_stats['max_mb']:.0f} MB，{store_stats['sessions']} 個 session 使用中）"
+                f" · 命中 {store_stats['hits']} / 建立 {store_stats['builds']} / 淘汰 {store_stats['evictions']}"
+            )
+            if bundle.get('precomputed_at'):
+                st.caption(f"⚡ 已載入背景預先計算結果（{bundle['precomputed_at']}）")
+            if bundle.get('snapshot') and bundle['snapshot']['windows']:
+                snapshot = bundle['snapshot']
+                st.caption(
+                    f"🗃️ 區間匯總取自每日快照（至 {snapshot['max_date']:%Y-%m-%d}）："
+                    f"本次更新 {len(snapshot['changed_days'])} 天，{snapshot['seconds']:.2f} 秒"
+                )
+            if breakdown_dims:
+                st.caption(
+                    f"👥 細分維度：{' / '.join(breakdown_dims)} · P30D 立方體 {breakdown_cube.n_cells:,} 格"
+                    f"（原始 {breakdown_cube.source_rows:,} 列）"
+                )
+            stage_timings = bundle.get('stage_timings') or {}
+            if stage_timings:
+                with st.expander(f"⏱️ 分析管線耗時 {stage_timings['wall'] + stage_timings.get('prepare', 0):.2f}s"):
+                    st.caption(f"匯總階段以 {PIPELINE_MAX_WORKERS} 個執行緒併行（PIPELINE_MAX_WORKERS）；wall 為併行段實際經過時間")
+                    st.dataframe(
+                        pd.DataFrame(sorted(stage_timings.items(), key=lambda kv: -kv[1]), columns=['階段', '秒數']).round(3),
+                        use_container_width=True, hide_index=True
+                    )
+
         # ==========================================
         # [NEW] 調整 2：新增 Dashboard 分頁 (Tab 0)
         # ==========================================
+        # 背景 AI 工作進度（診斷 / 週報可同時進行，不阻塞其他分頁）
+        render_llm_job_panel()
+
         tab_dash, tab1, tab2, tab3, tab4 = st.tabs(["📊 自訂儀表板", "📈 戰情室 & 雙重監控", "📑 詳細數據表 (AdSet+Ad)", "🤖 AI 深度診斷 (Gemini)", "🧾 週報產生器 (LINE Markdown)"])
         
         # ========== Tab 0：自訂儀表板 ==========
         with tab_dash:
-            st.subheader("📈 30天趨勢比較儀表板")
-            st.caption("勾選不同對象，比較其在指定指標上的每日變化趨勢。")
+            # 儀表板：層級 / 對象 / 指標切換只重跑此分頁
+            @st.fragment
+            def render_dashboard_tab():
+                st.subheader("📈 30天趨勢比較儀表板")
+                st.caption("勾選不同對象，比較其在指定指標上的每日變化趨勢。")
             
-            # 1. 選擇層級
-            dash_level = st.radio("1. 選擇分析層級", ["全帳戶 (Account)", "行銷活動 (Campaign)", "廣告組合 (AdSet)", "廣告 (Ad)"], horizontal=True)
+                # 1. 選擇層級
+                dash_level = st.radio("1. 選擇分析層級", ["全帳戶 (Account)", "行銷活動 (Campaign)", "廣告組合 (AdSet)", "廣告 (Ad)"], horizontal=True)
             
-            # 2. 準備篩選資料
-            df_dash = df_p30d.copy()
-            level_col_map = {
-                "行銷活動 (Campaign)": "行銷活動名稱",
-                "廣告組合 (AdSet)": "廣告組合名稱",
-                "廣告 (Ad)": "廣告名稱"
-            }
+                # 2. 準備篩選資料：一律從 P30D 立方體 roll-up（細分維度匯出也不回頭掃原始列）
+                entity_col = None
+                entity_filter = None
+                level_col_map = {
+                    "行銷活動 (Campaign)": "行銷活動名稱",
+                    "廣告組合 (AdSet)": "廣告組合名稱",
+                    "廣告 (Ad)": "廣告名稱"
+                }
             
-            selected_entities = []
-            if dash_level == "全帳戶 (Account)":
-                df_dash['分析對象'] = '全帳戶'
-                selected_entities = ['全帳戶']
-            else:
-                target_col = level_col_map[dash_level]
-                # 過濾掉 '全帳戶平均' 這種統計行
-                unique_items = sorted([x for x in df_dash[target_col].dropna().unique() if '平均' not in str(x)])
-                selected_entities = st.multiselect(f"2. 選擇 {dash_level} (可多選比對)", unique_items)
-                
-                if not selected_entities:
-                    st.info("👆 請從上方選單選擇至少一個項目來顯示圖表")
+                selected_entities = []
+                if dash_level == "全帳戶 (Account)":
+                    selected_entities = ['全帳戶']
                 else:
-                    df_dash = df_dash[df_dash[target_col].isin(selected_entities)].copy()
-                    df_dash['分析對象'] = df_dash[target_col]
-
-            # 3. 選擇指標
-            metric_options = ["花費金額", "轉換數", "CPA", "CTR", "CVR", "CPC", "CPM", "曝光次數", "連結點擊次數"]
-            selected_metric = st.selectbox("3. 選擇指標 (Y軸)", metric_options, index=2) # 預設 CPA
-
-            if selected_entities:
-                # 4. 計算每日數據
-                # 先依 日期 + 分析對象 Groupby Sum
-                daily_agg = df_dash.groupby(['天數', '分析對象']).agg({
-                    '花費金額 (TWD)': 'sum',
-                    conversion_col: 'sum',
-                    '連結點擊次數': 'sum',
-                    '曝光次數': 'sum'
-                }).reset_index()
+                    target_col = level_col_map[dash_level]
+                    # 過濾掉 '全帳戶平均' 這種統計行
+                    unique_items = [x for x in breakdown_cube.values_of(target_col) if '平均' not in str(x)]
+                    selected_entities = st.multiselect(f"2. 選擇 {dash_level} (可多選比對)", unique_items)
                 
-                # 計算衍生指標
-                daily_agg['CPA'] = daily_agg.apply(lambda x: x['花費金額 (TWD)'] / x[conversion_col] if x[conversion_col] > 0 else 0, axis=1)
-                daily_agg['CTR'] = daily_agg.apply(lambda x: x['連結點擊次數'] / x['曝光次數'] * 100 if x['曝光次數'] > 0 else 0, axis=1)
-                daily_agg['CVR'] = daily_agg.apply(lambda x: x[conversion_col] / x['連結點擊次數'] * 100 if x['連結點擊次數'] > 0 else 0, axis=1)
-                daily_agg['CPC'] = daily_agg.apply(lambda x: x['花費金額 (TWD)'] / x['連結點擊次數'] if x['連結點擊次數'] > 0 else 0, axis=1)
-                daily_agg['CPM'] = daily_agg.apply(lambda x: x['花費金額 (TWD)'] / x['曝光次數'] * 1000 if x['曝光次數'] > 0 else 0, axis=1)
+                    if not selected_entities:
+                        st.info("👆 請從上方選單選擇至少一個項目來顯示圖表")
+                    else:
+                        entity_filter = {target_col: selected_entities}
+                        entity_col = target_col
+
+                # 細分維度（匯出檔含年齡 / 性別 / 版位等欄位時）：每條線再依該維度拆開
+                breakdown_col = None
+                if breakdown_dims:
+                    breakdown_choice = st.selectbox("細分維度（選填）", ["（不細分）"] + breakdown_dims, key="dash_breakdown")
+                    breakdown_col = None if breakdown_choice == "（不細分）" else breakdown_choice
+
+                # 3. 選擇指標
+                metric_options = ["花費金額", "轉換數", "CPA", "CTR", "CVR", "CPC", "CPM", "曝光次數", "連結點擊次數"]
+                selected_metric = st.selectbox("3. 選擇指標 (Y軸)", metric_options, index=2) # 預設 CPA
+
+                if selected_entities:
+                    # 4. 計算每日數據
+                    # 先依 日期 + 分析對象 Groupby Sum
+                    group_dims = ['天數'] + [c for c in (entity_col, breakdown_col) if c]
+                    daily_agg = breakdown_cube.rollup(group_dims, filters=entity_filter).copy()
+                    daily_agg['分析對象'] = daily_agg[entity_col].astype(str) if entity_col else '全帳戶'
+                    if breakdown_col:
+                        daily_agg['分析對象'] = daily_agg['分析對象'] + ' · ' + daily_agg[breakdown_col].astype(str)
                 
-                # 對應中文欄位到 DataFrame 欄位
-                metric_map = {
-                    "花費金額": "花費金額 (TWD)",
-                    "轉換數": conversion_col,
-                    "CPA": "CPA",
-                    "CTR": "CTR",
-                    "CVR": "CVR",
-                    "CPC": "CPC",
-                    "CPM": "CPM",
-                    "曝光次數": "曝光次數",
-                    "連結點擊次數": "連結點擊次數"
-                }
+                    # 計算衍生指標
+                    daily_agg['CPA'] = daily_agg.apply(lambda x: x['花費金額 (TWD)'] / x[conversion_col] if x[conversion_col] > 0 else 0, axis=1)
+                    daily_agg['CTR'] = daily_agg.apply(lambda x: x['連結點擊次數'] / x['曝光次數'] * 100 if x['曝光次數'] > 0 else 0, axis=1)
+                    daily_agg['CVR'] = daily_agg.apply(lambda x: x[conversion_col] / x['連結點擊次數'] * 100 if x['連結點擊次數'] > 0 else 0, axis=1)
+                    daily_agg['CPC'] = daily_agg.apply(lambda x: x['花費金額 (TWD)'] / x['連結點擊次數'] if x['連結點擊次數'] > 0 else 0, axis=1)
+                    daily_agg['CPM'] = daily_agg.apply(lambda x: x['花費金額 (TWD)'] / x['曝光次數'] * 1000 if x['曝光次數'] > 0 else 0, axis=1)
                 
-                plot_col = metric_map[selected_metric]
+                    # 對應中文欄位到 DataFrame 欄位
+                    metric_map = {
+                        "花費金額": "花費金額 (TWD)",
+                        "轉換數": conversion_col,
+                        "CPA": "CPA",
+                        "CTR": "CTR",
+                        "CVR": "CVR",
+                        "CPC": "CPC",
+                        "CPM": "CPM",
+                        "曝光次數": "曝光次數",
+                        "連結點擊次數": "連結點擊次數"
+                    }
                 
-                # Pivot 轉換成 st.line_chart 需要的格式 (Index=Date, Columns=Entities, Values=Metric)
-                chart_data = daily_agg.pivot(index='天數', columns='分析對象', values=plot_col)
-                chart_data = chart_data.fillna(0)
+                    plot_col = metric_map[selected_metric]
                 
-                st.markdown(f"#### 📊 {selected_metric} 每日變化趨勢")
-                st.line_chart(chart_data)
+                    # Pivot 轉換成 st.line_chart 需要的格式 (Index=Date, Columns=Entities, Values=Metric)
+                    chart_data = daily_agg.pivot(index='天數', columns='分析對象', values=plot_col)
+                    chart_data = chart_data.fillna(0)
+                
+                    st.markdown(f"#### 📊 {selected_metric} 每日變化趨勢")
+                    st.line_chart(chart_data)
+
+                st.divider()
+                render_forecast_view()
+
+            def render_forecast_view():
+                """月底預估：表格為 bundle 內全部序列一次算好的結果，圖表只對選定對象即時重算逐日路徑"""
+                forecast_df = bundle['forecast_df']
+                if forecast_df.empty:
+                    return
+                st.subheader(
+                    f"🔮 {forecast_df.attrs['month']} 月底花費 / 轉換預估（剩 {forecast_df.attrs['remaining_days']} 天，"
+                    f"{CI_LEVEL:.0%} 區間）"
+                )
+                st.caption("依 P30D 逐日數據以「星期季節性指數平滑」預估剩餘天數，再加上本月至今實際值。")
+                fc_level = st.radio("預估層級", list(FORECAST_LEVELS), horizontal=True, key="forecast_level")
+                fc_dims = FORECAST_LEVELS[fc_level]
+                level_df = forecast_df[forecast_df['層級'] == fc_level]
+                hidden = ['層級'] + [d for d in FORECAST_LEVELS['廣告組合'] if d not in fc_dims]
+                st.dataframe(level_df.drop(columns=hidden), hide_index=True, use_container_width=True)
+
+                c1, c2 = st.columns([2, 1])
+                fc_row = c1.selectbox(
+                    "逐日預估對象", level_df.index.tolist(), key=f"forecast_entity_{fc_level}",
+                    format_func=lambda i: ' / '.join(str(level_df.at[i, d]) for d in fc_dims) or '全帳戶'
+                )
+                fc_metric = c2.radio("指標", ["花費", "轉換"], horizontal=True, key="forecast_metric")
+                fc_filter = {d: [level_df.at[fc_row, d]] for d in fc_dims} if fc_dims and fc_row is not None else None
+                st.line_chart(forecast_daily_frame(
+                    breakdown_cube, bundle['periods'], bundle['alert_day'], fc_filter, 'spend' if fc_metric == "花費" else 'conv'
+                ))
+
+            render_dashboard_tab()
 
         # ========== Tab 1：戰情室 ==========
         with tab1:
-            col_a, col_b = st.columns(2)
-            with col_a:
-                st.subheader("🚨 P1D 緊急警示 (昨日 vs 均值)")
-                if not alerts_daily.empty:
-                    st.dataframe(alerts_daily, hide_index=True, use_container_width=True)
-                else:
-                    st.success("昨日表現平穩 (無 CPA暴漲 / CTR驟降)")
+            # 戰情室：CPM 層級切換等互動只重跑此分頁
+            @st.fragment
+            def render_monitor_tab():
+                def suppressed_note(alerts):
+                    n = alerts.attrs.get('suppressed', 0)
+                    if n:
+                        st.caption(f"🔕 另有 {n} 則因樣本太少（{CI_LEVEL:.0%} 可信區間仍涵蓋基準）而未列出")
+
+                col_a, col_b = st.columns(2)
+                with col_a:
+                    st.subheader("🚨 P1D 緊急警示 (昨日 vs 均值)")
+                    if bundle['alert_day'] != max_date:
+                        st.caption(f"⏱️ {max_date:%m-%d} 尚未結束：改以最後完整日 {bundle['alert_day']:%m-%d} 比對前 7 日均值")
+                    if not alerts_daily.empty:
+                        st.dataframe(alerts_daily, hide_index=True, use_container_width=True)
+                    else:
+                        st.success("昨日表現平穩 (無 CPA暴漲 / CTR驟降)")
+                    suppressed_note(alerts_daily)
             
-            with col_b:
-                st.subheader("📉 P7D 週環比衰退 (本週 vs 上週)")
-                if not alerts_weekly.empty:
-                    st.dataframe(alerts_weekly, hide_index=True, use_container_width=True)
-                else:
-                    st.info("本週無顯著衰退項目 (CPA與CTR皆穩定)")
+                with col_b:
+                    st.subheader("📉 P7D 週環比衰退 (本週 vs 上週)")
+                    if not alerts_weekly.empty:
+                        st.dataframe(alerts_weekly, hide_index=True, use_container_width=True)
+                    else:
+                        st.info("本週無顯著衰退項目 (CPA與CTR皆穩定)")
+                    suppressed_note(alerts_weekly)
+
+                if hourly_df is not None and not hourly_df.empty:
+                    last_day = hourly_df['天數'].max()
+                    last_hour = int(hourly_df.loc[hourly_df['天數'] == last_day, '小時'].max())
+                    st.subheader(
+                        f"⏱️ 盤中警示（{last_day:%m-%d} 0~{last_hour} 時 vs 過去 {INTRADAY_TRAILING_DAYS} 日同時段）"
+                    )
+                    if not alerts_intraday.empty:
+                        st.dataframe(alerts_intraday, hide_index=True, use_container_width=True)
+                    else:
+                        st.success("今日目前為止表現與過去同時段相當")
+                    suppressed_note(alerts_intraday)
 
-            st.divider()
-            # 30日概況
-            total_spend = df_p30d['花費金額 (TWD)'].sum()
-            total_conv = df_p30d[conversion_col].sum()
-            total_impr = df_p30d['曝光次數'].sum()
-            cpa_30d = total_spend / total_conv if total_conv > 0 else 0
-            cpm_30d = (total_spend / total_impr * 1000) if total_impr > 0 else 0
+                st.divider()
+                # 30日概況（每日加總由 P30D 立方體 roll-up）
+                daily = breakdown_cube.rollup(['天數']).copy()
+                total_spend = daily['花費金額 (TWD)'].sum()
+                total_conv = daily[conversion_col].sum()
+                total_impr = daily['曝光次數'].sum()
+                cpa_30d = total_spend / total_conv if total_conv > 0 else 0
+                cpm_30d = (total_spend / total_impr * 1000) if total_impr > 0 else 0
             
-            c1, c2, c3, c4 = st.columns(4)
-            c1.metric("近30日總花費", f"${total_spend:,.0f}")
-            c2.metric("近30日總轉換", f"{total_conv:,.0f}")
-            c3.metric("近30日平均 CPA", f"${cpa_30d:,.0f}")
-            c4.metric("近30日平均 CPM", f"${cpm_30d:,.0f}")
-
-            # 趨勢圖：花費 vs 轉換
-            daily = df_p30d.groupby('天數')[['花費金額 (TWD)', conversion_col, '連結點擊次數', '曝光次數']].sum().reset_index()
-            daily['日期str'] = daily['天數'].dt.strftime('%m-%d')
+                c1, c2, c3, c4 = st.columns(4)
+                c1.metric("近30日總花費", f"${total_spend:,.0f}")
+                c2.metric("近30日總轉換", f"{total_conv:,.0f}")
+                c3.metric("近30日平均 CPA", f"${cpa_30d:,.0f}")
+                c4.metric("近30日平均 CPM", f"${cpm_30d:,.0f}")
+
+                # 趨勢圖：花費 vs 轉換
+                daily['日期str'] = daily['天數'].dt.strftime('%m-%d')
             
-            fig, ax1 = plt.subplots(figsize=(12, 5))
-            ax2 = ax1.twinx()
-            ax1.bar(daily['日期str'], daily['花費金額 (TWD)'], alpha=0.6, label='花費')
-            ax2.plot(daily['日期str'], daily[conversion_col], marker='o', label='轉換數', linewidth=2)
-            ax1.set_xlabel('日期', fontproperties=font_prop)
-            ax1.set_ylabel('花費 (TWD)', fontproperties=font_prop)
-            ax2.set_ylabel('轉換數', fontproperties=font_prop)
-            if font_prop:
-                for label in ax1.get_xticklabels():
-                    label.set_fontproperties(font_prop)
-            st.pyplot(fig)
+                fig, ax1 = plt.subplots(figsize=(12, 5))
+                ax2 = ax1.twinx()
+                ax1.bar(daily['日期str'], daily['花費金額 (TWD)'], alpha=0.6, label='花費')
+                ax2.plot(daily['日期str'], daily[conversion_col], marker='o', label='轉換數', linewidth=2)
+                ax1.set_xlabel('日期', fontproperties=font_prop)
+                ax1.set_ylabel('花費 (TWD)', fontproperties=font_prop)
+                ax2.set_ylabel('轉換數', fontproperties=font_prop)
+                if font_prop:
+                    for label in ax1.get_xticklabels():
+                        label.set_fontproperties(font_prop)
+                st.pyplot(fig)
 
-            st.divider()
-            st.subheader("💰 CPM 變化概況（行銷活動層級：P7D / PP7D / P30D）")
-            if cpm_change_df is not None and not cpm_change_df.empty:
-                st.dataframe(cpm_change_df, use_container_width=True)
-            else:
-                st.info("目前無法產生 CPM 變化表（可能是資料不足或欄位不完整）。")
+                st.divider()
+                st.subheader("💰 CPM 變化概況（P7D / PP7D / P30D）")
+                cpm_level = st.radio("CPM 分析層級", list(CPM_LEVELS.keys()), horizontal=True, key="cpm_level")
+                if cpm_level == '行銷活動 (Campaign)':
+                    cpm_view_df = cpm_change_df
+                elif cpm_level == '廣告組合 (AdSet)':
+                    cpm_view_df = cpm_change_adset_df
+                else:
+                    # 廣告層級不在 bundle 內：第一次選到時才算，之後同資料的 session 共用
+                    cpm_view_df = acquire_dataset(
+                        'cpm', ('cpm', content_hash, conversion_col, cpm_level),
+                        lambda: build_cpm_change_table(cpm_period_tables(bundle, cpm_level), CPM_LEVELS[cpm_level][1])
+                    )
+                if cpm_view_df is not None and not cpm_view_df.empty:
+                    st.dataframe(cpm_view_df, use_container_width=True)
+                else:
+                    st.info("目前無法產生 CPM 變化表（可能是資料不足或欄位不完整）。")
+
+                st.divider()
+                st.subheader("🍎 害群之馬偵測（P7D 廣告組合：移除單一廣告後的 CPA）")
+                if bad_apple_df is not None and not bad_apple_df.empty:
+                    st.dataframe(
+                        bad_apple_df.style.format(na_rep='-', precision=2), hide_index=True, use_container_width=True
+                    )
+                else:
+                    st.success("目前沒有 CPA 超標且花費達門檻的廣告組合。")
+
+                st.divider()
+                st.subheader("🎯 預算重分配建議（P30D 邊際 CPA 曲線，總日預算不變）")
+                st.slider(
+                    "每個廣告組合日預算調整上限（±%）", 5, 100, round(BUDGET_MAX_CHANGE * 100), step=5,
+                    key="budget_max_change"
+                )
+                budget_plan = current_budget_plan()
+                summary = budget_plan_summary(budget_plan)
+                if summary is None:
+                    st.info("P7D 沒有仍在花費的廣告組合，無法產生預算建議。")
+                else:
+                    c1, c2, c3 = st.columns(3)
+                    c1.metric("目前日均總花費", f"${summary['budget']:,.0f}")
+                    c2.metric("預估日轉換（建議配置）", f"{summary['conv_new']:,.1f}", f"{summary['lift_pct']:+.1f}%")
+                    c3.metric("需調整的廣告組合", f"{summary['moved']} / {summary['adsets']}")
+                    st.caption(
+                        f"每個組合以 日轉換 ≈ a·花費^b 擬合 P30D 逐日數據（帳戶共同彈性 "
+                        f"{budget_curves_df.attrs.get('pooled_elasticity', float('nan')):.2f}）；"
+                        f"有花費天數少於 {BUDGET_MIN_ACTIVE_DAYS} 天的組合維持現狀。邊際 CPA = 再多花 1 元換到的轉換之倒數。"
+                    )
+                    st.dataframe(budget_plan, hide_index=True, use_container_width=True)
+
+            render_monitor_tab()
 
         # ========== Tab 2：詳細數據表 ==========
         with tab2:
             st.markdown("### 🔍 各區間詳細數據 (行銷活動 > 廣告組合 > 廣告)")
             t_p1, t_p7, t_pp7, t_p30 = st.tabs(["P1D (昨日)", "P7D (本週)", "PP7D (上週)", "P30D (月報)"])
             
+            # 每個區間各自為一個 fragment：篩選 / 翻頁只重跑該區間
+            @st.fragment
             def render_data_tab(results_list, unique_key):
                 st.info("💡 下表為「詳細層級」，可看到每個 行銷活動 > 廣告組合 > 廣告 的表現（含 CPA / CTR / CVR / CPM）。")
-                st.dataframe(results_list[0][1], use_container_width=True)
+                detail_name, detail_df = results_list[0]
+                render_paged_table(detail_df, detail_name, bundle_key, f"{unique_key}_detail")
                 
                 with st.expander("查看其他匯總層級 (行銷活動 / 廣告組合 / 廣告整體)"):
                     view_mode = st.radio(
@@ -1109,12 +4972,38 @@ if uploaded_file is not None:
                         horizontal=True,
                         key=unique_key
                     )
-                    if view_mode == "行銷活動 (Campaign)":
-                        st.dataframe(results_list[3][1], use_container_width=True)
-                    elif view_mode == "廣告組合 (AdSet)":
-                        st.dataframe(results_list[2][1], use_container_width=True)
-                    elif view_mode == "廣告 (Ad)":
-                        st.dataframe(results_list[1][1], use_container_width=True)
+                    level_idx = {"行銷活動 (Campaign)": 3, "廣告組合 (AdSet)": 2, "廣告 (Ad)": 1}[view_mode]
+                    level_name, level_df = results_list[level_idx]
+                    render_paged_table(level_df, level_name, bundle_key, f"{unique_key}_{level_idx}")
+
+                if breakdown_dims:
+                    with st.expander(f"👥 依細分維度下鑽（{' / '.join(breakdown_dims)}）"):
+                        render_breakdown_drilldown(detail_name.split('_')[0], unique_key)
+
+            def render_breakdown_drilldown(period, unique_key):
+                """層級 × 細分維度：從 P30D 立方體 roll-up，可再限定單一活動 / 組合"""
+                c1, c2 = st.columns(2)
+                bd_level = c1.selectbox(
+                    "層級", list(BREAKDOWN_LEVELS), key=f"{unique_key}_bd_level"
+                )
+                bd_dims = c2.multiselect(
+                    "細分維度", breakdown_dims, default=breakdown_dims[:1], key=f"{unique_key}_bd_dims"
+                )
+                level_dims = BREAKDOWN_LEVELS[bd_level]
+                bd_filter = None
+                if level_dims:
+                    focus = st.multiselect(
+                        f"限定{bd_level}（選填）", breakdown_cube.values_of(level_dims[-1]), key=f"{unique_key}_bd_focus"
+                    )
+                    bd_filter = {level_dims[-1]: focus} if focus else None
+                if not bd_dims:
+                    st.info("👆 請選擇至少一個細分維度")
+                    return
+                bd_name = f"{period}_Breakdown_{bd_level}_{'x'.join(bd_dims)}"
+                if bd_filter:
+                    bd_name += '_' + hashlib.sha256(repr(sorted(bd_filter.items())).encode('utf-8')).hexdigest()[:12]
+                bd_df = breakdown_metrics_table(breakdown_cube, level_dims, bd_dims, bundle['periods'][period], bd_filter)
+                render_paged_table(bd_df, bd_name, bundle_key, f"{unique_key}_bd")
 
             with t_p1:
                 render_data_tab(res_p1, "radio_p1")
@@ -1127,329 +5016,276 @@ if uploaded_file is not None:
 
         # ========== Tab 3：AI 深度診斷 ==========
         with tab3:
-            st.header("🤖 Gemini AI 廣告成效診斷")
-            st.markdown("""
+            # AI 診斷：設定勾選只重跑此分頁（送出工作後才整頁刷新）
+            @st.fragment
+            def render_ai_tab():
+                st.header("🤖 Gemini AI 廣告成效診斷")
+                st.markdown("""
 AI 將依照「帳戶層級 → 行銷活動 → AdSet → 廣告 → 30 日趨勢 → CPM 變化」的多層級數據，
 自動產生優化診斷報告與可執行建議，並特別說明 CPM 變化對 CPA / CPC 的影響。
-            """)
-            
-            col_ai_btn, _ = st.columns([1, 2])
-            with col_ai_btn:
-                run_ai = st.button("🚀 開始 AI 智能分析", type="primary")
-            
-            if run_ai:
-                if not gemini_api_key:
-                    st.warning("⚠️ 請先於左側側邊欄輸入 Gemini API Key")
-                else:
-                    analysis_result = call_gemini_analysis(
-                        api_key=gemini_api_key,
-                        alerts_daily=alerts_daily,
-                        alerts_weekly=alerts_weekly,
-                        campaign_summary=p7_camp_df,
-                        adset_p7=p7_adset_df,
-                        ad_p7=p7_ad_df,
-                        trend_30d=trend_30d_df,
-                        cpm_change_table=cpm_change_df,
-                        new_creatives=new_creatives_df,
-                        new_adsets=new_adsets_df
+                """)
+
+                diag_status, _, _ = get_llm_job_status('diagnosis')
+                large_account = needs_map_reduce(p7_camp_df, p7_adset_df, p7_ad_df)
+                use_map_reduce = st.checkbox(
+                    "🧩 大型帳戶模式（Map-Reduce：依活動分段平行初診，再彙整成完整報告）",
+                    value=large_account,
+                    help=f"單次分析只會帶入花費前 {SINGLE_CALL_LIMITS['campaigns']} 個活動 / "
+                         f"{SINGLE_CALL_LIMITS['adsets']} 個 AdSet / {SINGLE_CALL_LIMITS['ads']} 支廣告；"
+                         f"大型帳戶模式會以 {GEMINI_MAP_MODEL} 分析全部項目。"
+                )
+                col_ai_btn, _ = st.columns([1, 2])
+                with col_ai_btn:
+                    run_ai = st.button(
+                        "🚀 開始 AI 智能分析", type="primary",
+                        disabled=diag_status in ('queued', 'running')
                     )
-                    st.session_state['gemini_result'] = analysis_result
-                    # 強制重新執行一次以刷新側邊欄下載按鈕的內容
-                    st.rerun()
-            
-            if st.session_state['gemini_result']:
-                st.markdown("### 📝 AI 診斷報告")
-                st.markdown("---")
-                st.markdown(st.session_state['gemini_result'])
 
+                if run_ai:
+                    if not gemini_api_key:
+                        st.warning("⚠️ 請先於左側側邊欄輸入 Gemini API Key")
+                    else:
+                        # 背景執行：完成後由進度面板寫回 gemini_result 並刷新側邊欄下載按鈕
+                        diag_kwargs = {'detail_p7': p7_detail_df} if use_map_reduce else {}
+                        submit_llm_job(
+                            'diagnosis', gemini_api_key,
+                            call_gemini_analysis_map_reduce if use_map_reduce else call_gemini_analysis,
+                            concurrency=llm_concurrency,
+                            usage_context={'account': account_name},
+                            **diag_kwargs,
+                            alerts_daily=alerts_daily,
+                            alerts_weekly=alerts_weekly,
+                            campaign_summary=p7_camp_df,
+                            adset_p7=p7_adset_df,
+                            ad_p7=p7_ad_df,
+                            trend_30d=trend_30d_df,
+                            cpm_change_table=cpm_change_df,
+                            cpm_change_adset=cpm_change_adset_df,
+                            new_creatives=new_creatives_df,
+                            new_adsets=new_adsets_df,
+                            bad_apples=bad_apple_df,
+                            budget_plan=current_budget_plan()
+                        )
+                        st.rerun()
+
+                cache_stats = get_prompt_cache_stats()
+                if cache_stats['calls_cached'] or cache_stats['calls_uncached']:
+                    st.caption(
+                        f"系統指令快取：命中 {cache_stats['calls_cached']} 次（平均 {cache_stats['avg_latency_cached']}s）/ "
+                        f"未命中 {cache_stats['calls_uncached']} 次（平均 {cache_stats['avg_latency_uncached']}s）｜"
+                        f"輸入 token {cache_stats['prompt_tokens']:,}，其中快取 {cache_stats['cached_tokens']:,}"
+                    )
 
-        # ========== Tab 4：週報產生器（LINE Markdown） ==========
-        PLAN_TYPES = [
-            "1. 做簡易的開關、預算調配即可",
-            "2. 補素材",
-            "3. 補受眾",
-            "4. 進行到達頁面優化",
-            "5. 預算縮減、提高",
-            "6. 維持即可",
-        ]
-
-        def _fmt_pct(x):
-            return f"{x:.2f}%"
-
-        def _fmt_money(x):
-            return f"${x:,.0f}"
-
-        def _weekly_report_ai_prompt(p7_overall, pp7_overall, top_adsets_p7, top_ads_p7):
-            return f"""
-你是一位成效廣告代操顧問。請用「可直接貼給客戶的週報語氣」輸出繁體中文，保持簡潔、可執行。
-
-【本週 P7D 概況】
-- 花費：{p7_overall['spend']}
-- 轉換：{p7_overall['conv']}
-- CPA：{p7_overall['cpa']}
-- CTR：{p7_overall['ctr']}%
-- CPC：{p7_overall['cpc']}
-
-【上週 PP7D 概況】
-- 花費：{pp7_overall['spend']}
-- 轉換：{pp7_overall['conv']}
-- CPA：{pp7_overall['cpa']}
-- CTR：{pp7_overall['ctr']}%
-- CPC：{pp7_overall['cpc']}
+                diag_error = st.session_state.get('llm_job_errors', {}).pop('diagnosis', None)
+                if diag_error:
+                    st.error(diag_error)
 
-【AdSet（視為受眾單位）P7D Top】
-{safe_to_markdown(top_adsets_p7)}
+                if st.session_state['gemini_result']:
+                    st.markdown("### 📝 AI 診斷報告")
+                    st.markdown("---")
+                    st.markdown(st.session_state['gemini_result'])
 
-【Ad（視為素材單位）P7D Top】
-{safe_to_markdown(top_ads_p7)}
+                with st.expander("📈 AI 用量、延遲與成本（所有帳戶 / 所有 session）"):
+                    usage_df = load_llm_usage()
+                    if usage_df.empty:
+                        st.caption(f"尚無紀錄（紀錄檔：{LLM_USAGE_LOG}）")
+                    else:
+                        st.markdown("**每日**")
+                        st.dataframe(summarize_llm_usage(usage_df, ['date']), hide_index=True, use_container_width=True)
+                        st.markdown("**每個帳戶**")
+                        st.dataframe(summarize_llm_usage(usage_df, ['account']), hide_index=True, use_container_width=True)
+                        st.markdown("**功能 × 模型**")
+                        st.dataframe(summarize_llm_usage(usage_df, ['feature', 'model']), hide_index=True, use_container_width=True)
+                        st.caption("成本依 GEMINI_PRICING_USD_PER_1M 估算；延遲 / TTFT 單位為秒。")
 
-請輸出 JSON（務必是 JSON，不能有多餘文字），格式如下：
-{{
-  "status_summary": "一段 2~4 句的現況描述（包含：哪些受眾有效/無效、哪些素材有效/無效）",
-  "audience_effective": ["受眾/AdSet A（理由）", "..."],
-  "audience_ineffective": ["受眾/AdSet B（理由）", "..."],
-  "creative_effective": ["素材/Ad X（理由）", "..."],
-  "creative_ineffective": ["素材/Ad Y（理由）", "..."],
-  "next_week_plan_reco": [
-    {{
-      "type": "1. 做簡易的開關、預算調配即可",
-      "recommend": true,
-      "reason": "為何建議/不建議",
-      "actions": ["具體動作 1", "具體動作 2"]
-    }}
-  ]
-}}
-"""
+            render_ai_tab()
 
-        def _try_parse_json(s):
-            try:
-                return json.loads(s)
-            except Exception:
-                s2 = re.sub(r"^```json\s*|\s*```$", "", str(s).strip(), flags=re.IGNORECASE)
-                try:
-                    return json.loads(s2)
-                except Exception:
-                    return None
 
+        # ========== Tab 4：週報產生器（LINE Markdown） ==========
         with tab4:
-            st.subheader("🧾 每週周報（可貼 LINE）")
-            st.caption("流程：AI 先產草案 → 你勾選/編輯 → 產出 Markdown")
-
-            # 1) P7D / PP7D 帳戶概況
-            p7_overall = calc_period_overall(df_p7d, conversion_col)
-            pp7_overall = calc_period_overall(df_pp7d, conversion_col)
-
-            # 2) 取受眾/素材 Top（避免把整張表丟給 AI 太長）
-            top_adsets = get_top_by_spend(p7_adset_df, n=12, min_spend=500)
-            top_ads = get_top_by_spend(p7_ad_df, n=12, min_spend=300)
-
-            # 3) 顯示概況
-            c1, c2 = st.columns(2)
-            with c1:
-                st.markdown("**P7D 概況**")
-                st.write({
-                    "花費": _fmt_money(p7_overall["spend"]),
-                    "轉換": int(p7_overall["conv"]),
-                    "CPA": _fmt_money(p7_overall["cpa"]),
-                    "CTR": _fmt_pct(p7_overall["ctr"]),
-                    "CPC": _fmt_money(p7_overall["cpc"]),
-                })
-            with c2:
-                st.markdown("**PP7D 概況**")
-                st.write({
-                    "花費": _fmt_money(pp7_overall["spend"]),
-                    "轉換": int(pp7_overall["conv"]),
-                    "CPA": _fmt_money(pp7_overall["cpa"]),
-                    "CTR": _fmt_pct(pp7_overall["ctr"]),
-                    "CPC": _fmt_money(pp7_overall["cpc"]),
-                })
-
-            st.divider()
+            # 週報產生器：編輯區以 form 批次送出，只重跑此分頁
+            @st.fragment
+            def render_weekly_tab():
+                st.subheader("🧾 每週周報（可貼 LINE）")
+                st.caption("流程：AI 先產草案 → 你勾選/編輯 → 產出 Markdown")
+
+                # 1) P7D / PP7D 帳戶概況
+                p7_overall = calc_period_overall(df_p7d, conversion_col)
+                pp7_overall = calc_period_overall(df_pp7d, conversion_col)
+
+                # 2) 取受眾/素材 Top（避免把整張表丟給 AI 太長）
+                top_adsets = get_top_by_spend(p7_adset_df, n=12, min_spend=500)
+                top_ads = get_top_by_spend(p7_ad_df, n=12, min_spend=300)
+
+                # 3) 顯示概況
+                c1, c2 = st.columns(2)
+                with c1:
+                    st.markdown("**P7D 概況**")
+                    st.write({
+                        "花費": _fmt_money(p7_overall["spend"]),
+                        "轉換": int(p7_overall["conv"]),
+                        "CPA": _fmt_money(p7_overall["cpa"]),
+                        "CTR": _fmt_pct(p7_overall["ctr"]),
+                        "CPC": _fmt_money(p7_overall["cpc"]),
+                    })
+                with c2:
+                    st.markdown("**PP7D 概況**")
+                    st.write({
+                        "花費": _fmt_money(pp7_overall["spend"]),
+                        "轉換": int(pp7_overall["conv"]),
+                        "CPA": _fmt_money(pp7_overall["cpa"]),
+                        "CTR": _fmt_pct(pp7_overall["ctr"]),
+                        "CPC": _fmt_money(pp7_overall["cpc"]),
+                    })
 
-            # 4) 生成週報草案（AI）
-            if "weekly_draft" not in st.session_state:
-                st.session_state["weekly_draft"] = None
+                st.divider()
 
-            col_btn, col_hint = st.columns([1, 3])
-            with col_btn:
-                gen_weekly = st.button("🤖 生成週報草案", type="primary")
-            with col_hint:
-                st.info("會輸出：現況描述 / 有效無效受眾與素材 / 下週計畫（6 類）→ 你再勾選與改字")
+                # 4) 生成週報草案（AI）
+                if "weekly_draft" not in st.session_state:
+                    st.session_state["weekly_draft"] = None
 
-            if gen_weekly:
-                if not gemini_api_key:
-                    st.warning("⚠️ 請先於左側側邊欄輸入 Gemini API Key")
-                else:
-                    prompt = _weekly_report_ai_prompt(p7_overall, pp7_overall, top_adsets, top_ads)
-                    with st.spinner("AI 週報草案生成中..."):
-                        try:
-                            if HAS_GENAI:
-                                genai.configure(api_key=gemini_api_key)
-                                model = genai.GenerativeModel("gemini-2.5-pro")
-                                resp = model.generate_content(prompt)
-                                raw_text = resp.text if hasattr(resp, "text") else str(resp)
-                            else:
-                                url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-pro:generateContent?key={gemini_api_key}"
-                                headers = {"Content-Type": "application/json"}
-                                data = {"contents": [{"parts": [{"text": prompt}]}]}
-                                r = requests.post(url, headers=headers, json=data)
-                                if r.status_code == 200:
-                                    j = r.json()
-                                    raw_text = j["candidates"][0]["content"]["parts"][0]["text"]
-                                else:
-                                    raw_text = ""
-                        except Exception as e:
-                            raw_text = ""
-
-                    parsed = _try_parse_json(raw_text)
-                    if not parsed:
-                        st.error("AI 回傳不是可解析 JSON（可能混入其它文字）。你可以把回傳貼到下方手動修正。")
-                        st.text_area("AI 原始回傳", value=str(raw_text), height=220)
+                weekly_status, _, _ = get_llm_job_status('weekly')
+                col_btn, col_hint = st.columns([1, 3])
+                with col_btn:
+                    gen_weekly = st.button(
+                        "🤖 生成週報草案", type="primary",
+                        disabled=weekly_status in ('queued', 'running')
+                    )
+                with col_hint:
+                    st.info("會輸出：現況描述 / 有效無效受眾與素材 / 下週計畫（6 類）→ 你再勾選與改字")
+                    wk_stats = get_weekly_json_stats()
+                    if wk_stats['calls']:
+                        st.caption(
+                            f"JSON 成功率 {wk_stats['success_rate']}%（直接 {wk_stats['direct']} / 本地修復 {wk_stats['repaired']} / "
+                            f"失敗 {wk_stats['failed']}，重試 {wk_stats['retries']} 次）"
+                        )
+
+                if gen_weekly:
+                    if not gemini_api_key:
+                        st.warning("⚠️ 請先於左側側邊欄輸入 Gemini API Key")
                     else:
-                        st.session_state["weekly_draft"] = parsed
-
-            draft = st.session_state.get("weekly_draft")
-            if not draft:
-                st.stop()
-
-            st.divider()
-            st.subheader("✍️ 你可勾選、編輯、補充")
+                        prompt = _weekly_report_ai_prompt(p7_overall, pp7_overall, top_adsets, top_ads)
+                        submit_llm_job(
+                            'weekly', gemini_api_key, call_gemini_weekly_draft, prompt,
+                            concurrency=llm_concurrency, usage_context={'account': account_name}
+                        )
+                        st.rerun()
+
+                weekly_error = st.session_state.get('llm_job_errors', {}).pop('weekly', None)
+                if weekly_error:
+                    st.error(weekly_error)
+                weekly_raw_error = st.session_state.get('weekly_raw_error')
+                if weekly_raw_error is not None:
+                    st.error("AI 回傳不是可解析 JSON（可能混入其它文字）。你可以把回傳貼到下方手動修正。")
+                    st.text_area("AI 原始回傳", value=weekly_raw_error, height=220)
+
+                draft = st.session_state.get("weekly_draft")
+                if not draft:
+                    return
 
-            # 5) 現況描述（可編輯）
-            status_summary = st.text_area(
-                "現況描述（可改）",
-                value=str(draft.get("status_summary", "")),
-                height=120
-            )
+                st.divider()
+                # 編輯區放在 form 內：打字 / 勾選不觸發重跑，按「套用」才一次送出並更新 Markdown
+                with st.form("weekly_editor"):
+                    st.subheader("✍️ 你可勾選、編輯、補充")
+
+                    # 5) 現況描述（可編輯）
+                    status_summary = st.text_area(
+                        "現況描述（可改）",
+                        value=str(draft.get("status_summary", "")),
+                        height=120
+                    )
 
-            # 6) 有效/無效受眾與素材：勾選 + 可編輯
-            def editable_checklist(title, items, key_prefix):
-                st.markdown(f"### {title}")
-                chosen = []
+                    # 6) 有效/無效受眾與素材：勾選 + 可編輯
+                    def editable_checklist(title, items, key_prefix):
+                        st.markdown(f"### {title}")
+                        chosen = []
 
-                items = items or []
-                for i, it in enumerate(items):
-                    k_chk = f"{key_prefix}_chk_{i}"
-                    k_txt = f"{key_prefix}_txt_{i}"
+                        items = items or []
+                        for i, it in enumerate(items):
+                            k_chk = f"{key_prefix}_chk_{i}"
+                            k_txt = f"{key_prefix}_txt_{i}"
 
-                    # 只在 widget 建立前初始化預設值（一次）
-                    if k_chk not in st.session_state:
-                        st.session_state[k_chk] = True
-                    if k_txt not in st.session_state:
-                        st.session_state[k_txt] = str(it)
+                            # 只在 widget 建立前初始化預設值（一次）
+                            if k_chk not in st.session_state:
+                                st.session_state[k_chk] = True
+                            if k_txt not in st.session_state:
+                                st.session_state[k_txt] = str(it)
 
-                    # 由 widget 自行更新 session_state，避免重複賦值造成錯誤
-                    st.checkbox("採用", key=k_chk)
-                    st.text_input("內容", key=k_txt)
+                            # 由 widget 自行更新 session_state，避免重複賦值造成錯誤
+                            st.checkbox("採用", key=k_chk)
+                            st.text_input("內容", key=k_txt)
 
-                    if st.session_state.get(k_chk) and str(st.session_state.get(k_txt, "")).strip():
-                        chosen.append(str(st.session_state.get(k_txt, "")).strip())
+                            if st.session_state.get(k_chk) and str(st.session_state.get(k_txt, "")).strip():
+                                chosen.append(str(st.session_state.get(k_txt, "")).strip())
 
-                    st.divider()
+                            st.divider()
 
-                return chosen
+                        return chosen
 
-            colL, colR = st.columns(2)
-            with colL:
-                aud_eff = editable_checklist("✅ 有效受眾（AdSet）", draft.get("audience_effective", []), "aud_eff")
-                aud_bad = editable_checklist("❌ 無效受眾（AdSet）", draft.get("audience_ineffective", []), "aud_bad")
-            with colR:
-                cre_eff = editable_checklist("✅ 有效素材（Ad）", draft.get("creative_effective", []), "cre_eff")
-                cre_bad = editable_checklist("❌ 無效素材（Ad）", draft.get("creative_ineffective", []), "cre_bad")
+                    colL, colR = st.columns(2)
+                    with colL:
+                        aud_eff = editable_checklist("✅ 有效受眾（AdSet）", draft.get("audience_effective", []), "aud_eff")
+                        aud_bad = editable_checklist("❌ 無效受眾（AdSet）", draft.get("audience_ineffective", []), "aud_bad")
+                    with colR:
+                        cre_eff = editable_checklist("✅ 有效素材（Ad）", draft.get("creative_effective", []), "cre_eff")
+                        cre_bad = editable_checklist("❌ 無效素材（Ad）", draft.get("creative_ineffective", []), "cre_bad")
 
-            st.divider()
-
-            # 7) 下週計畫：6 類型逐一顯示（勾選採用 + 編輯理由 + 編輯 actions）
-            st.markdown("### 📌 下週計畫（你決定採用哪些）")
-            plan_recos = draft.get("next_week_plan_reco", [])
-
-            reco_map = {p.get("type"): p for p in plan_recos if isinstance(p, dict) and p.get("type")}
-            merged_plans = []
-            for t in PLAN_TYPES:
-                p = reco_map.get(t, {"type": t, "recommend": False, "reason": "", "actions": []})
-                merged_plans.append(p)
-
-            selected_plans = []
-            for idx, p in enumerate(merged_plans):
-                t = p.get("type", "")
-                default_on = bool(p.get("recommend", False))
-
-                k_on = f"plan_on_{idx}"
-                k_reason = f"plan_reason_{idx}"
-                k_actions = f"plan_actions_{idx}"
-
-                if k_on not in st.session_state:
-                    st.session_state[k_on] = default_on
-                if k_reason not in st.session_state:
-                    st.session_state[k_reason] = str(p.get("reason", ""))
-                if k_actions not in st.session_state:
-                    st.session_state[k_actions] = "\n".join(p.get("actions", []) or [])
-
-                st.markdown(f"**{t}**")
-                st.checkbox("採用此計畫", key=k_on)
-                st.text_area("理由（可改）", height=80, key=k_reason)
-                st.text_area("具體動作（每行一條，可改）", height=100, key=k_actions)
-
-                if st.session_state[k_on]:
-                    actions_list = [x.strip() for x in st.session_state[k_actions].splitlines() if x.strip()]
-                    selected_plans.append({
-                        "type": t,
-                        "reason": st.session_state[k_reason].strip(),
-                        "actions": actions_list
-                    })
-                st.divider()
+                    st.divider()
 
-            # 8) 補充輸入框
-            client_note = st.text_area("補充說明（可選）", value="", height=120)
-
-            # 9) 拼 Markdown（LINE 可貼）
-            def build_markdown():
-                lines = []
-                lines.append("## 📊 本週廣告週報")
-                lines.append("")
-                lines.append("### 1) 簡要概況")
-                lines.append(f"- **P7D** 花費 {_fmt_money(p7_overall['spend'])}｜轉換 {int(p7_overall['conv'])}｜CPA {_fmt_money(p7_overall['cpa'])}｜CTR {_fmt_pct(p7_overall['ctr'])}｜CPC {_fmt_money(p7_overall['cpc'])}")
-                lines.append(f"- **PP7D** 花費 {_fmt_money(pp7_overall['spend'])}｜轉換 {int(pp7_overall['conv'])}｜CPA {_fmt_money(pp7_overall['cpa'])}｜CTR {_fmt_pct(pp7_overall['ctr'])}｜CPC {_fmt_money(pp7_overall['cpc'])}")
-                lines.append("")
-                lines.append("### 2) 現況描述")
-                if status_summary.strip():
-                    lines.append(status_summary.strip())
-                lines.append("")
-                lines.append("### 3) 受眾與素材表現")
-                if aud_eff:
-                    lines.append("**✅ 有效受眾（AdSet）**")
-                    lines += [f"- {x}" for x in aud_eff]
-                if aud_bad:
-                    lines.append("**❌ 無效受眾（AdSet）**")
-                    lines += [f"- {x}" for x in aud_bad]
-                if cre_eff:
-                    lines.append("**✅ 有效素材（Ad）**")
-                    lines += [f"- {x}" for x in cre_eff]
-                if cre_bad:
-                    lines.append("**❌ 無效素材（Ad）**")
-                    lines += [f"- {x}" for x in cre_bad]
-                lines.append("")
-                lines.append("### 4) 下週計畫")
-                if selected_plans:
-                    for p in selected_plans:
-                        lines.append(f"**{p['type']}**")
-                        if p.get("reason"):
-                            lines.append(f"- 理由：{p['reason']}")
-                        if p.get("actions"):
-                            lines.append("- 動作：")
-                            lines += [f"  - {a}" for a in p["actions"]]
-                else:
-                    lines.append("- 本週建議維持為主，先觀察數據穩定性。")
-                if client_note.strip():
-                    lines.append("")
-                    lines.append("### 5) 補充")
-                    lines.append(client_note.strip())
-                return "\n".join(lines)
+                    # 7) 下週計畫：6 類型逐一顯示（勾選採用 + 編輯理由 + 編輯 actions）
+                    st.markdown("### 📌 下週計畫（你決定採用哪些）")
+                    plan_recos = draft.get("next_week_plan_reco", [])
+
+                    reco_map = {p.get("type"): p for p in plan_recos if isinstance(p, dict) and p.get("type")}
+                    merged_plans = []
+                    for t in PLAN_TYPES:
+                        p = reco_map.get(t, {"type": t, "recommend": False, "reason": "", "actions": []})
+                        merged_plans.append(p)
+
+                    selected_plans = []
+                    for idx, p in enumerate(merged_plans):
+                        t = p.get("type", "")
+                        default_on = bool(p.get("recommend", False))
+
+                        k_on = f"plan_on_{idx}"
+                        k_reason = f"plan_reason_{idx}"
+                        k_actions = f"plan_actions_{idx}"
+
+                        if k_on not in st.session_state:
+                            st.session_state[k_on] = default_on
+                        if k_reason not in st.session_state:
+                            st.session_state[k_reason] = str(p.get("reason", ""))
+                        if k_actions not in st.session_state:
+                            st.session_state[k_actions] = "\n".join(p.get("actions", []) or [])
+
+                        st.markdown(f"**{t}**")
+                        st.checkbox("採用此計畫", key=k_on)
+                        st.text_area("理由（可改）", height=80, key=k_reason)
+                        st.text_area("具體動作（每行一條，可改）", height=100, key=k_actions)
+
+                        if st.session_state[k_on]:
+                            actions_list = [x.strip() for x in st.session_state[k_actions].splitlines() if x.strip()]
+                            selected_plans.append({
+                                "type": t,
+                                "reason": st.session_state[k_reason].strip(),
+                                "actions": actions_list
+                            })
+                        st.divider()
+
+                    # 8) 補充輸入框
+                    client_note = st.text_area("補充說明（可選）", value="", height=120)
+
+                    st.form_submit_button("✅ 套用編輯並更新 Markdown", type="primary")
+
+                # 9) 拼 Markdown（LINE 可貼）
+                md = build_weekly_markdown(
+                    p7_overall, pp7_overall, status_summary, aud_eff, aud_bad, cre_eff, cre_bad, selected_plans, client_note
+                )
 
-            md = build_markdown()
+                st.subheader("📋 可複製 Markdown（貼給客戶）")
+                st.code(md, language="markdown")
 
-            st.subheader("📋 可複製 Markdown（貼給客戶）")
-            st.code(md, language="markdown")
+            render_weekly_tab()
 
     except Exception as e:
         st.error(f"系統發生未預期的錯誤: {e}")
@@ -0,0 +1,110 @@
+"""
+批次週報：一次替資料夾內所有帳戶（每個匯出檔 = 一個帳戶）產生週報草案與 LINE Markdown。
+
+- 週報輸入與「🧾 週報產生器」分頁相同（P7D / PP7D 概況、Top AdSet / Ad）；有背景預先計算結果時直接載入
+- 讀檔 / 匯總以 --build-workers 個子行程進行，每完成一個帳戶就立刻排入 AI 佇列（讀檔與等 AI 重疊）
+- AI 呼叫依 API Key 的 RPM / TPM 額度排程（app.py 5.12 token bucket），429 時整把 Key 退避後重試
+- 輸出：--out/<帳戶>.json（草案 + 重試資訊）、--out/<帳戶>.md（草案預設勾選的 Markdown）、summary.json
+  帳戶 = 匯出檔相對於 --dir 的路徑（去掉副檔名）：子資料夾內的同名檔（clientA/export.csv、clientB/export.csv）分開輸出
+
+使用方式：
+  # 資料夾內全部帳戶，額度 150 RPM / 2M TPM
+  GEMINI_API_KEY=... python batch_weekly_reports.py --dir /data/exports --rpm 150 --tpm 2000000
+
+  # 對本地 mock 測試（mock 以 --error-429-rate 注入限流）
+  GEMINI_API_BASE=http://127.0.0.1:8765 python batch_weekly_reports.py --dir /data/exports --api-key mock-key
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+_app = None
+
+
+def load_app(app_dir):
+    """在目前行程載入 app.py（bare mode，不啟動 UI）"""
+    global _app
+    if _app is None:
+        sys.path.insert(0, os.path.abspath(app_dir))
+        sys.argv = [sys.argv[0]]
+        import app
+        _app = app
+    return _app
+
+
+def build_inputs(app_dir, data_dir, rel_path):
+    """子行程：單一匯出檔 → 週報輸入（只回傳小型 dict / 表，跨行程傳遞成本低）"""
+    return load_app(app_dir).weekly_inputs_for_export(rel_path, data_dir)
+
+
+def log(event, **fields):
+    print(json.dumps({'ts': time.strftime('%Y-%m-%d %H:%M:%S'), 'event': event, **fields}, ensure_ascii=False), flush=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='多帳戶批次週報（依 RPM / TPM 額度排程）')
+    ap.add_argument('--dir', default=os.environ.get('ADS_DATA_DIR', ''), help='匯出檔資料夾（預設 ADS_DATA_DIR）')
+    ap.add_argument('--files', nargs='*', default=None, help='只處理這些相對路徑（預設資料夾內全部）')
+    ap.add_argument('--out', default=os.path.join('weekly_reports', date.today().isoformat()), help='輸出資料夾')
+    ap.add_argument('--api-key', default=os.environ.get('GEMINI_API_KEY', ''), help='預設 GEMINI_API_KEY')
+    ap.add_argument('--rpm', type=float, default=None, help='每分鐘請求上限（預設 GEMINI_RPM_LIMIT）')
+    ap.add_argument('--tpm', type=float, default=None, help='每分鐘 token 上限（預設 GEMINI_TPM_LIMIT）')
+    ap.add_argument('--workers', type=int, default=None, help='AI 呼叫執行緒數（預設 WEEKLY_BATCH_MAX_WORKERS）')
+    ap.add_argument('--build-workers', type=int, default=2, help='讀檔 / 匯總子行程數')
+    ap.add_argument('--retries', type=int, default=4, help='每個帳戶最多重試次數')
+    ap.add_argument('--app-dir', default=os.path.dirname(os.path.abspath(__file__)), help='app.py 所在目錄')
+    args = ap.parse_args()
+
+    if not args.dir or not os.path.isdir(args.dir):
+        ap.error('請以 --dir 或 ADS_DATA_DIR 指定存在的資料夾')
+    if not args.api_key:
+        ap.error('請以 --api-key 或 GEMINI_API_KEY 提供 API Key')
+    app = load_app(args.app_dir)
+    rel_paths = args.files or [rel for rel, _, _ in app.list_server_exports(args.dir)]
+    rpm = args.rpm or app.GEMINI_RPM_LIMIT
+    tpm = args.tpm or app.GEMINI_TPM_LIMIT
+    log('start', accounts=len(rel_paths), rpm=rpm, tpm=tpm, out=os.path.abspath(args.out))
+
+    t0 = time.perf_counter()
+    build_errors = []
+
+    def built_inputs(pool):
+        """依完成順序產生週報輸入；讀檔失敗的帳戶記錄後略過"""
+        futures = {pool.submit(build_inputs, args.app_dir, args.dir, rel): rel for rel in rel_paths}
+        for future in as_completed(futures):
+            try:
+                job = future.result()
+            except Exception as e:
+                build_errors.append({'file': futures[future], 'error': str(e)})
+                log('build_failed', file=futures[future], error=str(e))
+                continue
+            log('built', account=job['account'])
+            yield job
+
+    with ProcessPoolExecutor(max_workers=args.build_workers) as pool:
+        rows = app.run_weekly_batch(
+            args.api_key, built_inputs(pool), args.out, rpm=rpm, tpm=tpm,
+            max_workers=args.workers, max_retries=args.retries, on_done=lambda row: log('done', **row)
+        )
+
+    wall = time.perf_counter() - t0
+    summary = {
+        'accounts': len(rel_paths), 'ok': sum(r['ok'] for r in rows), 'failed': sum(not r['ok'] for r in rows),
+        'build_failed': build_errors, 'attempts': sum(r['attempts'] for r in rows),
+        'wall_s': round(wall, 2),
+        # 額度下限：請求數 / RPM（分鐘）→ 實際時間越接近此值，代表越貼近額度上限
+        'quota_floor_s': round(sum(r['attempts'] for r in rows) / rpm * 60, 2),
+        'rows': rows,
+    }
+    os.makedirs(args.out, exist_ok=True)
+    with open(os.path.join(args.out, 'summary.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    log('stop', **{k: v for k, v in summary.items() if k != 'rows'})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+分析管線記憶體 / 時間基準：產生（或讀取）大型 CSV，量測 build_analysis_bundle 的尖峰記憶體。
+
+- 尖峰記憶體以背景執行緒每 5ms 取樣 RSS（/proc/self/statm）量測，
+  pyarrow 字串欄位由 Arrow 自己的記憶體池配置，tracemalloc 看不到，所以不用它
+- --app-dir 可指向另一份 app.py（例如舊版的 git worktree），用來比較改版前後
+
+使用方式：
+  # 產生 100 萬列測試檔並量測目前版本
+  python bench_pipeline_memory.py --rows 1000000
+
+  # 伺服器端讀取（memory-map + Arrow）與上傳 bytes 讀取的尖峰記憶體比較
+  python bench_pipeline_memory.py --reader path
+  python bench_pipeline_memory.py --reader bytes
+
+  # 超長歷史：pandas 全量載入 vs DuckDB 只載入最近 30 天
+  python bench_pipeline_memory.py --csv /tmp/bench_long.csv --days 720 --reader path
+  python bench_pipeline_memory.py --csv /tmp/bench_long.csv --days 720 --backend duckdb
+
+  # 與舊版比較（先 git worktree add /tmp/app_old <commit>）
+  python bench_pipeline_memory.py --csv /tmp/bench_1m.csv --app-dir /tmp/app_old
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def write_synthetic_csv(path, rows, days=60, seed=0):
+    """產生與 Ads Manager 匯出同欄位的假資料（金額 / 次數含千分位逗號）"""
+    rng = np.random.default_rng(seed)
+    n_camp, n_set, n_ad = 40, 6, 8
+    camp = rng.integers(0, n_camp, rows)
+    adset = camp * n_set + rng.integers(0, n_set, rows)
+    ad = adset * n_ad + rng.integers(0, n_ad, rows)
+    day = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, days, rows), unit='D')
+    spend = rng.gamma(2, 600, rows).round(0)
+    impr = (spend * rng.uniform(8, 30, rows)).astype(np.int64)
+    clicks = (impr * rng.uniform(0.005, 0.03, rows)).astype(np.int64)
+    conv = rng.poisson(clicks * 0.03)
+    df = pd.DataFrame({
+        '天數': day.strftime('%Y-%m-%d'),
+        '行銷活動名稱': np.char.add('活動_', camp.astype(str)),
+        '廣告組合名稱': np.char.add('組合_', adset.astype(str)),
+        '廣告名稱': np.char.add(np.char.add('素材_', ad.astype(str)), np.where(ad % 5 == 0, '_20240110 - 複本', '')),
+        '花費金額 (TWD)': spend,
+        '曝光次數': [f'{v:,}' for v in impr],
+        '連結點擊次數': [f'{v:,}' for v in clicks],
+        '購買次數': conv,
+    })
+    df.to_csv(path, index=False)
+
+
+def current_rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def release_free_heap():
+    """gc + glibc malloc_trim：讓「保留量」反映仍存活的物件，而不是尚未歸還 OS 的空閒 heap"""
+    import ctypes
+    import gc
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except OSError:
+        pass
+
+
+class RssSampler:
+    """with 區塊內的 RSS 尖峰（相對於進入時的 RSS）"""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.base = self.peak = 0
+        self._stop = threading.Event()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss_bytes())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.base = self.peak = current_rss_bytes()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_bytes())
+
+
+def main():
+    ap = argparse.ArgumentParser(description='分析管線記憶體基準')
+    ap.add_argument('--csv', default='/tmp/bench_1m.csv', help='CSV 路徑；不存在時依 --rows 產生')
+    ap.add_argument('--rows', type=int, default=1_000_000)
+    ap.add_argument('--days', type=int, default=60, help='產生測試檔時的日期跨度（天）')
+    ap.add_argument('--backend', choices=['pandas', 'duckdb'], default='pandas',
+                    help='duckdb：以 SQL 直接查詢 CSV，只載入最近 30 天（讀取時間併入 pipeline_s）')
+    ap.add_argument('--reader', choices=['bytes', 'path'], default='bytes',
+                    help='bytes：整份讀進記憶體再解析（上傳檔路徑）；path：伺服器端 memory-map + Arrow')
+    ap.add_argument('--workers', type=int, default=None,
+                    help='匯總階段併行執行緒數（預設 PIPELINE_MAX_WORKERS；1 = 逐一執行）')
+    ap.add_argument('--app-dir', default=os.path.dirname(os.path.abspath(__file__)), help='要量測的 app.py 所在目錄')
+    args = ap.parse_args()
+
+    if not os.path.exists(args.csv):
+        print(f'產生 {args.rows:,} 列測試檔 → {args.csv}', file=sys.stderr)
+        write_synthetic_csv(args.csv, args.rows, days=args.days)
+
+    sys.path.insert(0, os.path.abspath(args.app_dir))
+    sys.argv = [sys.argv[0]]
+    import app
+
+    if args.backend == 'duckdb':
+        return bench_duckdb(app, args)
+
+    release_free_heap()
+    with RssSampler() as read_rss:
+        t0 = time.perf_counter()
+        if args.reader == 'path':
+            df_raw = app.read_csv_path(args.csv)
+        else:
+            with open(args.csv, 'rb') as f:
+                file_bytes = f.read()
+            df_raw = app.read_csv_bytes(file_bytes)
+            del file_bytes
+        read_s = time.perf_counter() - t0
+    release_free_heap()
+
+    cols = df_raw.columns.tolist()
+    conv_col = cols[app.suggest_conversion_index(cols)]
+    spend_col = app.find_col(cols, ['花費金額 (TWD)', '花費', '金額'], '花費金額 (TWD)')
+    clicks_col = app.find_col(cols, ['連結點擊次數', '連結點擊'], '連結點擊次數')
+    impressions_col = app.find_col(cols, ['曝光次數', '曝光'], '曝光次數')
+    raw_mb = app.estimate_nbytes(df_raw) / 1024 ** 2
+
+    with RssSampler() as rss:
+        t0 = time.perf_counter()
+        kwargs = {} if args.workers is None else {'max_workers': args.workers}
+        bundle = app.build_analysis_bundle(df_raw, conv_col, spend_col, clicks_col, impressions_col, **kwargs)
+        pipeline_s = time.perf_counter() - t0
+    release_free_heap()
+    retained = current_rss_bytes() - rss.base
+
+    report = {
+        'app_dir': os.path.abspath(args.app_dir),
+        'rows': len(df_raw),
+        'raw_df_mb': round(raw_mb, 1),
+        'reader': args.reader,
+        'csv_mb': round(os.path.getsize(args.csv) / 1024 ** 2, 1),
+        'read_s': round(read_s, 2),
+        'read_peak_rss_increase_mb': round((read_rss.peak - read_rss.base) / 1024 ** 2, 1),
+        'pipeline_s': round(pipeline_s, 2),
+        'pipeline_peak_rss_increase_mb': round((rss.peak - rss.base) / 1024 ** 2, 1),
+        'pipeline_retained_rss_mb': round(retained / 1024 ** 2, 1),
+        'bundle_estimated_mb': round(app.estimate_nbytes(bundle) / 1024 ** 2, 1),
+    }
+    if 'stage_timings' in bundle:
+        report['stage_timings_s'] = {k: round(v, 3) for k, v in sorted(bundle['stage_timings'].items(), key=lambda kv: -kv[1])}
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+def bench_duckdb(app, args):
+    release_free_heap()
+    with RssSampler() as rss:
+        t0 = time.perf_counter()
+        raw = app.describe_duckdb_sources([os.path.basename(args.csv)], os.path.dirname(os.path.abspath(args.csv)))
+        cols = raw['columns']
+        conv_col = cols[app.suggest_conversion_index(cols)]
+        metric_cols = [app.find_col(cols, opts, canonical) for canonical, opts in app.STANDARD_METRIC_COLS.items()]
+        kwargs = {} if args.workers is None else {'max_workers': args.workers}
+        bundle = app.build_analysis_bundle_duckdb(raw, conv_col, *metric_cols, **kwargs)
+        pipeline_s = time.perf_counter() - t0
+    release_free_heap()
+    retained = current_rss_bytes() - rss.base
+
+    report = {
+        'app_dir': os.path.abspath(args.app_dir),
+        'backend': 'duckdb',
+        'window_rows': len(bundle['df_std']),
+        'csv_mb': round(os.path.getsize(args.csv) / 1024 ** 2, 1),
+        'duckdb_memory_limit': app.DUCKDB_MEMORY_LIMIT,
+        'pipeline_s': round(pipeline_s, 2),
+        'pipeline_peak_rss_increase_mb': round((rss.peak - rss.base) / 1024 ** 2, 1),
+        'pipeline_retained_rss_mb': round(retained / 1024 ** 2, 1),
+        'bundle_estimated_mb': round(app.estimate_nbytes(bundle) / 1024 ** 2, 1),
+        'stage_timings_s': {k: round(v, 3) for k, v in sorted(bundle['stage_timings'].items(), key=lambda kv: -kv[1])},
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""
+AI 路徑壓測：N 個同時 session 對 Gemini REST（通常是 mock_gemini_server.py）發送
+診斷 / 週報請求，回報端到端 p50 / p95 延遲與吞吐量。
+
+請求走 app.py 內實際的 call_gemini_analysis / call_gemini_weekly_draft（REST 路徑），
+所以 prompt 組裝、JSON 修復等行為都會被量到。
+
+使用方式：
+  # 自動在背景啟動 mock，20 個 session，每個 5 次請求，10% 429
+  python load_test_gemini.py --spawn-mock --sessions 20 --requests 5 --error-429-rate 0.1
+
+  # 對已啟動的 mock / 其他相容端點
+  python load_test_gemini.py --base-url http://127.0.0.1:8765 --sessions 10
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import requests
+
+
+def synthetic_tables(n_campaigns, n_adsets, n_ads, seed=0):
+    """產生與 collect_period_results 同欄位的假資料表（只用於組 prompt）"""
+    rng = np.random.default_rng(seed)
+
+    def table(name_col, n):
+        spend = rng.gamma(2, 5000, n).round(2)
+        conv = rng.poisson(spend / 400)
+        clicks = (spend / rng.uniform(8, 20, n)).astype(int)
+        impr = clicks * rng.integers(40, 120, n)
+        df = pd.DataFrame({
+            name_col: [f'{name_col}_{i}' for i in range(n)],
+            '花費金額 (TWD)': spend, '購買次數': conv, '連結點擊次數': clicks, '曝光次數': impr,
+        })
+        df['CPA (TWD)'] = np.where(conv > 0, spend / np.maximum(conv, 1), 0).round(2)
+        df['CTR (%)'] = (clicks / impr * 100).round(2)
+        df['CVR (%)'] = np.where(clicks > 0, conv / np.maximum(clicks, 1) * 100, 0).round(2)
+        df['CPM (TWD)'] = (spend / impr * 1000).round(2)
+        return df
+
+    return table('行銷活動名稱', n_campaigns), table('廣告組合名稱', n_adsets), table('廣告名稱_clean', n_ads)
+
+
+def percentile_report(latencies):
+    if not latencies:
+        return {}
+    arr = np.asarray(latencies)
+    return {
+        'p50_s': round(float(np.percentile(arr, 50)), 3),
+        'p95_s': round(float(np.percentile(arr, 95)), 3),
+        'p99_s': round(float(np.percentile(arr, 99)), 3),
+        'mean_s': round(float(arr.mean()), 3),
+        'max_s': round(float(arr.max()), 3),
+    }
+
+
+def stream_once(base_url, api_key, payload):
+    """直接打 streamGenerateContent，回傳 (成功, TTFT, 總時間, usageMetadata)"""
+    url = f"{base_url}/v1beta/models/gemini-2.5-pro:streamGenerateContent?alt=sse&key={api_key}"
+    t0 = time.perf_counter()
+    ttft = None
+    text = ''
+    usage = {}
+    with requests.post(url, json=payload, stream=True, timeout=300) as r:
+        if r.status_code != 200:
+            return False, None, time.perf_counter() - t0, usage
+        for raw in r.iter_lines():
+            line = raw.decode('utf-8')
+            if not line.startswith('data:'):
+                continue
+            if ttft is None:
+                ttft = time.perf_counter() - t0
+            event = json.loads(line[5:])
+            for p in event['candidates'][0]['content']['parts']:
+                text += p.get('text', '')
+            usage = event.get('usageMetadata', usage)
+    return bool(text), ttft, time.perf_counter() - t0, usage
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Gemini AI 路徑壓測')
+    ap.add_argument('--base-url', default=None, help='REST 端點（預設：--spawn-mock 啟動的本地 mock）')
+    ap.add_argument('--spawn-mock', action='store_true', help='在本 process 背景啟動 mock_gemini_server')
+    ap.add_argument('--sessions', type=int, default=10, help='同時模擬的 session 數')
+    ap.add_argument('--requests', type=int, default=3, help='每個 session 依序發出的請求數')
+    ap.add_argument('--mode', choices=['diagnosis', 'weekly', 'mixed', 'stream', 'cache-compare'], default='mixed',
+                    help='cache-compare：同一份診斷 prompt 交替以「系統指令快取」/「直送」串流呼叫，比較 TTFT 與計費 token')
+    ap.add_argument('--campaigns', type=int, default=40)
+    ap.add_argument('--adsets', type=int, default=120)
+    ap.add_argument('--ads', type=int, default=300)
+    ap.add_argument('--api-key', default='mock-key')
+    # 傳給 mock 的參數（僅 --spawn-mock 時有效）
+    ap.add_argument('--port', type=int, default=8765)
+    ap.add_argument('--latency-ms', type=float, default=800)
+    ap.add_argument('--jitter-ms', type=float, default=200)
+    ap.add_argument('--tokens-per-sec', type=float, default=80)
+    ap.add_argument('--error-429-rate', type=float, default=0.0)
+    ap.add_argument('--error-500-rate', type=float, default=0.0)
+    ap.add_argument('--max-concurrency', type=int, default=0)
+    args = ap.parse_args()
+
+    server = None
+    if args.spawn_mock:
+        import mock_gemini_server
+        mock_args = mock_gemini_server.build_arg_parser().parse_args([
+            '--port', str(args.port), '--latency-ms', str(args.latency_ms), '--jitter-ms', str(args.jitter_ms),
+            '--tokens-per-sec', str(args.tokens_per_sec), '--error-429-rate', str(args.error_429_rate),
+            '--error-500-rate', str(args.error_500_rate), '--max-concurrency', str(args.max_concurrency),
+        ])
+        server, _ = mock_gemini_server.start_server(mock_args)
+    base_url = (args.base_url or f'http://127.0.0.1:{args.port}').rstrip('/')
+
+    # 必須在 import app 前設定，app 會因此改走 REST 路徑
+    os.environ['GEMINI_API_BASE'] = base_url
+    sys.argv = [sys.argv[0]]
+    import app
+
+    camp, adset, ad = synthetic_tables(args.campaigns, args.adsets, args.ads)
+    weekly_prompt = app.safe_to_markdown(adset.head(12)) + '\n' + app.safe_to_markdown(ad.head(12))
+    diag_text = (
+        app.safe_to_markdown(camp) + '\n' + app.safe_to_markdown(adset.head(30))
+        + '\n' + app.safe_to_markdown(ad.head(50)) + app.DIAGNOSIS_USER_REQUEST
+    )
+    cache = None
+    if args.mode == 'cache-compare':
+        cache = app.get_prompt_cache(args.api_key, 'gemini-2.5-pro', app.AI_CONSULTANT_PROMPT)
+        if cache is None:
+            print('⚠️ 無法建立 cachedContents（端點不支援或 prompt 低於最小快取 token 數），只會量到未快取路徑')
+
+    usages = []
+
+    def one_request(kind):
+        if kind == 'diagnosis':
+            out = app.call_gemini_analysis(
+                args.api_key, alerts_daily=pd.DataFrame(), alerts_weekly=pd.DataFrame(),
+                campaign_summary=camp, adset_p7=adset, ad_p7=ad
+            )
+            return not str(out).startswith(('⚠️', '❌')), None
+        if kind == 'weekly':
+            out = app.call_gemini_weekly_draft(args.api_key, weekly_prompt, max_retries=0)
+            return out['draft'] is not None, None
+        if kind == 'stream':
+            payload = {"contents": [{"parts": [{"text": weekly_prompt}]}]}
+        else:
+            payload = app.build_gemini_payload(
+                diag_text, app.AI_CONSULTANT_PROMPT, cache['name'] if (cache and kind == 'cached') else None
+            )
+        ok, ttft, _, usage = stream_once(base_url, args.api_key, payload)
+        with lock:
+            usages.append((kind, usage))
+        return ok, ttft
+
+    results = []
+    lock = threading.Lock()
+
+    def session(sid):
+        for i in range(args.requests):
+            if args.mode == 'mixed':
+                kind = 'diagnosis' if (sid + i) % 2 == 0 else 'weekly'
+            elif args.mode == 'cache-compare':
+                kind = 'cached' if (sid + i) % 2 == 0 else 'uncached'
+            else:
+                kind = args.mode
+            t0 = time.perf_counter()
+            try:
+                ok, ttft = one_request(kind)
+            except Exception:
+                ok, ttft = False, None
+            with lock:
+                results.append((kind, ok, time.perf_counter() - t0, ttft))
+
+    t_start = time.perf_counter()
+    threads = [threading.Thread(target=session, args=(s,)) for s in range(args.sessions)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t_start
+
+    report = {
+        'sessions': args.sessions,
+        'requests': len(results),
+        'ok': sum(1 for r in results if r[1]),
+        'failed': sum(1 for r in results if not r[1]),
+        'wall_s': round(wall, 3),
+        'throughput_rps': round(len(results) / wall, 3) if wall > 0 else 0,
+        'latency_all': percentile_report([r[2] for r in results]),
+        'latency_ok': percentile_report([r[2] for r in results if r[1]]),
+    }
+    for kind in ('diagnosis', 'weekly', 'stream'):
+        lat = [r[2] for r in results if r[0] == kind]
+        if lat:
+            report[f'latency_{kind}'] = percentile_report(lat)
+    ttfts = [r[3] for r in results if r[3] is not None]
+    if ttfts:
+        report['ttft'] = percentile_report(ttfts)
+    for kind in ('cached', 'uncached'):
+        rows = [r for r in results if r[0] == kind and r[1]]
+        if not rows:
+            continue
+        ku = [u for k, u in usages if k == kind and u]
+        prompt_tok = [u.get('promptTokenCount', 0) for u in ku]
+        cached_tok = [u.get('cachedContentTokenCount', 0) for u in ku]
+        report[f'{kind}_prompt'] = {
+            'latency': percentile_report([r[2] for r in rows]),
+            'ttft': percentile_report([r[3] for r in rows if r[3] is not None]),
+            'avg_prompt_tokens': round(float(np.mean(prompt_tok)), 1) if ku else 0,
+            'avg_cached_tokens': round(float(np.mean(cached_tok)), 1) if ku else 0,
+            'avg_full_price_input_tokens': round(float(np.mean(prompt_tok) - np.mean(cached_tok)), 1) if ku else 0,
+        }
+    try:
+        report['server_stats'] = requests.get(f'{base_url}/stats', timeout=5).json()
+    except Exception:
+        pass
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if server is not None:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+"""
+本地 Gemini REST 模擬伺服器（壓測 / 回歸測試 AI 路徑用，不需要真 Key）
+
+實作 app.py 使用的 REST 形狀：
+  POST /v1beta/models/{model}:generateContent?key=...
+  POST /v1beta/models/{model}:streamGenerateContent?alt=sse&key=...
+  POST /v1beta/cachedContents?key=...   → 建立系統指令快取（generateContent 以 cachedContent 引用）
+  GET  /stats   → 累計請求數 / 錯誤數 / token 數
+
+使用方式：
+  python mock_gemini_server.py --port 8765 --latency-ms 800 --jitter-ms 300 --error-429-rate 0.1
+  python mock_gemini_server.py --rpm 60   # 模擬每分鐘請求額度（滑動 60 秒視窗，超過即 429）
+  GEMINI_API_BASE=http://127.0.0.1:8765 streamlit run app.py
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+CACHE_PATH = '/v1beta/cachedContents'
+PATH_RE = re.compile(r'^/v1beta/models/(?P<model>[^/:]+):(?P<method>generateContent|streamGenerateContent)$')
+CJK_RE = re.compile(r'[\u3000-\u9fff\uff00-\uffef]')
+
+MOCK_DIAGNOSIS_TEXT = """## 1. 帳戶整體快速總結 & 風險預警
+- **整體狀態**：偏穩定（mock 回覆）
+- **數據概覽**：近 7 日 CPA 約 $100，轉換量持平。
+
+## 2. 🚨 昨日救火清單 (Daily Alerts)
+- 無（mock）
+
+## 3. 📉 週環比衰退診斷 (Weekly Trends)
+- 無明顯惡化（mock）
+
+## 6. ✅ 優先級待辦清單 (Action Plan)
+1. Priority A：`[暫停]` 廣告 X（依據：mock）
+"""
+
+MOCK_WEEKLY_DRAFT = {
+    "status_summary": "本週整體花費與轉換持平（mock 回覆）。",
+    "audience_effective": ["AdSet A（CPA 低於平均）"],
+    "audience_ineffective": ["AdSet B（高花費低轉換）"],
+    "creative_effective": ["Ad X（CTR 高且 CVR 穩定）"],
+    "creative_ineffective": ["Ad Y（CVR 偏低）"],
+    "next_week_plan_reco": [
+        {"type": "1. 做簡易的開關、預算調配即可", "recommend": True, "reason": "mock", "actions": ["暫停 Ad Y"]},
+        {"type": "6. 維持即可", "recommend": False, "reason": "mock", "actions": []},
+    ],
+}
+
+
+def count_tokens(text):
+    """粗估 token 數：CJK 字元 1 字 1 token，其餘約 4 字元 1 token"""
+    text = str(text or '')
+    cjk = len(CJK_RE.findall(text))
+    return cjk + max(0, len(text) - cjk) // 4
+
+
+class MockState:
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.caches = {}  # cachedContents name → (model, 快取 token 數)
+        self.recent = deque()  # 最近 60 秒內被接受的請求時間（--rpm 用）
+        self.stats = {
+            'requests': 0, 'ok': 0, 'errors_429': 0, 'errors_500': 0,
+            'prompt_tokens': 0, 'response_tokens': 0, 'cached_tokens': 0, 'caches_created': 0,
+            'streamed': 0, 'max_in_flight': 0,
+        }
+
+    def bump(self, **inc):
+        with self.lock:
+            for k, v in inc.items():
+                self.stats[k] += v
+
+    def enter(self):
+        with self.lock:
+            self.in_flight += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.in_flight)
+            return self.in_flight
+
+    def over_rpm(self):
+        """滑動 60 秒視窗：已達 --rpm 時回傳 True（不計入）；否則記錄本次請求"""
+        if not self.args.rpm:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            while self.recent and now - self.recent[0] >= 60:
+                self.recent.popleft()
+            if len(self.recent) >= self.args.rpm:
+                return True
+            self.recent.append(now)
+            return False
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, in_flight=self.in_flight)
+
+
+def make_handler(state):
+    args = state.args
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, fmt, *a):
+            if args.verbose:
+                super().log_message(fmt, *a)
+
+        def _send_json(self, code, obj, extra_headers=None):
+            body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in (extra_headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urlparse(self.path).path == '/stats':
+                self._send_json(200, state.snapshot())
+            else:
+                self._send_json(404, {'error': {'code': 404, 'message': 'not found', 'status': 'NOT_FOUND'}})
+
+        def do_POST(self):
+            parsed = urlparse(self.path)
+            if parsed.path == CACHE_PATH:
+                self._create_cache()
+                return
+            m = PATH_RE.match(parsed.path)
+            if not m:
+                self._send_json(404, {'error': {'code': 404, 'message': 'not found', 'status': 'NOT_FOUND'}})
+                return
+            query = parse_qs(parsed.query)
+            if args.require_key and not query.get('key'):
+                self._send_json(400, {'error': {'code': 400, 'message': 'API key not valid.', 'status': 'INVALID_ARGUMENT'}})
+                return
+
+            payload = self._read_json()
+            if payload is None:
+                self._send_json(400, {'error': {'code': 400, 'message': 'Invalid JSON payload', 'status': 'INVALID_ARGUMENT'}})
+                return
+
+            state.bump(requests=1)
+            in_flight = state.enter()
+            try:
+                self._handle_generate(m.group('model'), m.group('method'), payload, in_flight)
+            finally:
+                state.leave()
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                return json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                return None
+
+        def _create_cache(self):
+            payload = self._read_json()
+            if payload is None:
+                self._send_json(400, {'error': {'code': 400, 'message': 'Invalid JSON payload', 'status': 'INVALID_ARGUMENT'}})
+                return
+            text = ''.join(str(p.get('text', '')) for p in (payload.get('systemInstruction') or {}).get('parts', []))
+            for c in payload.get('contents', []):
+                text += ''.join(str(p.get('text', '')) for p in c.get('parts', []))
+            tokens = count_tokens(text)
+            if tokens < args.cache_min_tokens:
+                self._send_json(400, {'error': {
+                    'code': 400, 'status': 'INVALID_ARGUMENT',
+                    'message': f'Cached content is too small. total_token_count={tokens}, min_total_token_count={args.cache_min_tokens}'}})
+                return
+            with state.lock:
+                name = f'cachedContents/mock-{len(state.caches) + 1}'
+                state.caches[name] = (payload.get('model', ''), tokens)
+                state.stats['caches_created'] += 1
+            self._send_json(200, {
+                'name': name, 'model': payload.get('model', ''),
+                'usageMetadata': {'totalTokenCount': tokens}, 'ttl': payload.get('ttl', '3600s'),
+            })
+
+        def _handle_generate(self, model, method, payload, in_flight):
+            # 錯誤注入：超過併發上限或隨機 429 / 500
+            if ((args.max_concurrency and in_flight > args.max_concurrency) or random.random() < args.error_429_rate
+                    or state.over_rpm()):
+                state.bump(errors_429=1)
+                self._send_json(429, {'error': {
+                    'code': 429, 'message': 'Resource has been exhausted (e.g. check quota).',
+                    'status': 'RESOURCE_EXHAUSTED'}}, {'Retry-After': str(args.retry_after)})
+                return
+            if random.random() < args.error_500_rate:
+                time.sleep(args.latency_ms / 1000 / 2)
+                state.bump(errors_500=1)
+                self._send_json(500, {'error': {'code': 500, 'message': 'Internal error encountered.', 'status': 'INTERNAL'}})
+                return
+
+            prompt_text = ''
+            for c in payload.get('contents', []):
+                for p in c.get('parts', []):
+                    prompt_text += str(p.get('text', ''))
+            sys_inst = payload.get('systemInstruction') or payload.get('system_instruction') or {}
+            for p in sys_inst.get('parts', []):
+                prompt_text += str(p.get('text', ''))
+
+            cached_tokens = 0
+            cache_name = payload.get('cachedContent')
+            if cache_name:
+                with state.lock:
+                    cached = state.caches.get(cache_name)
+                if cached is None:
+                    self._send_json(403, {'error': {
+                        'code': 403, 'message': f'CachedContent not found (or permission denied): {cache_name}',
+                        'status': 'PERMISSION_DENIED'}})
+                    return
+                cached_tokens = cached[1]
+
+            gen_cfg = payload.get('generationConfig') or {}
+            if gen_cfg.get('responseMimeType') == 'application/json':
+                text = json.dumps(MOCK_WEEKLY_DRAFT, ensure_ascii=False)
+            else:
+                text = MOCK_DIAGNOSIS_TEXT
+
+            # 與正式 API 一致：promptTokenCount 含快取部分，另以 cachedContentTokenCount 標示
+            fresh_tokens = count_tokens(prompt_text)
+            prompt_tokens = fresh_tokens + cached_tokens
+            response_tokens = count_tokens(text)
+            state.bump(prompt_tokens=prompt_tokens, response_tokens=response_tokens, cached_tokens=cached_tokens)
+            usage = {
+                'promptTokenCount': prompt_tokens,
+                'candidatesTokenCount': response_tokens,
+                'totalTokenCount': prompt_tokens + response_tokens,
+            }
+            if cached_tokens:
+                usage['cachedContentTokenCount'] = cached_tokens
+
+            # 延遲模型：TTFT（含依 prompt 長度的前置處理） + 依輸出 token 速率的生成時間
+            ttft = (args.latency_ms + random.uniform(-args.jitter_ms, args.jitter_ms)) / 1000
+            ttft += fresh_tokens / args.prefill_tokens_per_sec + cached_tokens / args.cached_prefill_tokens_per_sec
+            gen_time = response_tokens / args.tokens_per_sec
+            time.sleep(max(0.0, ttft))
+
+            if method == 'streamGenerateContent':
+                state.bump(streamed=1, ok=1)
+                self._stream(text, usage, model, gen_time)
+                return
+
+            time.sleep(gen_time)
+            state.bump(ok=1)
+            self._send_json(200, {
+                'candidates': [{
+                    'content': {'parts': [{'text': text}], 'role': 'model'},
+                    'finishReason': 'STOP', 'index': 0,
+                }],
+                'usageMetadata': usage,
+                'modelVersion': model,
+            })
+
+        def _stream(self, text, usage, model, gen_time):
+            """以 SSE（alt=sse）分段送出，最後一段附 usageMetadata"""
+            n = max(1, args.stream_chunks)
+            step = max(1, -(-len(text) // n))
+            chunks = [text[i:i + step] for i in range(0, len(text), step)]
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            for idx, chunk in enumerate(chunks):
+                event = {
+                    'candidates': [{'content': {'parts': [{'text': chunk}], 'role': 'model'}, 'index': 0}],
+                    'modelVersion': model,
+                }
+                if idx == len(chunks) - 1:
+                    event['candidates'][0]['finishReason'] = 'STOP'
+                    event['usageMetadata'] = usage
+                self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode('utf-8'))
+                self.wfile.flush()
+                if idx < len(chunks) - 1:
+                    time.sleep(gen_time / len(chunks))
+            self.close_connection = True
+
+    return Handler
+
+
+def build_arg_parser():
+    ap = argparse.ArgumentParser(description='本地 Gemini REST 模擬伺服器')
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8765)
+    ap.add_argument('--latency-ms', type=float, default=800, help='基本首字延遲（TTFT）')
+    ap.add_argument('--jitter-ms', type=float, default=200, help='TTFT 隨機抖動 ±ms')
+    ap.add_argument('--prefill-tokens-per-sec', type=float, default=20000, help='prompt 前置處理速度')
+    ap.add_argument('--cached-prefill-tokens-per-sec', type=float, default=200000, help='快取命中部分的前置處理速度')
+    ap.add_argument('--cache-min-tokens', type=int, default=0, help='cachedContents 最小 token 數（低於此回 400）')
+    ap.add_argument('--tokens-per-sec', type=float, default=80, help='輸出 token 生成速度')
+    ap.add_argument('--stream-chunks', type=int, default=8, help='streamGenerateContent 分段數')
+    ap.add_argument('--error-429-rate', type=float, default=0.0)
+    ap.add_argument('--error-500-rate', type=float, default=0.0)
+    ap.add_argument('--max-concurrency', type=int, default=0, help='超過此同時請求數即回 429（0 = 不限制）')
+    ap.add_argument('--rpm', type=int, default=0, help='每分鐘請求額度（滑動 60 秒視窗，超過即 429；0 = 不限制）')
+    ap.add_argument('--retry-after', type=int, default=1, help='429 回應的 Retry-After 秒數')
+    ap.add_argument('--require-key', action='store_true', help='缺少 ?key= 時回 400')
+    ap.add_argument('--verbose', action='store_true')
+    return ap
+
+
+def make_server(args):
+    state = MockState(args)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    server.daemon_threads = True
+    return server, state
+
+
+def start_server(args):
+    """啟動伺服器於背景執行緒，回傳 (server, state)；load_test_gemini.py 也會用到"""
+    server, state = make_server(args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    server, state = make_server(args)
+    print(f"Mock Gemini server on http://{args.host}:{args.port}  (GET /stats for counters)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(state.snapshot(), ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+背景預先計算 daemon：監看匯出檔資料夾，新檔一出現就跑完整分析管線並寫入預先計算快取，
+分析師早上開啟 app 時直接載入結果（不必等讀檔、匯總與 Excel 產生）。
+
+- 每個檔案：讀取 → 清洗 / 各區間匯總 / 警示 / CPM 變化表 / 新素材與新組合摘要 → Excel / Parquet 包
+  → 寫入 PRECOMPUTE_DIR（與 app.py 共用，見 app.py 5.10）
+- 增量處理：以「路徑 + 大小 + 修改時間」簽章判斷是否處理過；已處理的檔案不會重跑
+- 檔案最後修改超過 --settle 秒才處理（避免讀到還在複製中的檔案）
+- 以 --workers 個子行程平行處理（CPU 密集，用 process 而不是 thread）
+- 各帳戶（相對路徑）的逐日加總與 P1D / P7D / PP7D / P30D 視窗加總存於 SNAPSHOT_DB（SQLite，見 app.py 5.11）：
+  每天早上的新匯出檔只重算新增 / 重述的日子，視窗只加上滑進來的日、減掉滑出去的日
+
+使用方式：
+  # 監看 ADS_DATA_DIR，每 30 秒掃描一次，2 個 worker
+  ADS_DATA_DIR=/data/exports python precompute_daemon.py --workers 2
+
+  # 只處理目前資料夾內尚未處理的檔案後結束（cron 用）
+  python precompute_daemon.py --dir /data/exports --once
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+_app = None
+
+
+def load_app(app_dir):
+    """在目前行程載入 app.py（bare mode，不啟動 UI）"""
+    global _app
+    if _app is None:
+        sys.path.insert(0, os.path.abspath(app_dir))
+        sys.argv = [sys.argv[0]]
+        import app
+        _app = app
+    return _app
+
+
+def process_export(app_dir, data_dir, rel_path):
+    """子行程：單一檔案的完整管線"""
+    return load_app(app_dir).precompute_export(rel_path, data_dir)
+
+
+def pending_exports(app, data_dir, settle_seconds, in_flight, failed):
+    """尚未預先計算、且已停止寫入的檔案：[(相對路徑, 簽章), ...]，新的在前"""
+    now = time.time()
+    pending = []
+    for rel, _, mtime in app.list_server_exports(data_dir):
+        if now - mtime < settle_seconds:
+            continue
+        signature = app.server_exports_signature([rel], data_dir)
+        if signature in in_flight or signature in failed:
+            continue
+        if app.precomputed_digest_for_signature(signature) is not None:
+            continue
+        pending.append((rel, signature))
+    return pending
+
+
+def log(event, **fields):
+    print(json.dumps({'ts': time.strftime('%Y-%m-%d %H:%M:%S'), 'event': event, **fields}, ensure_ascii=False), flush=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description='匯出檔資料夾背景預先計算')
+    ap.add_argument('--dir', default=os.environ.get('ADS_DATA_DIR', ''), help='監看的資料夾（預設 ADS_DATA_DIR）')
+    ap.add_argument('--workers', type=int, default=2, help='同時處理的檔案數（子行程數）')
+    ap.add_argument('--interval', type=float, default=30, help='掃描間隔（秒）')
+    ap.add_argument('--settle', type=float, default=10, help='檔案最後修改超過幾秒才處理')
+    ap.add_argument('--once', action='store_true', help='處理完目前待處理的檔案後結束')
+    ap.add_argument('--app-dir', default=os.path.dirname(os.path.abspath(__file__)), help='app.py 所在目錄')
+    args = ap.parse_args()
+
+    if not args.dir or not os.path.isdir(args.dir):
+        ap.error('請以 --dir 或 ADS_DATA_DIR 指定存在的資料夾')
+    app = load_app(args.app_dir)
+    log('start', dir=os.path.abspath(args.dir), workers=args.workers,
+        precompute_dir=os.path.abspath(app.PRECOMPUTE_DIR), snapshot_db=os.path.abspath(app.SNAPSHOT_DB),
+        version=app.PRECOMPUTE_VERSION)
+
+    in_flight = {}   # 簽章 → (相對路徑, future)
+    failed = set()   # 失敗過的簽章：檔案內容（簽章）沒變就不再重試
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        while True:
+            for rel, signature in pending_exports(app, args.dir, args.settle, in_flight, failed):
+                in_flight[signature] = (rel, pool.submit(process_export, args.app_dir, args.dir, rel))
+                log('queued', file=rel)
+
+            # 等到至少一個完成或到下一次掃描
+            deadline = time.time() + args.interval
+            while in_flight and time.time() < deadline:
+                for signature, (rel, future) in list(in_flight.items()):
+                    if not future.done():
+                        continue
+                    del in_flight[signature]
+                    try:
+                        manifest = future.result()
+                        log('done', file=rel, seconds=manifest['seconds'], digest=manifest['digest'][:12],
+                            conversion_col=manifest['conversion_col'],
+                            snapshot_changed_days=manifest.get('snapshot_changed_days'))
+                    except Exception as e:
+                        failed.add(signature)
+                        log('failed', file=rel, error=str(e))
+                time.sleep(0.2)
+
+            if args.once and not in_flight:
+                break
+            if not in_flight:
+                time.sleep(max(0.0, deadline - time.time()))
+    log('stop')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+測試共用 fixture：以 bare mode 匯入 app.py（不經 streamlit run；st.* 呼叫只會印出 ScriptRunContext 警告），
+快照 / 預先計算快取寫到暫存目錄，不動到 .ads_cache
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    cache_dir = tmp_path_factory.mktemp('ads_cache')
+    # 必須在 import app 前設定：這些路徑在匯入時讀取
+    os.environ['SNAPSHOT_DB'] = str(cache_dir / 'snapshots.sqlite')
+    os.environ['PRECOMPUTE_DIR'] = str(cache_dir / 'precomputed')
+    os.environ['DUCKDB_TEMP_DIR'] = str(cache_dir / 'duckdb_tmp')
+    os.environ['LLM_USAGE_LOG'] = str(cache_dir / 'llm_usage.jsonl')
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    argv, sys.argv = sys.argv, [sys.argv[0]]
+    try:
+        import app as module
+    finally:
+        sys.argv = argv
+    return module
+
+
+def make_export(days=40, n_camp=3, n_set=3, n_ad=4, seed=0):
+    """與 Ads Manager 匯出同欄位的假資料（每天每支廣告一列；點擊數含千分位逗號，和真實匯出一樣是文字）"""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for day in pd.date_range('2025-11-01', periods=days):
+        for c in range(n_camp):
+            for s in range(n_set):
+                for a in range(n_ad):
+                    spend = rng.gamma(2, 150)
+                    impr = int(spend * rng.uniform(8, 20))
+                    clicks = int(impr * rng.uniform(0.005, 0.03))
+                    conv = rng.binomial(clicks, 0.01 if a == 0 else 0.05)
+                    rows.append((
+                        day.strftime('%Y-%m-%d'), f'活動{c}', f'活動{c}_組合{s}',
+                        f'素材{a}_2025110{a + 1} - 複本', round(spend, 2), impr, f'{clicks:,}', conv,
+                    ))
+    return pd.DataFrame(rows, columns=[
+        '天數', '行銷活動名稱', '廣告組合名稱', '廣告名稱', '花費金額 (TWD)', '曝光次數', '連結點擊次數', '購買次數',
+    ])
+
+
+@pytest.fixture(scope='session')
+def export_csv_bytes():
+    return make_export().to_csv(index=False).encode('utf-8')
+
+
+@pytest.fixture
+def raw_export(app, export_csv_bytes):
+    """read_csv_bytes 讀回的原始匯出（每個測試各拿一份，可自由修改）"""
+    return app.read_csv_bytes(export_csv_bytes)
+
+
+@pytest.fixture
+def analysis_columns(app, raw_export):
+    """(轉換, 花費, 點擊, 曝光) 欄名"""
+    return app.default_analysis_columns(raw_export.columns.tolist())
+
+
+def assert_period_results_equal(left, right):
+    """[(表名, DataFrame), ...] 逐表比對（數值容許浮點誤差，整數 / 浮點型別差異不計）"""
+    assert [name for name, _ in left] == [name for name, _ in right]
+    for (name, a), (_, b) in zip(left, right):
+        pd.testing.assert_frame_equal(
+            a.reset_index(drop=True), b.reset_index(drop=True), check_dtype=False, obj=name
+        )
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+
+def curves_frame(spend, a, b, active_days):
+    n = len(spend)
+    return pd.DataFrame({
+        '行銷活動名稱': ['活動'] * n,
+        '廣告組合名稱': [f'組合{i}' for i in range(n)],
+        '活躍天數': active_days,
+        '目前日均花費 (TWD)': np.asarray(spend, dtype=float),
+        '曲線 a': np.asarray(a, dtype=float),
+        '彈性 b': np.asarray(b, dtype=float),
+    })
+
+
+def test_allocation_keeps_budget_and_bounds(app):
+    rng = np.random.default_rng(3)
+    n = 40
+    spend = rng.gamma(2, 2000, n)
+    curves = curves_frame(spend, rng.uniform(0.01, 0.3, n), rng.uniform(0.2, 0.9, n),
+                          np.where(np.arange(n) % 7 == 0, 3, 20))
+    max_change = 0.3
+    plan = app.optimize_budget_allocation(curves, max_change=max_change, min_active_days=7)
+    plan = plan.set_index('廣告組合名稱').loc[curves['廣告組合名稱']]
+    cur = plan['目前日均花費 (TWD)'].to_numpy()
+    new = plan['建議日均花費 (TWD)'].to_numpy()
+
+    assert abs(new.sum() - spend.sum()) <= 0.01 * n      # 表格四捨五入到小數 2 位
+    assert (new >= cur * (1 - max_change) - 0.01).all() and (new <= cur * (1 + max_change) + 0.01).all()
+    frozen = curves['活躍天數'].to_numpy() < 7
+    np.testing.assert_allclose(new[frozen], cur[frozen], atol=0.01)
+    assert plan['預估日轉換_建議'].sum() >= plan['預估日轉換_目前'].sum()
+
+    # KKT：沒碰到上下限的組合邊際 CPA 相同
+    free = ~frozen & (new > cur * (1 - max_change) + 1) & (new < cur * (1 + max_change) - 1)
+    assert free.sum() >= 2
+    marginal = plan['建議邊際 CPA (TWD)'].to_numpy()[free]
+    np.testing.assert_allclose(marginal, marginal.mean(), rtol=1e-3)
+
+
+def test_identical_curves_leave_budget_unchanged(app):
+    curves = curves_frame([1000.0, 1000.0, 1000.0], [0.1] * 3, [0.6] * 3, [30] * 3)
+    plan = app.optimize_budget_allocation(curves)
+    np.testing.assert_allclose(plan['建議日均花費 (TWD)'], 1000.0, atol=0.01)
+    assert app.budget_plan_summary(plan)['moved'] == 0
+
+
+def test_bundle_plan_keeps_total_budget(app, raw_export, analysis_columns):
+    bundle = app.build_analysis_bundle(raw_export, *analysis_columns)
+    curves, plan = bundle['budget_curves_df'], bundle['budget_plan_df']
+    assert not plan.empty
+    b = curves['彈性 b']
+    assert ((b >= app.BUDGET_ELASTICITY_BOUNDS[0]) & (b <= app.BUDGET_ELASTICITY_BOUNDS[1])).all()
+    assert abs(plan['建議日均花費 (TWD)'].sum() - plan['目前日均花費 (TWD)'].sum()) <= 0.01 * len(plan)
@@ -0,0 +1,74 @@
+import math
+
+import numpy as np
+import pytest
+
+
+def jeffreys_beta_cdf(q, k, n):
+    """
+    Beta(k + ½, n − k + ½) 的 CDF 參考值：代換 x = sin²θ 後被積函數為 2 sin^(2k) θ cos^(2(n−k)) θ，
+    在 [0, asin √q] 上平滑，以 Simpson 法數值積分（與 app 的級數實作無關）
+    """
+    a, b = k + 0.5, n - k + 0.5
+    theta = np.linspace(0, math.asin(math.sqrt(q)), 20001)
+    f = 2 * np.sin(theta) ** (2 * k) * np.cos(theta) ** (2 * (n - k))
+    h = theta[1] - theta[0]
+    integral = h / 3 * (f[0] + f[-1] + 4 * f[1:-1:2].sum() + 2 * f[2:-1:2].sum())
+    return integral / math.exp(math.lgamma(a) + math.lgamma(b) - math.lgamma(a + b))
+
+
+def jeffreys_gamma_cdf(x, k):
+    """Gamma(k + ½) 的 CDF 參考值：P(½, x) = erf(√x)，再以 P(a + 1, x) = P(a, x) − x^a e^(−x) / Γ(a + 1) 遞推"""
+    p, a = math.erf(math.sqrt(x)), 0.5
+    for _ in range(k):
+        p -= math.exp(a * math.log(x) - x - math.lgamma(a + 1))
+        a += 1
+    return p
+
+
+# 小樣本以 Newton 法修正到精確分位數；k、n − k 都 ≥ CI_EXACT_MAX_COUNT 時只用 Cornish-Fisher（CDF 誤差約 1e-5）
+@pytest.mark.parametrize('level', [0.9, 0.95])
+@pytest.mark.parametrize('k, n, tol', [
+    (0, 1, 1e-8), (1, 1, 1e-8), (0, 10, 1e-8), (3, 3, 1e-8), (2, 15, 1e-8), (7, 30, 1e-8),
+    (19, 500, 1e-8), (0, 10000, 1e-8), (60, 200, 1e-4), (25, 60, 1e-4),
+])
+def test_beta_interval_hits_exact_quantiles(app, k, n, tol, level):
+    lo, hi = app.beta_credible_interval([k], [n], level)
+    assert jeffreys_beta_cdf(lo[0], k, n) == pytest.approx((1 - level) / 2, abs=tol)
+    assert jeffreys_beta_cdf(hi[0], k, n) == pytest.approx((1 + level) / 2, abs=tol)
+
+
+@pytest.mark.parametrize('level', [0.9, 0.95])
+@pytest.mark.parametrize('k, tol', [(0, 1e-8), (1, 1e-8), (2, 1e-8), (5, 1e-8), (19, 1e-8), (45, 1e-4), (400, 1e-4)])
+def test_poisson_interval_hits_exact_quantiles(app, k, tol, level):
+    lo, hi = app.poisson_rate_interval([k], level)
+    assert jeffreys_gamma_cdf(lo[0], k) == pytest.approx((1 - level) / 2, abs=tol)
+    assert jeffreys_gamma_cdf(hi[0], k) == pytest.approx((1 + level) / 2, abs=tol)
+
+
+def test_known_small_count_values(app):
+    lo, hi = app.beta_credible_interval([0, 3], [10, 3], 0.9)
+    assert hi[0] == pytest.approx(0.17077, abs=1e-5)
+    assert lo[1] == pytest.approx(0.55593, abs=1e-5)
+    lo, hi = app.poisson_rate_interval([0, 1], 0.9)
+    # k = 0：Gamma(½) = χ²₁ / 2，χ²₁ 的 5% / 95% 分位數為 0.0039321 / 3.8414588
+    assert lo[0] == pytest.approx(0.0039321 / 2, rel=1e-4)
+    assert hi[0] == pytest.approx(3.8414588 / 2, rel=1e-6)
+    assert hi[1] == pytest.approx(3.90736, abs=1e-5)
+
+
+def test_vectorized_rows_are_independent(app):
+    k = np.array([0, 1, 5, 40, 2, 0])
+    n = np.array([0, 3, 5, 900, 2, 7])
+    lo, hi = app.beta_credible_interval(k, n)
+    for i in range(len(k)):
+        one = app.beta_credible_interval(k[i:i + 1], n[i:i + 1])
+        np.testing.assert_array_equal([lo[i], hi[i]], [one[0][0], one[1][0]])
+    assert np.isnan(lo[0]) and np.isnan(hi[0])
+    assert ((0 < lo[1:]) & (lo[1:] < hi[1:]) & (hi[1:] < 1)).all()
+
+
+def test_more_successes_than_trials_counts_as_all_successes(app):
+    over = app.beta_credible_interval([12], [10])
+    full = app.beta_credible_interval([10], [10])
+    np.testing.assert_array_equal(over, full)
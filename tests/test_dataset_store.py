@@ -0,0 +1,58 @@
+import gc
+import weakref
+
+import numpy as np
+import pandas as pd
+
+
+def result_table(n=200):
+    rng = np.random.default_rng(0)
+    body = pd.DataFrame({
+        '行銷活動名稱': [f'活動{i % 7}' for i in range(n)],
+        '廣告名稱': [f'素材{i:03d}' for i in range(n)],
+        '花費金額 (TWD)': rng.gamma(2, 500, n).round(2),
+        'CPA (TWD)': np.where(rng.random(n) < 0.1, np.nan, rng.gamma(2, 100, n).round(2)),
+    })
+    summary = pd.DataFrame({'行銷活動名稱': ['全帳戶平均'], '廣告名稱': [''], '花費金額 (TWD)': [0.0], 'CPA (TWD)': [0.0]})
+    return pd.concat([summary, body], ignore_index=True)
+
+
+def test_table_index_keeps_positions_not_the_table(app):
+    df = result_table()
+    index = app.TableIndex(df)
+    ref = weakref.ref(df)
+
+    hits = index.view(df, '活動3 素材1', 'CPA (TWD)', ascending=True)
+    page = index.page(df, hits, 1, 25)
+    body = df.iloc[1:]
+    expected = body[body['行銷活動名稱'].str.contains('活動3') & body['廣告名稱'].str.contains('素材1')]
+    expected = expected.sort_values('CPA (TWD)', kind='stable', na_position='last')
+    assert page.iloc[0]['行銷活動名稱'] == '全帳戶平均'
+    pd.testing.assert_frame_equal(page.iloc[1:], expected.head(25))
+
+    # 排序名次快取算進大小；索引不持有原表，原表可隨 bundle 釋放
+    base = index.estimated_nbytes()
+    index.rank(df, '花費金額 (TWD)', ascending=False)
+    assert index.estimated_nbytes() > base
+    del df, body, expected, page
+    gc.collect()
+    assert ref() is None
+
+
+def test_children_are_evicted_with_their_parent_and_resized(app):
+    store = app.DatasetStore(max_bytes=10_000, idle_seconds=3600)
+    parent = ('bundle', 'a')
+    store.get_or_build(parent, lambda: b'x' * 4_000)
+    df = result_table(50)
+    index = store.get_or_build(('table_index', 'bundle', 'a', 't'), lambda: app.TableIndex(df), 'sid', parent=parent)
+
+    # 建好之後補上的排序名次快取：refresh_nbytes 後倉庫的計量跟著更新
+    before = store.stats()['total_mb']
+    index.rank(df, 'CPA (TWD)')
+    store.refresh_nbytes(('table_index', 'bundle', 'a', 't'))
+    assert store.stats()['total_mb'] > before
+
+    # 超過上限：沒有引用的 parent 先被淘汰，仍被 session 引用的索引也一併移除
+    store.get_or_build(('bundle', 'b'), lambda: b'y' * 6_000)
+    stats = store.stats()
+    assert stats['entries'] == 1 and stats['evictions'] == 2
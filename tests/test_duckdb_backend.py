@@ -0,0 +1,40 @@
+import pandas as pd
+import pytest
+
+from conftest import assert_period_results_equal, make_export
+
+# 兩種後端都產生、且應逐格相同的 DataFrame / 表格清單
+FRAME_KEYS = ['trend_30d_df', 'new_adsets_df', 'new_creatives_df', 'bad_apple_df', 'cpm_change_df',
+              'cpm_change_adset_df', 'alerts_daily', 'alerts_weekly', 'budget_plan_df', 'forecast_df']
+RESULT_KEYS = ['res_p1', 'res_p7', 'res_pp7', 'res_p30']
+
+
+@pytest.fixture(params=['export.csv', 'export.parquet'])
+def server_export(request, app, tmp_path):
+    if not app.HAS_DUCKDB:
+        pytest.skip('duckdb 未安裝')
+    # 帶 30 天以前的歷史：DuckDB 只載入最近的視窗，結果仍須與 pandas 全量相同
+    raw = app.read_csv_bytes(make_export(days=60).to_csv(index=False).encode('utf-8'))
+    if request.param.endswith('.parquet'):
+        raw.to_parquet(tmp_path / request.param)
+    else:
+        raw.to_csv(tmp_path / request.param, index=False)
+    return raw, request.param, tmp_path
+
+
+def test_duckdb_bundle_matches_pandas(app, server_export):
+    raw, rel_path, data_dir = server_export
+    columns = app.default_analysis_columns(raw.columns.tolist())
+    expected = app.build_analysis_bundle(raw, *columns)
+    actual = app.build_analysis_bundle_duckdb(app.describe_duckdb_sources([rel_path], str(data_dir)), *columns)
+
+    assert actual['backend'] == 'duckdb'
+    assert actual['max_date'] == expected['max_date']
+    assert actual['periods'] == expected['periods']
+    for key in RESULT_KEYS:
+        assert_period_results_equal(actual[key], expected[key])
+    for key in FRAME_KEYS:
+        pd.testing.assert_frame_equal(
+            actual[key].reset_index(drop=True), expected[key].reset_index(drop=True), check_dtype=False, obj=key
+        )
+    assert [name for name, _ in actual['excel_stack']] == [name for name, _ in expected['excel_stack']]
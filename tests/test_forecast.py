@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+
+
+def test_constant_series_forecast_is_the_constant(app):
+    Y = np.array([[0.0] * 30, [5.0] * 30, [250.0] * 30])
+    fc = app.seasonal_es_forecast(Y, '2025-11-01', horizon=12)
+    for key in ('path', 'path_lo', 'path_hi'):
+        np.testing.assert_allclose(fc[key], np.repeat(Y[:, :1], 12, axis=1), atol=1e-9)
+    for key in ('total', 'total_lo', 'total_hi'):
+        np.testing.assert_allclose(fc[key], Y[:, 0] * 12, atol=1e-9)
+
+
+def test_weekly_pattern_continues(app):
+    pattern = np.array([100.0, 120, 90, 80, 150, 200, 60])
+    first_day = pd.Timestamp('2025-11-05')          # 不是星期一：星期效果須依實際星期對齊
+    T, horizon = 30, 10
+    Y = pattern[np.arange(T) % 7][None, :]
+    fc = app.seasonal_es_forecast(Y, first_day, horizon)
+    expected = pattern[np.arange(T, T + horizon) % 7]
+    np.testing.assert_allclose(fc['path'][0], expected, atol=1e-9)
+    np.testing.assert_allclose(fc['total'][0], expected.sum(), atol=1e-9)
+
+
+def test_noisy_series_interval_brackets_forecast(app):
+    rng = np.random.default_rng(5)
+    Y = np.maximum(rng.normal(1000, 150, (4, 30)), 0)
+    fc = app.seasonal_es_forecast(Y, '2025-11-01', horizon=15)
+    assert (fc['path_lo'] <= fc['path']).all() and (fc['path'] <= fc['path_hi']).all()
+    assert (fc['total_lo'] < fc['total']).all() and (fc['total'] < fc['total_hi']).all()
+    # 區間隨預測天數變寬
+    width = fc['path_hi'] - fc['path_lo']
+    assert (np.diff(width, axis=1) >= -1e-9).all()
+
+
+def test_month_end_table_for_flat_account(app):
+    days = pd.date_range('2025-11-01', '2025-11-20')
+    raw = pd.DataFrame([
+        (d.strftime('%Y-%m-%d'), f'活動{c}', f'活動{c}_組合', f'廣告{a}', 100.0, 2000, 40, 2)
+        for d in days for c in range(2) for a in range(2)
+    ], columns=['天數', '行銷活動名稱', '廣告組合名稱', '廣告名稱', '花費金額 (TWD)', '曝光次數', '連結點擊次數', '購買次數'])
+    bundle = app.build_analysis_bundle(raw, *app.default_analysis_columns(raw.columns.tolist()))
+    fc = bundle['forecast_df']
+    assert fc.attrs['month'] == '2025-11' and fc.attrs['remaining_days'] == 10
+
+    account = fc[fc['層級'] == '全帳戶'].iloc[0]
+    assert account['本月至今花費 (TWD)'] == 20 * 400
+    for col in ('預估月底花費 (TWD)', '月底花費下限 (TWD)', '月底花費上限 (TWD)'):
+        assert account[col] == 30 * 400
+    for col in ('預估月底轉換', '月底轉換下限', '月底轉換上限'):
+        assert account[col] == 30 * 8
+    assert account['預估月底 CPA (TWD)'] == 50
+
+    campaigns = fc[fc['層級'] == '行銷活動']
+    assert len(campaigns) == 2 and (campaigns['預估月底花費 (TWD)'] == 30 * 200).all()
+
+
+def hourly_flat_export(days, last_day_hours=24):
+    """每支廣告每小時花費 10、每天 0 點 1 次購買；最後一天只到 last_day_hours − 1 點"""
+    rows = []
+    for i, d in enumerate(days):
+        hours = range(last_day_hours if i == len(days) - 1 else 24)
+        rows += [
+            (d.strftime('%Y-%m-%d'), f'{h:02d}:00:00 - {h:02d}:59:59', f'活動{c}', f'活動{c}_組合', f'廣告{a}',
+             10.0, 50, 2, int(h == 0))
+            for h in hours for c in range(2) for a in range(2)
+        ]
+    return pd.DataFrame(rows, columns=['天數', '一天中的時段（廣告帳戶時區）', '行銷活動名稱', '廣告組合名稱', '廣告名稱',
+                                       '花費金額 (TWD)', '曝光次數', '連結點擊次數', '購買次數'])
+
+
+def test_partial_last_hourly_day_is_forecast_not_counted(app):
+    raw = hourly_flat_export(pd.date_range('2025-11-01', '2025-11-21'), last_day_hours=12)
+    bundle = app.build_analysis_bundle(raw, *app.default_analysis_columns(raw.columns.tolist()))
+    assert bundle['max_date'] == pd.Timestamp('2025-11-21') and bundle['alert_day'] == pd.Timestamp('2025-11-20')
+
+    # 11/21 只有半天：本月至今算到 11/20，11/21 整天由預估補上（不是半天實際 + 剩 9 天）
+    fc = bundle['forecast_df']
+    assert fc.attrs['remaining_days'] == 10
+    account = fc[fc['層級'] == '全帳戶'].iloc[0]
+    assert account['本月至今花費 (TWD)'] == 20 * 960
+    assert account['近7日日均花費 (TWD)'] == 960
+    for col in ('預估月底花費 (TWD)', '月底花費下限 (TWD)', '月底花費上限 (TWD)'):
+        assert account[col] == 30 * 960
+
+    daily = app.forecast_daily_frame(bundle['breakdown_cube'], bundle['periods'], bundle['alert_day'], None, 'spend')
+    assert daily['實際'].last_valid_index() == pd.Timestamp('2025-11-20')
+    assert daily.index[-1] == pd.Timestamp('2025-11-30') and (daily['預估'].dropna() == 960).all()
+
+    # 預算重分配的目前日均花費也只看完整日
+    curves = bundle['budget_curves_df']
+    assert len(curves) == 2 and (curves['目前日均花費 (TWD)'] == 480).all()
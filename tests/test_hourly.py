@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import assert_period_results_equal, make_export
+
+HOUR_COL = '一天中的時段（廣告帳戶時區）'
+
+
+def split_into_hours(daily, seed=0):
+    """逐日匯出 → 逐小時匯出：每列的整數指標依多項分配拆到 24 小時、花費以「分」拆，各小時加總等於原值"""
+    rng = np.random.default_rng(seed)
+    n = len(daily)
+    weights = rng.dirichlet(np.ones(24), size=n)
+
+    def split(total):
+        return np.stack([rng.multinomial(int(t), w) for t, w in zip(total, weights)])
+
+    clicks = daily['連結點擊次數'].astype(str).str.replace(',', '').astype(int).to_numpy()
+    parts = {
+        '花費金額 (TWD)': split(np.round(daily['花費金額 (TWD)'].to_numpy() * 100)) / 100,
+        '曝光次數': split(daily['曝光次數'].to_numpy()),
+        '連結點擊次數': split(clicks),
+        '購買次數': split(daily['購買次數'].to_numpy()),
+    }
+    hourly = daily.loc[np.repeat(np.arange(n), 24), ['天數', '行銷活動名稱', '廣告組合名稱', '廣告名稱']].reset_index(drop=True)
+    hourly.insert(1, HOUR_COL, np.tile([f'{h:02d}:00:00 - {h:02d}:59:59' for h in range(24)], n))
+    for col, values in parts.items():
+        hourly[col] = values.reshape(-1)
+    return hourly
+
+
+@pytest.fixture(scope='module')
+def daily_export():
+    """最後兩天 活動0 花費 ×3；倒數第二天 活動1 0 轉換 → 兩個日期的 P1D 警示不同"""
+    df = make_export(days=40)
+    days = sorted(df['天數'].unique())
+    df.loc[(df['行銷活動名稱'] == '活動0') & df['天數'].isin(days[-2:]), '花費金額 (TWD)'] *= 3
+    df.loc[(df['行銷活動名稱'] == '活動1') & (df['天數'] == days[-2]), '購買次數'] = 0
+    return df
+
+
+@pytest.fixture(scope='module')
+def hourly_export(daily_export):
+    return split_into_hours(daily_export)
+
+
+def test_collapsed_hourly_export_matches_daily_export(app, daily_export, hourly_export):
+    columns = app.default_analysis_columns(daily_export.columns.tolist())
+    assert app.default_analysis_columns(hourly_export.columns.tolist()) == columns
+    daily = app.build_analysis_bundle(daily_export, *columns)
+    hourly = app.build_analysis_bundle(hourly_export, *columns)
+
+    assert hourly['hourly_df'] is not None and daily['hourly_df'] is None
+    assert hourly['alert_day'] == hourly['max_date'] == daily['max_date']   # 最後一天 24 小時齊全：不往前移
+    for key in ('res_p1', 'res_p7', 'res_pp7', 'res_p30'):
+        assert_period_results_equal(hourly[key], daily[key])
+    assert not daily['alerts_daily'].empty
+    for key in ('alerts_daily', 'alerts_weekly', 'bad_apple_df', 'trend_30d_df', 'cpm_change_df'):
+        pd.testing.assert_frame_equal(hourly[key], daily[key], check_dtype=False, obj=key)
+
+
+def test_partial_last_day_shifts_daily_alerts_to_last_complete_day(app, daily_export, hourly_export):
+    columns = app.default_analysis_columns(daily_export.columns.tolist())
+    last = hourly_export['天數'].max()
+    hours = hourly_export[HOUR_COL].str[:2].astype(int)
+    partial = hourly_export[(hourly_export['天數'] != last) | (hours < 12)].reset_index(drop=True)
+    bundle = app.build_analysis_bundle(partial, *columns)
+
+    assert bundle['max_date'] == pd.Timestamp(last)
+    assert bundle['alert_day'] == pd.Timestamp(last) - pd.Timedelta(days=1)
+    # P1D 警示 = 只匯出到前一天時的警示（半天的數字不拿去比整天的 P7D 日均）
+    previous = app.build_analysis_bundle(daily_export[daily_export['天數'] != last], *columns)
+    assert '活動1' in set(bundle['alerts_daily']['名稱'])
+    pd.testing.assert_frame_equal(bundle['alerts_daily'], previous['alerts_daily'], check_dtype=False)
+    # 其他區間仍含最後一天已有的時段
+    assert bundle['res_p1'][0][1]['花費金額 (TWD)'].sum() > 0
+
+
+def intraday_frame(today_spend):
+    """8 天 × 24 小時、兩個活動（各一組合），每小時花費 100 / 點擊 20 / 曝光 1000 / 轉換 1；今日只到 11 點"""
+    rows = []
+    days = pd.date_range('2025-11-01', periods=8)
+    for d in days:
+        for h in range(12 if d == days[-1] else 24):
+            for camp in ('活動A', '活動B'):
+                spend = today_spend[camp] if d == days[-1] else 100.0
+                if spend:
+                    k = spend / 100
+                    rows.append((d, h, camp, f'{camp}_組合', spend, k, 20 * k, 1000 * k))
+    return pd.DataFrame(rows, columns=['天數', '小時', '行銷活動名稱', '廣告組合名稱', '花費金額 (TWD)', '購買次數', '連結點擊次數', '曝光次數'])
+
+
+def test_intraday_flags_spike_and_stall_against_same_hours(app):
+    alerts = app.check_intraday_anomalies(intraday_frame({'活動A': 300.0, '活動B': 0.0}), '購買次數')
+    found = set(zip(alerts['層級'], alerts['名稱'], alerts['類型']))
+    # 同時段（0 ~ 11 點）基準 1,200：活動A 今日 3,600 → 花費暴衝；活動B 沒花費 → 投放停滯
+    # （若拿整天 2,400 當基準，3,600 不會超過 1.5 倍）
+    assert found == {
+        ('行銷活動名稱', '活動A', '⏫ 花費暴衝'),
+        ('行銷活動名稱', '活動B', '⏸️ 投放停滯'),
+        ('廣告組合名稱', '活動A / 活動A_組合', '⏫ 花費暴衝'),
+        ('廣告組合名稱', '活動B / 活動B_組合', '⏸️ 投放停滯'),
+    }
+    assert alerts['今日花費'].iloc[0] == 3600
+
+    # 與基準相同的一天沒有任何警示
+    assert app.check_intraday_anomalies(intraday_frame({'活動A': 100.0, '活動B': 100.0}), '購買次數').empty
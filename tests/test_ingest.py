@@ -0,0 +1,40 @@
+import gzip
+import io
+import zipfile
+
+import pandas as pd
+import pytest
+
+from conftest import make_export
+
+
+def zipped(members):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize('use_arrow', [True, False])
+def test_byte_parts_parse_the_same_with_and_without_arrow(app, monkeypatch, use_arrow):
+    if use_arrow and not app.HAS_PYARROW:
+        pytest.skip('pyarrow 未安裝')
+    monkeypatch.setattr(app, 'HAS_PYARROW', use_arrow)
+    export = make_export(days=12)
+    days = sorted(export['天數'].unique())
+    first, second = export[export['天數'] <= days[7]], export[export['天數'] >= days[4]]   # 重疊 4 天
+    files = [
+        ('first.csv', b'\xef\xbb\xbf' + first.to_csv(index=False).encode('utf-8')),                # Excel 另存的 BOM
+        ('second.zip', zipped({'part.csv.gz': gzip.compress(second.to_csv(index=False).encode('cp950'))})),
+    ]
+    result = app.ingest_uploads(files)
+    assert result['ingest']['parts'] == ['first.csv', 'second.zip/part.csv']
+    assert result['ingest']['duplicates'] == 4 * 36
+
+    columns = app.default_analysis_columns(result['df'].columns.tolist())
+    got = app.standardize_frame(result['df'], *columns)
+    expected = app.standardize_frame(export, *columns)
+    pd.testing.assert_frame_equal(
+        got[expected.columns].reset_index(drop=True), expected.reset_index(drop=True), check_dtype=False
+    )
@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pandas as pd
+
+
+def account_tables(n_camp=4, n_ads=60):
+    camps = pd.DataFrame({
+        '行銷活動名稱': [f'活動{c}' for c in range(n_camp)] + ['全帳戶平均'],
+        '花費金額 (TWD)': [1000.0 * (c + 1) for c in range(n_camp)] + [0.0],
+    })
+    adsets = pd.DataFrame({
+        '行銷活動名稱': [f'活動{c}' for c in range(n_camp)],
+        '廣告組合名稱': [f'活動{c}_組合' for c in range(n_camp)],
+        '花費金額 (TWD)': camps['花費金額 (TWD)'].iloc[:n_camp],
+    })
+    detail = pd.DataFrame({
+        '行銷活動名稱': [f'活動{c}' for c in range(n_camp) for _ in range(n_ads)],
+        '廣告組合名稱': [f'活動{c}_組合' for c in range(n_camp) for _ in range(n_ads)],
+        '廣告名稱': [f'活動{c}_廣告{a:03d}' for c in range(n_camp) for a in range(n_ads)],
+        '花費金額 (TWD)': [float(n_ads - a) for _ in range(n_camp) for a in range(n_ads)],
+    })
+    return camps, adsets, detail
+
+
+def test_chunks_fit_budget_and_keep_every_ad(app):
+    camps, adsets, detail = account_tables()
+    budget = 800
+    chunks = app.partition_campaign_chunks(camps, adsets, detail, token_budget=budget)
+    assert len(chunks) > 1
+    assert all(app.estimate_tokens(c) <= budget for c in chunks)
+    text = '\n'.join(chunks)
+    for name in detail['廣告名稱']:
+        assert text.count(name) == 1, name
+    assert '全帳戶平均' not in text
+
+
+def test_oversized_campaign_is_split_not_truncated(app):
+    camps, adsets, detail = account_tables(n_camp=1, n_ads=200)
+    chunks = app.partition_campaign_chunks(camps, adsets, detail, token_budget=600)
+    assert len(chunks) > 2
+    assert '（續）' not in chunks[0] and all('活動0（續）' in c for c in chunks[1:])
+    # 依花費由高到低切段：第一段是花費最高的廣告
+    assert '活動0_廣告000' in chunks[0] and '活動0_廣告199' in chunks[-1]
+    assert sum(c.count('活動0_廣告') for c in chunks) == 200
+
+
+def test_map_calls_respect_key_limit_and_retry_rate_limits(app, monkeypatch):
+    camps, adsets, detail = account_tables(n_camp=6, n_ads=40)
+    app._get_key_semaphore('map-key', 2)
+    monkeypatch.setattr(app, 'get_rate_limiter', lambda api_key: app.KeyRateLimiter(rpm=60_000, tpm=1e9))
+
+    lock, state, calls = threading.Lock(), {'running': 0, 'peak': 0}, []
+
+    def fake_generate(api_key, model_name, user_text, system_text=None, feature='diagnosis', retry=0, **kwargs):
+        if feature == 'diagnosis_reduce':
+            return user_text
+        with lock:
+            calls.append(retry)
+            state['running'] += 1
+            state['peak'] = max(state['peak'], state['running'])
+        try:
+            time.sleep(0.02)
+            if retry == 0:
+                raise app.GeminiAPIError('⚠️ API 連線錯誤 (429)', 429, retry_after=0.01)
+            return f'finding retry={retry}'
+        finally:
+            with lock:
+                state['running'] -= 1
+
+    monkeypatch.setattr(app, 'gemini_generate_text', fake_generate)
+    report = app.call_gemini_analysis_map_reduce(
+        'map-key', None, None, camps, adset_p7=adsets, detail_p7=detail, chunk_tokens=800, map_concurrency=8
+    )
+    n_chunks = len(app.partition_campaign_chunks(camps, adsets, detail, 800))
+    # 平行數以 Key 的上限（2）為準，而不是 map_concurrency=8
+    assert n_chunks > 2 and state['peak'] <= 2
+    # 每段先 429 再重試成功：Reduce 拿到的是 findings，不是錯誤字串
+    assert sorted(calls) == [0] * n_chunks + [1] * n_chunks
+    assert '本段初診失敗' not in report and report.count('finding retry=1') == n_chunks
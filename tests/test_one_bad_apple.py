@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+CONV = '購買次數'
+
+
+def p7d_frame(rows):
+    return pd.DataFrame(rows, columns=['行銷活動名稱', '廣告組合名稱', '廣告名稱', '花費金額 (TWD)', CONV, '連結點擊次數'])
+
+
+def test_flags_single_bad_apple(app):
+    df = p7d_frame([
+        ('活動A', '組合1', '爛廣告', 3000.0, 0, 100),
+        ('活動A', '組合1', '好廣告', 1000.0, 10, 100),
+        ('活動B', '組合2', '基準', 1000.0, 10, 100),
+    ])
+    out = app.build_one_bad_apple_table(df, CONV)
+    assert out['廣告名稱'].tolist() == ['爛廣告']
+    row = out.iloc[0]
+    assert row['判定'].startswith('🍎')
+    assert row['移除後組合 CPA (TWD)'] == 100.0
+    assert row['組合 CPA (TWD)'] == 400.0
+    # 0 轉換的廣告 CPA 無定義，不是 0
+    assert np.isnan(row['廣告 CPA (TWD)'])
+
+
+def test_leave_one_out_matches_recomputing_without_the_ad(app):
+    rng = np.random.default_rng(1)
+    rows = []
+    for s in range(6):
+        for a in range(5):
+            conv = int(rng.poisson(3)) if s % 2 or a == 0 else 0   # 偶數組合只有第一支廣告有轉換
+            rows.append(('活動', f'組合{s}', f'廣告{a}', float(rng.gamma(2, 800)), conv, int(rng.integers(50, 500))))
+    df = p7d_frame(rows)
+    out = app.build_one_bad_apple_table(df, CONV, min_adset_spend=0, cpa_excess_ratio=0, top_n=len(df))
+    assert not out.empty
+
+    for _, row in out.iterrows():
+        rest = df[(df['廣告組合名稱'] == row['廣告組合名稱']) & (df['廣告名稱'] != row['廣告名稱'])]
+        if rest[CONV].sum() > 0:
+            expected = rest['花費金額 (TWD)'].sum() / rest[CONV].sum()
+            assert row['移除後組合 CPA (TWD)'] == round(expected, 2)
+        else:
+            # 移除後沒有轉換：CPA 無定義（不是 0，否則會被當成最好的組合）
+            assert np.isnan(row['移除後組合 CPA (TWD)'])
+
+    undefined = out['移除後組合 CPA (TWD)'].isna().to_numpy()
+    assert undefined.any() and not undefined.all()
+    # 無定義的列排在所有有定義的列之後
+    assert not (undefined[:-1] & ~undefined[1:]).any()
+
+
+def test_zero_conversion_adset_has_undefined_cpa(app):
+    df = p7d_frame([
+        ('活動A', '組合1', '廣告甲', 2000.0, 0, 100),
+        ('活動A', '組合1', '廣告乙', 1500.0, 0, 100),
+        ('活動B', '組合2', '基準', 1000.0, 10, 100),
+    ])
+    out = app.build_one_bad_apple_table(df, CONV)
+    assert sorted(out['廣告名稱']) == ['廣告乙', '廣告甲']
+    assert (out['判定'] == '⚠️ 全體偏差（檢討組合）').all()
+    assert out[['廣告 CPA (TWD)', '組合 CPA (TWD)', '移除後組合 CPA (TWD)']].isna().all().all()
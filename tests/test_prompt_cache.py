@@ -0,0 +1,47 @@
+import threading
+import time
+
+
+def test_cache_build_blocks_only_its_own_key(app, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    created = []
+
+    def create(api_key, model, system_text):
+        created.append(api_key)
+        if api_key == 'slow-key':
+            started.set()
+            release.wait(5)
+        return f'cachedContents/{api_key}', None
+
+    monkeypatch.setattr(app, '_create_prompt_cache', create)
+    results = {}
+    slow = [threading.Thread(target=lambda i=i: results.__setitem__(i, app.get_prompt_cache('slow-key', 'm', 'sys')))
+            for i in range(3)]
+    slow[0].start()
+    assert started.wait(5)
+    for t in slow[1:]:
+        t.start()
+
+    # 另一把 Key 的快取建立不必等 slow-key 的網路呼叫
+    t0 = time.perf_counter()
+    assert app.get_prompt_cache('fast-key', 'm', 'sys')['name'] == 'cachedContents/fast-key'
+    assert time.perf_counter() - t0 < 1
+
+    release.set()
+    for t in slow:
+        t.join(5)
+    # 同一項目只建立一次，等候者讀到同一筆
+    assert created.count('slow-key') == 1
+    assert {r['name'] for r in results.values()} == {'cachedContents/slow-key'}
+
+    app.invalidate_prompt_cache('slow-key', 'm', 'sys')
+    app.get_prompt_cache('slow-key', 'm', 'sys')
+    assert created.count('slow-key') == 2
+
+
+def test_failed_build_falls_back_to_system_instruction(app, monkeypatch):
+    def create(api_key, model, system_text):
+        raise RuntimeError('prompt too short to cache')
+
+    monkeypatch.setattr(app, '_create_prompt_cache', create)
+    assert app.get_prompt_cache('failing-key', 'm', 'sys') is None
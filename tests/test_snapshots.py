@@ -0,0 +1,114 @@
+import pandas as pd
+import pytest
+
+from conftest import assert_period_results_equal
+
+
+@pytest.fixture
+def snapshot_db(app, tmp_path, monkeypatch):
+    path = str(tmp_path / 'snapshots.sqlite')
+    monkeypatch.setattr(app, 'SNAPSHOT_DB', path)
+    return path
+
+
+def full_rebuild(app, df_std, conv):
+    """不經快照、直接從原始列匯總各視窗"""
+    periods = app.report_periods(df_std['天數'].max().normalize())
+    out = {}
+    for window in app.SNAPSHOT_WINDOWS:
+        start, end = periods[window]
+        part = df_std[(df_std['天數'] >= start) & (df_std['天數'] <= end)]
+        out[window] = app.collect_period_results(part, window, conv)
+    return out
+
+
+def assert_windows_match(app, df_std, conv, db_path, account='acct'):
+    expected = full_rebuild(app, df_std, conv)
+    for window in app.SNAPSHOT_WINDOWS:
+        assert_period_results_equal(app.snapshot_period_results(account, conv, window, db_path), expected[window])
+
+
+def test_append_and_restate_match_full_rebuild(app, raw_export, analysis_columns, snapshot_db):
+    conv = analysis_columns[0]
+    df_std = app.standardize_frame(raw_export, *analysis_columns)
+    last = df_std['天數'].max()
+
+    first = app.refresh_snapshots('acct', df_std[df_std['天數'] <= last - pd.Timedelta(days=3)], conv)
+    assert len(first['changed_days']) == df_std['天數'].nunique() - 3
+
+    # 新增 3 天：只處理新日子，視窗隨最後一天滑動
+    appended = app.refresh_snapshots('acct', df_std, conv)
+    assert len(appended['changed_days']) == 3
+    assert_windows_match(app, df_std, conv, snapshot_db)
+
+    # 重述：P7D 內某天的花費被平台修正、P30D 之前（已滑出視窗）的某天也改了
+    restated = df_std.copy()
+    p7_day = last - pd.Timedelta(days=2)
+    old_day = df_std['天數'].min()
+    restated.loc[restated['天數'] == p7_day, '花費金額 (TWD)'] *= 1.1
+    restated.loc[restated['天數'] == old_day, conv] += 1
+    summary = app.refresh_snapshots('acct', restated, conv)
+    assert summary['changed_days'] == sorted(d.strftime('%Y-%m-%d') for d in (old_day, p7_day))
+    assert_windows_match(app, restated, conv, snapshot_db)
+
+    # 同一份資料再跑一次：沒有變動日
+    assert app.refresh_snapshots('acct', restated, conv)['changed_days'] == []
+
+
+def test_removed_day_and_stale_file(app, raw_export, analysis_columns, snapshot_db):
+    conv = analysis_columns[0]
+    df_std = app.standardize_frame(raw_export, *analysis_columns)
+    app.refresh_snapshots('acct', df_std, conv)
+
+    gone = df_std['天數'].max() - pd.Timedelta(days=4)
+    trimmed = df_std[df_std['天數'] != gone].reset_index(drop=True)
+    assert app.refresh_snapshots('acct', trimmed, conv)['removed_days'] == [gone.strftime('%Y-%m-%d')]
+    assert_windows_match(app, trimmed, conv, snapshot_db)
+
+    # 比快照舊的檔案不更新快照
+    assert app.refresh_snapshots('acct', trimmed[trimmed['天數'] < gone], conv) is None
+    assert_windows_match(app, trimmed, conv, snapshot_db)
+
+
+def test_snapshot_bundle_depends_only_on_file(app, raw_export, analysis_columns, snapshot_db):
+    fresh = app.build_analysis_bundle(raw_export, *analysis_columns)
+    first = app.build_analysis_bundle(raw_export, *analysis_columns, snapshot_account='a/export')
+    assert first['snapshot']['windows']
+
+    # 同帳戶只匯出最近幾天：視窗快照含檔案以外的歷史 → 不讀快照，結果與全新計算相同
+    dates = pd.to_datetime(raw_export['天數'])
+    short = raw_export[dates > dates.max() - pd.Timedelta(days=7)].reset_index(drop=True)
+    short_bundle = app.build_analysis_bundle(short, *analysis_columns, snapshot_account='a/export')
+    assert not short_bundle['snapshot']['windows']
+    short_fresh = app.build_analysis_bundle(short, *analysis_columns)
+
+    for key in ('res_p1', 'res_p7', 'res_pp7', 'res_p30'):
+        assert_period_results_equal(first[key], fresh[key])
+        assert_period_results_equal(short_bundle[key], short_fresh[key])
+
+    # 不同資料夾的同名檔案是不同帳戶
+    assert app.snapshot_account_for_export('a/export.csv') != app.snapshot_account_for_export('b/export.csv')
+
+
+def test_concurrent_file_for_same_account_does_not_leak_into_bundle(app, raw_export, analysis_columns,
+                                                                     snapshot_db, monkeypatch):
+    conv = analysis_columns[0]
+    other = raw_export.copy()
+    other['花費金額 (TWD)'] = other['花費金額 (TWD)'] * 2      # 同帳戶、同日期範圍，但每天都被重述
+    other_std = app.standardize_frame(other, *analysis_columns)
+
+    # 模擬 daemon 同時處理同帳戶的另一個檔案：在快照更新之後、各階段計算之前插入它的更新
+    assemble = app.assemble_analysis_bundle
+
+    def interleaved(*args, **kwargs):
+        app.refresh_snapshots('a/export', other_std, conv)
+        return assemble(*args, **kwargs)
+
+    monkeypatch.setattr(app, 'assemble_analysis_bundle', interleaved)
+    bundle = app.build_analysis_bundle(raw_export, *analysis_columns, snapshot_account='a/export')
+    monkeypatch.setattr(app, 'assemble_analysis_bundle', assemble)
+
+    assert bundle['snapshot']['windows'] and 'window_results' not in bundle['snapshot']
+    fresh = app.build_analysis_bundle(raw_export, *analysis_columns)
+    for key in ('res_p1', 'res_p7', 'res_pp7', 'res_p30'):
+        assert_period_results_equal(bundle[key], fresh[key])
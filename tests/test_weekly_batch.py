@@ -0,0 +1,92 @@
+import json
+import os
+
+import pytest
+
+from conftest import make_export
+
+
+class FakeClock:
+    """取代 time.monotonic / time.sleep：sleep 直接把時間往前推，測試不必真的等"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(app.time, 'monotonic', fake.monotonic)
+    monkeypatch.setattr(app.time, 'sleep', fake.sleep)
+    return fake
+
+
+def test_token_bucket_reservations_queue_up(app, clock):
+    bucket = app.TokenBucket(60)                       # 每秒 1 個，容量 1
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    assert bucket.reserve(1) == pytest.approx(2.0)     # 透支：後面的預約依序往後排
+    clock.now += 2
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    clock.now += 60
+    assert bucket.reserve(1) == 0                      # 閒置後最多只累積容量，不會一次衝出整分鐘的額度
+    assert bucket.reserve(1) == pytest.approx(1.0)
+
+
+def test_rate_limiter_waits_for_both_buckets_and_pauses_after_429(app, clock):
+    limiter = app.KeyRateLimiter(rpm=60, tpm=60_000)   # 每秒 1 次請求、1000 token
+    assert limiter.acquire(500) == 0
+    assert limiter.acquire(3000) == pytest.approx(2.5)  # TPM 比 RPM 緊：等 token 桶
+    assert clock.sleeps == [pytest.approx(2.5)]
+
+    clock.now += 10
+    limiter.backoff(5)                                  # 429：整把 Key 暫停 5 秒（清空額度再透支 5 秒）
+    assert limiter.acquire(1) == pytest.approx(6.0)     # 暫停 5 秒 + 這次請求本身在 RPM 桶的 1 秒
+    assert limiter.acquire(1) == pytest.approx(1.0)     # 後面的預約接著排，不會在暫停結束時一起衝出去
+
+
+def test_scheduled_call_backs_off_on_429_then_succeeds(app, clock, monkeypatch):
+    responses = [
+        app.GeminiAPIError('⚠️ API 連線錯誤 (429)', 429, retry_after=7),
+        json.dumps({'status_summary': 'ok'}),
+    ]
+
+    def fake_raw(api_key, prompt, retry=0):
+        r = responses.pop(0)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+    monkeypatch.setattr(app, '_gemini_weekly_raw', fake_raw)
+    limiter = app.KeyRateLimiter(rpm=600, tpm=10_000_000)
+    result = app.call_gemini_weekly_draft_scheduled('k', 'prompt', limiter)
+    assert result['draft']['status_summary'] == 'ok' and result['attempts'] == 2
+    # Retry-After 7 秒由 limiter 暫停整把 Key，第二次預約因此等待約 7 秒
+    assert clock.sleeps and clock.sleeps[-1] == pytest.approx(7, abs=0.2)
+
+
+def test_same_named_exports_in_different_folders_do_not_overwrite(app, tmp_path, monkeypatch):
+    data_dir = tmp_path / 'exports'
+    for client in ('clientA', 'clientB'):
+        (data_dir / client).mkdir(parents=True)
+        make_export(days=20, seed=len(client) + ord(client[-1])).to_csv(data_dir / client / 'export.csv', index=False)
+    jobs = [app.weekly_inputs_for_export(f'{c}/export.csv', str(data_dir)) for c in ('clientA', 'clientB')]
+    assert [j['account'] for j in jobs] == ['clientA/export', 'clientB/export']
+
+    monkeypatch.setattr(app, '_gemini_weekly_raw', lambda api_key, prompt, retry=0: json.dumps({'status_summary': prompt[-40:]}))
+    out = tmp_path / 'out'
+    rows = app.run_weekly_batch('k', jobs, str(out), rpm=6000, tpm=10_000_000, max_workers=2)
+    assert all(r['ok'] for r in rows)
+    written = sorted(os.path.relpath(os.path.join(d, f), out) for d, _, fs in os.walk(out) for f in fs)
+    assert written == sorted(os.path.join(c, f'export.{ext}') for c in ('clientA', 'clientB') for ext in ('json', 'md'))
+    payloads = [json.loads((out / c / 'export.json').read_text(encoding='utf-8')) for c in ('clientA', 'clientB')]
+    assert [p['account'] for p in payloads] == ['clientA/export', 'clientB/export']
+    assert payloads[0]['p7_overall'] != payloads[1]['p7_overall']
@@ -0,0 +1,52 @@
+import json
+
+DRAFT = {
+    'status_summary': '本週 CPA 持平。',
+    'audience_effective': ['組合 A（CPA 低）'],
+    'audience_ineffective': [],
+    'creative_effective': ['素材 1'],
+    'creative_ineffective': ['素材 2'],
+    'next_week_plan_reco': [{'type': '2. 補素材', 'recommend': True, 'reason': '素材疲乏', 'actions': ['新增 3 支']}],
+}
+
+
+def test_parses_valid_json_directly(app):
+    draft, how = app.parse_weekly_draft(json.dumps(DRAFT, ensure_ascii=False))
+    assert how == 'direct'
+    assert draft == DRAFT
+
+
+def test_repairs_fenced_json_with_trailing_commas(app):
+    text = '以下是週報：\n```json\n' + json.dumps(DRAFT, ensure_ascii=False, indent=2).replace(']\n', '],\n') + '\n```'
+    draft, how = app.parse_weekly_draft(text)
+    assert how == 'repaired'
+    assert draft == DRAFT
+
+
+def test_repairs_truncated_json(app):
+    text = json.dumps(DRAFT, ensure_ascii=False)
+    draft, how = app.parse_weekly_draft(text[:text.index('"creative_effective"') + 30])
+    assert how == 'repaired'
+    assert draft['status_summary'] == DRAFT['status_summary']
+    assert draft['audience_effective'] == DRAFT['audience_effective']
+    assert draft['next_week_plan_reco'] == []
+
+
+def test_normalizes_loose_types(app):
+    text = json.dumps({
+        'status_summary': '  ok ',
+        'creative_effective': '- 素材 1\n- 素材 2',
+        'next_week_plan_reco': [{'type': '5', 'recommend': '是'}, {'type': '不存在的計畫'}, 'x'],
+    }, ensure_ascii=False)
+    draft, _ = app.parse_weekly_draft(text)
+    assert draft['status_summary'] == 'ok'
+    assert draft['creative_effective'] == ['素材 1', '素材 2']
+    assert draft['audience_ineffective'] == []
+    assert draft['next_week_plan_reco'] == [
+        {'type': app.PLAN_TYPES[4], 'recommend': True, 'reason': '', 'actions': []},
+    ]
+
+
+def test_unparseable_text(app):
+    assert app.parse_weekly_draft('模型沒有回傳 JSON') == (None, None)
+    assert app.parse_weekly_draft('') == (None, None)